@@ -1,20 +1,91 @@
 import json
 import boto3
+import tempfile
+import gzip
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from queue import Queue
 from datetime import datetime, UTC
 from pg8000.native import Connection
 import os
+import re
+import math
+import time
 from decimal import Decimal
 # import dotenv # for local implementation
 
-from pg8000.exceptions import DatabaseError
+from pg8000.exceptions import DatabaseError, InterfaceError
 # from pprint import pprint
 
+RAW_FORMATS = ["json", "ndjson.gz", "parquet"]
+
+TABLE_NAMES = ["address", "counterparty", "currency", "department",
+               "design", "payment", "payment_type", "purchase_order",
+               "staff", "transaction", "sales_order"]
+
+# columns extracted from each table and their types, limited to those used by mvp_transform_df in
+# lambda_transform (and last_updated, which orders row versions). Tables not listed are extracted
+# with SELECT * and encoded through serialise_object
+EXTRACT_COLUMNS = {
+    "address": {"address_id": "int", "address_line_1": "str", "address_line_2": "str", "district": "str",
+                "city": "str", "postal_code": "str", "country": "str", "phone": "str", "last_updated": "timestamp"},
+    "counterparty": {"counterparty_id": "int", "counterparty_legal_name": "str", "legal_address_id": "int",
+                     "last_updated": "timestamp"},
+    "currency": {"currency_id": "int", "currency_code": "str", "last_updated": "timestamp"},
+    "department": {"department_id": "int", "department_name": "str", "location": "str", "last_updated": "timestamp"},
+    "design": {"design_id": "int", "design_name": "str", "file_location": "str", "file_name": "str",
+               "last_updated": "timestamp"},
+    "staff": {"staff_id": "int", "first_name": "str", "last_name": "str", "department_id": "int",
+              "email_address": "str", "last_updated": "timestamp"},
+    "sales_order": {"sales_order_id": "int", "created_at": "timestamp", "last_updated": "timestamp",
+                    "design_id": "int", "staff_id": "int", "counterparty_id": "int", "units_sold": "int",
+                    "unit_price": "float", "currency_id": "int", "agreed_delivery_date": "str",
+                    "agreed_payment_date": "str", "agreed_delivery_location_id": "int"},
+}
+
+# JSON encoder of a non-null value of each EXTRACT_COLUMNS type, output matches json.dumps with serialise_object
+# except for non-finite floats, which are written as null. Values not of the declared type go through encode_value
+JSON_ENCODERS = {
+    "int": lambda value: str(value) if type(value) is int else encode_value(value),
+    "float": lambda value: encode_float(value),
+    "str": lambda value: json.dumps(value) if type(value) is str else encode_value(value),
+    "timestamp": lambda value: '"' + value.isoformat() + '"' if type(value) is datetime else encode_value(value),
+}
+
+# stage in which terraform/state_machine.asl.json transforms and loads each table (default 1).
+# Stage 2 tables join against a stage 1 snapshot (TRANSFORM_DEPENDENCIES in lambda_transform),
+# stage 3 tables feed facts, which are loaded after every dimension (TABLE_DEPENDENCIES in lambda_load)
+PIPELINE_STAGES = {"staff": 2, "counterparty": 2, "sales_order": 3}
+
+# database connection kept open between warm invocations, see get_conn
+db_connection = None
+
+CREDENTIAL_BACKENDS = ["s3", "file", "env"]
+
+# (backend, name) -> (expiry on time.monotonic(), value), kept between warm invocations
+credential_cache = {}
+
 def lambda_extract(events, context):
     """ 
     Function that calls utility functions to extract data from DB.
+    Setting the EXTRACT_MODE environment variable to 'stream' pulls rows through a
+    server-side cursor in batches of STREAM_BATCH_SIZE instead of loading whole tables.
+    Setting RAW_CHUNK_ROWS and/or RAW_CHUNK_MB splits each table into size-bounded
+    objects listed by a manifest, whose key is returned in place of the single object key.
+    Setting EXTRACT_WORKERS above 1 extracts that many tables at once, each on its own connection.
+    The extraction timestamps are only saved once every table has been written.
+    The serial path and the change check reuse the module's connection between warm invocations (see get_conn).
+    Tables are first checked for new rows with a single query (see count_changed_rows) and only
+    the tables that have new rows are extracted. Skipped tables keep their last extraction timestamp.
+    When the state machine passes the 'changed_tables' found by lambda_probe, those are extracted
+    without checking again.
+    RAW_FORMAT selects the raw object format: 'json' (default), 'ndjson.gz' or 'parquet'.
+    Tables in EXTRACT_COLUMNS are extracted with only the columns the transform uses (see build_query).
 
     Args:
-        events (None): Optional argument passed by AWS to trigger function - not used in this implementation
+        events (dict | None): Optional argument passed by AWS to trigger function, the output of lambda_probe
+                              when run by the state machine - only 'changed_tables' is used
         context (None): Optional argument passed by AWS containing information about invocation,
                         function configuration or execution environment - not used in this implementation
 
@@ -22,33 +93,331 @@ def lambda_extract(events, context):
         dict:   'message': <status message> ,
                 'timestamp': <timestamp of last updated table>,
                 'total_new_files': <count of recently updated tables>,
-                'new_keys': <list containing keys of recently updated tables>
+                'new_keys': <list containing keys of recently updated tables>,
+                'work_stages': <transform events per key, grouped by stage, see build_work_stages>
 
     """
 
     extract_client = boto3.client('s3')
-    db = create_conn(extract_client)
     bucket_name = os.environ['INGESTION_S3']
-    table_names = ["address", "counterparty", "currency", "department", 
-                   "design", "payment", "payment_type", "purchase_order",
-                   "staff", "transaction", "sales_order"]
+    table_names = TABLE_NAMES
     last_timestamp_dict, timestamp_key = get_last_timestamps(extract_client, bucket_name)
-    new_timestamp_dict = {}
+    probe_time = datetime.now(UTC).isoformat().replace('+00:00','')
+    db = get_conn(extract_client)
+    if events and events.get("changed_tables") is not None:
+        changed_tables = [table_name for table_name in table_names if table_name in events["changed_tables"]]
+    else:
+        changed_rows = count_changed_rows(db, table_names, last_timestamp_dict)
+        changed_tables = find_changed_tables(table_names, changed_rows, last_timestamp_dict)
+    workers = int(os.environ.get("EXTRACT_WORKERS", 1))
+    if workers > 1:
+        results = extract_tables_concurrently(extract_client, bucket_name, changed_tables, last_timestamp_dict, workers)
+    else:
+        results = [
+            extract_table(db, extract_client, bucket_name, table_name, last_timestamp_dict.get(table_name, None))
+            for table_name in changed_tables
+        ]
+    # skipped tables keep their timestamp
+    new_timestamp_dict = {table_name: last_timestamp_dict.get(table_name, None) for table_name in table_names}
     new_keys = []
-    for table_name in table_names:
-        last_extract = last_timestamp_dict.get(table_name, None)
-        new_dict_list, extract_time = get_data(db, table_name, last_extract)
+    for table_name, (extract_time, any_key) in zip(changed_tables, results):
         new_timestamp_dict[table_name]= extract_time
-        any_key = save_to_s3(extract_client, bucket_name, new_dict_list, table_name, extract_time)
         if any_key:
             new_keys.append(any_key)
-    db.close()
     extract_client.put_object(Bucket=bucket_name, Body=json.dumps(new_timestamp_dict, default=serialise_object, indent=2), 
             Key=timestamp_key)
-    return {'message':'completed ingestion', 'timestamp':new_timestamp_dict['transaction'],
-            'total_new_files':len(new_keys), 'new_keys':new_keys}
+    timestamp = new_timestamp_dict['transaction'] if 'transaction' in changed_tables else probe_time
+    return {'message':'completed ingestion', 'timestamp':timestamp,
+            'total_new_files':len(new_keys), 'new_keys':new_keys,
+            'work_stages':build_work_stages(new_keys, timestamp)}
     
 
+def lambda_probe(events, context):
+    """
+    Function that checks whether any table has changed since its last extraction, run by the state
+    machine before lambda_extract so that runs with nothing to extract end straight away.
+    Every table is checked with a single query (see count_changed_rows) on the module's connection.
+    If SCHEDULE_RULE names the EventBridge rule that starts the state machine, its rate is halved
+    while tables keep changing and doubled while they do not, between SCHEDULE_MIN_MINUTES (default 5)
+    and SCHEDULE_MAX_MINUTES (default 20) (see adapt_schedule).
+    The state machine passes the ARN of its execution; while another execution of the state machine is
+    still running the probe reports no change, so that two runs never extract from the same timestamps.
+
+    Args:
+        events (dict): Optional, 'execution_arn': <ARN of the state machine execution running the probe>
+        context (None): Optional argument passed by AWS containing information about invocation,
+                        function configuration or execution environment - not used in this implementation
+
+    Returns:
+        dict:   'message': <status message> ,
+                'timestamp': <UTC timestamp of the check>,
+                'changed': <True if any table has rows to extract>,
+                'changed_tables': <list of tables with rows to extract>,
+                'interval_minutes': <minutes until the next scheduled run, None without SCHEDULE_RULE>
+    """
+
+    timestamp = datetime.now(UTC).isoformat().replace('+00:00','')
+    execution_arn = events.get("execution_arn") if events else None
+    if execution_arn and other_running_executions(boto3.client('stepfunctions'), execution_arn):
+        return {'message':'skipped probe, previous run still in progress', 'timestamp':timestamp,
+                'changed':False, 'changed_tables':[], 'interval_minutes':None}
+    extract_client = boto3.client('s3')
+    bucket_name = os.environ['INGESTION_S3']
+    last_timestamp_dict, _ = get_last_timestamps(extract_client, bucket_name)
+    db = get_conn(extract_client)
+    changed_rows = count_changed_rows(db, TABLE_NAMES, last_timestamp_dict)
+    changed_tables = find_changed_tables(TABLE_NAMES, changed_rows, last_timestamp_dict)
+    interval = None
+    if os.environ.get("SCHEDULE_RULE"):
+        interval = adapt_schedule(boto3.client('events'), os.environ["SCHEDULE_RULE"], bool(changed_tables),
+                                  int(os.environ.get("SCHEDULE_MIN_MINUTES", 5)),
+                                  int(os.environ.get("SCHEDULE_MAX_MINUTES", 20)))
+    return {'message':'completed probe', 'timestamp':timestamp,
+            'changed':bool(changed_tables), 'changed_tables':changed_tables, 'interval_minutes':interval}
+
+
+def other_running_executions(sfn_client, execution_arn):
+    """
+    Utility function, lists the running executions of a state machine other than the given one
+
+    Args:
+        sfn_client (Object): a boto3 Step Functions client
+        execution_arn (str): ARN of an execution of the state machine,
+                             e.g. 'arn:aws:states:<region>:<account>:execution:<state machine>:<id>'
+
+    Returns:
+        list: ARNs of the other running executions
+    """
+
+    arn_parts = execution_arn.split(":")
+    state_machine_arn = ":".join(arn_parts[:5] + ["stateMachine", arn_parts[6]])
+    response = sfn_client.list_executions(stateMachineArn=state_machine_arn, statusFilter="RUNNING")
+    return [execution["executionArn"] for execution in response["executions"]
+            if execution["executionArn"] != execution_arn]
+
+
+def count_changed_rows(db, table_names, last_timestamp_dict):
+    """
+    Utility function, counts the rows each table would return to build_query, for every table in a single
+    UNION ALL query, so that tables without new rows can be skipped without querying them one by one.
+    If the query fails, each table is counted on its own so that one failing table does not stop the
+    others; tables whose count fails are returned as None and extracted as usual, where get_data
+    handles the error as before
+
+    Args:
+        db (pg8000 Object): pg8000.Native.Connection object
+        table_names (list): DB table names to be checked
+        last_timestamp_dict (dict): tablenames (k) and timestamp of last update check (v)
+
+    Returns:
+        dict: tablenames (k) and count of rows updated since their last extraction, every row if never extracted,
+              None if the count failed (v)
+    """
+
+    selects = []
+    for table_name in table_names:
+        select = f"SELECT '{table_name}' AS table_name, count(*) AS changed_rows FROM {table_name}"
+        last_extract = last_timestamp_dict.get(table_name, None)
+        if last_extract:
+            select += f" WHERE last_updated > '{last_extract}'"
+        selects.append(select)
+    try:
+        return {table_name: changed_rows for table_name, changed_rows in db.run(" UNION ALL ".join(selects))}
+    except DatabaseError:
+        changed_rows = {}
+        for table_name, select in zip(table_names, selects):
+            try:
+                changed_rows[table_name] = db.run(select)[0][1]
+            except DatabaseError:
+                changed_rows[table_name] = None
+        return changed_rows
+
+
+def find_changed_tables(table_names, changed_rows, last_timestamp_dict):
+    """
+    Utility function, lists the tables that need extracting: those with new rows or a failed count, and
+    those never extracted, which are extracted even when empty so that every table gets a timestamp
+
+    Args:
+        table_names (list): DB table names
+        changed_rows (dict): tablenames (k) and count of new rows (v), see count_changed_rows
+        last_timestamp_dict (dict): tablenames (k) and timestamp of last update check (v)
+
+    Returns:
+        list: table names in table_names order
+    """
+
+    return [table_name for table_name in table_names
+            if changed_rows[table_name] != 0 or not last_timestamp_dict.get(table_name, None)]
+
+
+def adapt_schedule(events_client, rule_name, changed, min_minutes=5, max_minutes=20):
+    """
+    Utility function, halves the rate of the EventBridge schedule rule when tables have changed and
+    doubles it when they have not, keeping it between min_minutes and max_minutes. The rule is only
+    updated when its rate changes
+
+    Args:
+        events_client (Object): a boto3 EventBridge client
+        rule_name (str): name of the schedule rule
+        changed (bool): whether any table changed since the last run
+        min_minutes (int, optional): shortest interval. Defaults to 5.
+        max_minutes (int, optional): longest interval. Defaults to 20.
+
+    Returns:
+        int: interval of the rule in minutes after the update
+    """
+
+    rule = events_client.describe_rule(Name=rule_name)
+    minutes = parse_rate(rule["ScheduleExpression"])
+    new_minutes = max(min_minutes, minutes // 2) if changed else min(max_minutes, minutes * 2)
+    if new_minutes != minutes:
+        # put_rule replaces the whole rule, so the description is passed back unchanged
+        events_client.put_rule(Name=rule_name, ScheduleExpression=rate_expression(new_minutes),
+                               Description=rule.get("Description", ""), State=rule.get("State", "ENABLED"))
+    return new_minutes
+
+
+def parse_rate(expression):
+    """
+    Utility function, reads the interval of an EventBridge rate expression
+
+    Args:
+        expression (str): e.g. 'rate(20 minutes)' or 'rate(1 hour)'
+
+    Raises:
+        ValueError: for cron or malformed expressions
+
+    Returns:
+        int: interval in minutes
+    """
+
+    match = re.fullmatch(r"rate\((\d+) (minute|minutes|hour|hours|day|days)\)", expression.strip())
+    if not match:
+        raise ValueError(f"Unsupported schedule expression: {expression}")
+    unit_minutes = {"minute": 1, "hour": 60, "day": 1440}[match.group(2).rstrip("s")]
+    return int(match.group(1)) * unit_minutes
+
+
+def rate_expression(minutes):
+    """
+    Utility function, builds an EventBridge rate expression, which needs the singular unit for 1
+
+    Args:
+        minutes (int): interval in minutes
+
+    Returns:
+        str: rate expression
+    """
+
+    return f"rate({minutes} minute)" if minutes == 1 else f"rate({minutes} minutes)"
+
+
+def extract_table(db, extract_client, bucket_name, table_name, last_extract=None):
+    """
+    Utility function, extracts one table and writes it to the S3 bucket using the
+    extract mode and output layout selected by the environment variables
+
+    Args:
+        db (pg8000 Object): pg8000.Native.Connection object
+        extract_client (Object): a boto3 client object to query the S3 bucket
+        bucket_name (Object): an S3 bucket name where the JSON objects are stored
+        table_name (str): DB table name to be queried
+        last_extract (str, optional): Timestamp of last 'table_name' update check. Defaults to None.
+
+    Returns:
+        extract_time (str) : UTC timestamp of query
+        key (str): S3 Object key of the new data, None if there were no new rows
+    """
+
+    chunk_rows = os.environ.get("RAW_CHUNK_ROWS")
+    chunk_mb = os.environ.get("RAW_CHUNK_MB")
+    raw_format = os.environ.get("RAW_FORMAT", "json")
+    max_rows = int(chunk_rows) if chunk_rows else None
+    max_bytes = int(float(chunk_mb) * 1024 * 1024) if chunk_mb else None
+    if os.environ.get("EXTRACT_MODE", "full") == "stream":
+        # the cursor's transaction ends with the with block, before db is reused or returned to a pool
+        with stream_data(db, table_name, last_extract) as (batches, extract_time):
+            if not (chunk_rows or chunk_mb):
+                key = save_stream_to_s3(extract_client, bucket_name, batches, table_name, extract_time, raw_format)
+            else:
+                key = save_chunks_to_s3(extract_client, bucket_name, batches, table_name, extract_time,
+                                        max_rows=max_rows, max_bytes=max_bytes, raw_format=raw_format)
+        return extract_time, key
+    new_dict_list, extract_time = get_data(db, table_name, last_extract)
+    if not (chunk_rows or chunk_mb):
+        key = save_to_s3(extract_client, bucket_name, new_dict_list, table_name, extract_time, raw_format)
+        return extract_time, key
+    key = save_chunks_to_s3(extract_client, bucket_name, [new_dict_list], table_name, extract_time,
+                            max_rows=max_rows, max_bytes=max_bytes, raw_format=raw_format)
+    return extract_time, key
+
+
+def build_work_stages(new_keys, timestamp):
+    """
+    Utility function, splits the extracted keys into one transform event per table, grouped by
+    PIPELINE_STAGES stage. The state machine runs the stages in order and transforms and loads the
+    tables of a stage in parallel, each in its own invocation
+
+    Args:
+        new_keys (list): keys of the raw objects written by this run
+        timestamp (str): timestamp of the run
+
+    Returns:
+        list: lists of dicts with 'message', 'timestamp', 'total_new_files' and 'new_keys', one list per non-empty stage
+    """
+
+    stages = {}
+    for key in new_keys:
+        stages.setdefault(PIPELINE_STAGES.get(key.split('/')[1], 1), []).append(
+            {'message':'completed ingestion', 'timestamp':timestamp, 'total_new_files':1, 'new_keys':[key]}
+        )
+    return [stages[stage] for stage in sorted(stages)]
+
+
+def extract_tables_concurrently(extract_client, bucket_name, table_names, last_timestamp_dict, workers):
+    """
+    Utility function, extracts tables on a bounded pool of threads and DB connections, so that the
+    query of one table overlaps with the S3 upload of another
+
+    Args:
+        extract_client (Object): a boto3 client object to query the S3 bucket
+        bucket_name (Object): an S3 bucket name where the JSON objects are stored
+        table_names (list): DB table names to be queried
+        last_timestamp_dict (dict): tablenames (k) and timestamp of last update check (v)
+        workers (int): maximum number of tables extracted at the same time
+
+    Raises:
+        Exception: the first error raised by any table, after every connection has been closed
+
+    Returns:
+        list: (extract_time, key) tuples in the same order as table_names
+    """
+
+    if not table_names:
+        return []
+    conn_pool = Queue()
+    conns = []
+    try:
+        for _ in range(min(workers, len(table_names))):
+            conns.append(create_conn(extract_client))
+            conn_pool.put(conns[-1])
+
+        def extract_on_pooled_conn(table_name):
+            db = conn_pool.get()
+            try:
+                return extract_table(db, extract_client, bucket_name, table_name,
+                                     last_timestamp_dict.get(table_name, None))
+            finally:
+                conn_pool.put(db)
+
+        with ThreadPoolExecutor(max_workers=len(conns)) as executor:
+            return list(executor.map(extract_on_pooled_conn, table_names))
+    finally:
+        for db in conns:
+            db.close()
+
+
 def get_last_timestamps(extract_client, bucket_name):
     """
     Utility function, queries S3 bucket and returns dictionary containing keys and timestamps of latest DB updates
@@ -85,9 +454,7 @@ def get_data(db, table_name, last_extract=None):
         extract_time (str) : UTC timestamp of query
     """
 
-    query = f"SELECT * FROM {table_name}"
-    if last_extract:
-        query+= f" WHERE last_updated > '{last_extract}'"  
+    query = build_query(table_name, last_extract)
     try:
         tab_data = db.run(query)
         extract_time = datetime.now(UTC).isoformat()
@@ -101,7 +468,81 @@ def get_data(db, table_name, last_extract=None):
         return [], last_extract
     
 
-def save_to_s3(extract_client, bucket_name, new_dict_list, table_name, extract_time):
+def build_query(table_name, last_extract=None):
+    """
+    Utility function, builds the SELECT statement used to extract a table, selecting the
+    EXTRACT_COLUMNS of the table if it has any
+
+    Args:
+        table_name (str): DB table name to be queried
+        last_extract (str, optional): Timestamp of last 'table_name' update check. Defaults to None.
+
+    Returns:
+        query (str): SQL query returning the rows updated since last_extract
+    """
+
+    columns = ", ".join(EXTRACT_COLUMNS[table_name]) if table_name in EXTRACT_COLUMNS else "*"
+    query = f"SELECT {columns} FROM {table_name}"
+    if last_extract:
+        query+= f" WHERE last_updated > '{last_extract}'"
+    return query
+
+
+@contextmanager
+def stream_data(db, table_name, last_extract=None, batch_size=None):
+    """
+    Utility function, opens a named server-side cursor over the table inside a transaction and gives a
+    generator of row batches so that only one batch is held in memory at a time. Used as a context manager:
+    the cursor is closed and the transaction committed when the with block ends, or rolled back if it raises,
+    whether or not every batch was read, so the connection is never handed back with the transaction open
+
+    Args:
+        db (pg8000 Object): pg8000.Native.Connection object
+        table_name (str): DB table name to be queried
+        last_extract (str, optional): Timestamp of last 'table_name' update check. Defaults to None.
+        batch_size (int, optional): Rows fetched per round trip. Defaults to STREAM_BATCH_SIZE or 5000.
+
+    Yields:
+        tuple: (batches, extract_time)
+            - batches (generator): yields lists of dictionaries containing table row data
+            - extract_time (str) : UTC timestamp of query
+    """
+
+    if batch_size is None:
+        batch_size = int(os.environ.get("STREAM_BATCH_SIZE", 5000))
+    cursor_name = f"extract_{table_name}"
+    query = build_query(table_name, last_extract)
+    try:
+        db.run("START TRANSACTION")
+        db.run(f"DECLARE {cursor_name} NO SCROLL CURSOR FOR {query}")
+    except DatabaseError:
+        db.run("ROLLBACK")
+        yield iter([]), last_extract
+        return
+    extract_time = datetime.now(UTC).isoformat()
+    extract_time = extract_time.replace('+00:00','')
+
+    def fetch_batches():
+        while True:
+            tab_data = db.run(f"FETCH FORWARD {batch_size} FROM {cursor_name}")
+            if not tab_data:
+                break
+            keys = [column["name"] for column in db.columns]
+            yield [dict(zip(keys, single_data)) for single_data in tab_data]
+
+    try:
+        yield fetch_batches(), extract_time
+    except BaseException:
+        try:
+            db.run("ROLLBACK")
+        except (DatabaseError, InterfaceError, OSError):
+            pass
+        raise
+    db.run(f"CLOSE {cursor_name}")
+    db.run("COMMIT")
+
+
+def save_to_s3(extract_client, bucket_name, new_dict_list, table_name, extract_time, raw_format="json"):
 
 
     """
@@ -113,20 +554,402 @@ def save_to_s3(extract_client, bucket_name, new_dict_list, table_name, extract_t
         new_dict_list (_type_): _description_
         table_name (str): DB table name to be queried
         extract_time (str) : UTC timestamp of query
+        raw_format (str, optional): one of RAW_FORMATS. Defaults to 'json'.
 
     Returns:
         key (str): S3 Object key derived from table_name and extract_time
     """
     
     date, time = extract_time.split('T')
-    key = f"dev/{table_name}/{date}/{table_name}_{time}.json"
+    key = f"dev/{table_name}/{date}/{table_name}_{time}.{raw_format}"
 
     if len(new_dict_list)==0:
         return
-    extract_client.put_object(Bucket=bucket_name, Body=json.dumps(new_dict_list, default=serialise_object, indent=2), 
+    extract_client.put_object(Bucket=bucket_name, Body=serialise_rows(new_dict_list, raw_format, table_name), 
             Key=key)
     return key
 
+def save_stream_to_s3(extract_client, bucket_name, batches, table_name, extract_time, raw_format="json"):
+    """
+    Utility function, writes batches of rows to a temporary file as one raw object and uploads it
+    to an S3 bucket, so that peak memory is bounded by the batch size rather than the table size.
+    Object key is derived from table_name and extract_time arguments
+
+    Args:
+        extract_client (Object): a boto3 client object to query the S3 bucket
+        bucket_name (Object): an S3 bucket name where the JSON object is stored
+        batches (iterable): iterable of lists of dictionaries containing table row data
+        table_name (str): DB table name to be queried
+        extract_time (str) : UTC timestamp of query
+        raw_format (str, optional): one of RAW_FORMATS. Defaults to 'json'.
+
+    Returns:
+        key (str): S3 Object key derived from table_name and extract_time, None if there were no rows
+    """
+
+    date, time = extract_time.split('T')
+    key = f"dev/{table_name}/{date}/{table_name}_{time}.{raw_format}"
+
+    row_count = 0
+    with tempfile.TemporaryFile() as raw_file:
+        if raw_format == "parquet":
+            import pyarrow.parquet as pq
+            parquet_writer = None
+            schema = arrow_schema(table_name)
+            for batch in batches:
+                if not batch:
+                    continue
+                table = rows_to_arrow(batch, schema if parquet_writer is None else parquet_writer.schema)
+                if parquet_writer is None:
+                    parquet_writer = pq.ParquetWriter(raw_file, table.schema)
+                parquet_writer.write_table(table)
+                row_count += len(batch)
+            if parquet_writer is not None:
+                parquet_writer.close()
+        else:
+            out_file = gzip.GzipFile(fileobj=raw_file, mode="wb") if raw_format == "ndjson.gz" else raw_file
+            encode = row_encoder(table_name, raw_format)
+            if raw_format == "json":
+                out_file.write(b"[")
+            for batch in batches:
+                for row in batch:
+                    if raw_format == "json":
+                        out_file.write((b",\n" if row_count else b"\n") + encode(row))
+                    else:
+                        out_file.write(encode(row) + b"\n")
+                    row_count += 1
+            if raw_format == "json":
+                out_file.write(b"\n]")
+            if out_file is not raw_file:
+                out_file.close()
+        if row_count == 0:
+            return
+        raw_file.seek(0)
+        extract_client.upload_fileobj(raw_file, bucket_name, key)
+    return key
+
+def save_chunks_to_s3(extract_client, bucket_name, batches, table_name, extract_time, max_rows=None, max_bytes=None,
+                      raw_format="json"):
+    """
+    Utility function, rolls rows into chunk objects of at most max_rows rows and max_bytes bytes of encoded
+    rows (a single larger row gets a chunk of its own), then stores a manifest object listing the chunk keys,
+    row counts and byte sizes. Object keys are derived from table_name and extract_time arguments.
+    Parquet chunks are sized on their Arrow data instead (see iter_arrow_chunks), so max_bytes bounds the
+    uncompressed columns rather than the Parquet object
+
+    Args:
+        extract_client (Object): a boto3 client object to query the S3 bucket
+        bucket_name (Object): an S3 bucket name where the JSON objects are stored
+        batches (iterable): iterable of lists of dictionaries containing table row data
+        table_name (str): DB table name to be queried
+        extract_time (str) : UTC timestamp of query
+        max_rows (int, optional): maximum rows per chunk. Defaults to None (no row limit).
+        max_bytes (int, optional): maximum bytes per chunk, measured before compression. Defaults to None (no size limit).
+        raw_format (str, optional): one of RAW_FORMATS. Defaults to 'json'.
+
+    Returns:
+        key (str): S3 key of the manifest object, None if there were no rows
+    """
+
+    date, time = extract_time.split('T')
+    chunk_prefix = f"dev/{table_name}/{date}/{table_name}_{time}"
+    manifest = {"table_name": table_name, "extract_time": extract_time, "raw_format": raw_format,
+                "total_rows": 0, "chunks": []}
+
+    def put_chunk(body, rows):
+        chunk_key = f"{chunk_prefix}/part_{len(manifest['chunks']):05d}.{raw_format}"
+        extract_client.put_object(Bucket=bucket_name, Body=body, Key=chunk_key)
+        manifest["chunks"].append({"key": chunk_key, "rows": rows, "bytes": len(body)})
+        manifest["total_rows"] += rows
+
+    if raw_format == "parquet":
+        import pyarrow.parquet as pq
+        for chunk_table in iter_arrow_chunks(batches, arrow_schema(table_name), max_rows, max_bytes):
+            buffer = BytesIO()
+            pq.write_table(chunk_table, buffer)
+            put_chunk(buffer.getvalue(), chunk_table.num_rows)
+    else:
+        chunk_encoded = []
+        chunk_bytes = 4
+        encode = row_encoder(table_name, raw_format)
+        for batch in batches:
+            for row in batch:
+                row_bytes = encode(row)
+                if chunk_encoded and max_bytes and chunk_bytes + len(row_bytes) > max_bytes:
+                    put_chunk(join_encoded_rows(chunk_encoded, raw_format), len(chunk_encoded))
+                    chunk_encoded = []
+                    chunk_bytes = 4
+                chunk_encoded.append(row_bytes)
+                chunk_bytes += len(row_bytes) + 2
+                if max_rows and len(chunk_encoded) >= max_rows:
+                    put_chunk(join_encoded_rows(chunk_encoded, raw_format), len(chunk_encoded))
+                    chunk_encoded = []
+                    chunk_bytes = 4
+        if chunk_encoded:
+            put_chunk(join_encoded_rows(chunk_encoded, raw_format), len(chunk_encoded))
+    if manifest["total_rows"] == 0:
+        return
+
+    key = f"{chunk_prefix}.manifest.json"
+    extract_client.put_object(Bucket=bucket_name, Body=json.dumps(manifest, indent=2), Key=key)
+    return key
+
+def iter_arrow_chunks(batches, schema=None, max_rows=None, max_bytes=None):
+    """
+    Utility function, converts batches of rows to Arrow and regroups them into tables of at most max_rows
+    rows and about max_bytes bytes of Arrow data, estimated from the average row size of each batch
+    (a single larger row gets a chunk of its own)
+
+    Args:
+        batches (iterable): iterable of lists of dictionaries containing table row data
+        schema (pyarrow.Schema, optional): schema of the rows, inferred from the first batch if None. Defaults to None.
+        max_rows (int, optional): maximum rows per chunk. Defaults to None (no row limit).
+        max_bytes (int, optional): maximum Arrow bytes per chunk. Defaults to None (no size limit).
+
+    Yields:
+        pyarrow.Table: chunk of rows
+    """
+
+    import pyarrow as pa
+    pending = []
+    pending_rows = 0
+    pending_bytes = 0
+    for batch in batches:
+        if not batch:
+            continue
+        table = rows_to_arrow(batch, schema)
+        schema = table.schema
+        row_bytes = table.nbytes / table.num_rows
+        while table.num_rows:
+            room = max_rows - pending_rows if max_rows else table.num_rows
+            if max_bytes:
+                room = min(room, int((max_bytes - pending_bytes) // row_bytes) if row_bytes else room)
+            if room <= 0:
+                if pending:
+                    yield pa.concat_tables(pending)
+                    pending, pending_rows, pending_bytes = [], 0, 0
+                    continue
+                room = 1
+            pending.append(table.slice(0, room))
+            pending_rows += pending[-1].num_rows
+            pending_bytes += pending[-1].num_rows * row_bytes
+            table = table.slice(room)
+            if (max_rows and pending_rows >= max_rows) or (max_bytes and pending_bytes >= max_bytes):
+                yield pa.concat_tables(pending)
+                pending, pending_rows, pending_bytes = [], 0, 0
+    if pending:
+        yield pa.concat_tables(pending)
+
+def encode_row(row, raw_format="json"):
+    """
+    Utility function, encodes one row for a JSON based raw format
+
+    Args:
+        row (dict): table row data
+        raw_format (str, optional): one of RAW_FORMATS. Defaults to 'json'.
+
+    Returns:
+        bytes: indented JSON for 'json', compact JSON otherwise
+    """
+
+    if raw_format == "json":
+        return json.dumps(row, default=serialise_object, indent=2).encode("utf-8")
+    return json.dumps(row, default=serialise_object, separators=(",", ":")).encode("utf-8")
+
+def row_encoder(table_name, raw_format="json"):
+    """
+    Utility function, returns the row encoder for a table. For tables in EXTRACT_COLUMNS every column
+    is encoded by the JSON_ENCODERS function of its type around pre-encoded keys, so no value goes through
+    the type checks of serialise_object. Other tables are encoded with encode_row
+
+    Args:
+        table_name (str): DB table the rows come from
+        raw_format (str, optional): 'json' or 'ndjson.gz'. Defaults to 'json'.
+
+    Returns:
+        function: takes a row (dict) and returns bytes in the same layout as encode_row
+    """
+
+    if table_name not in EXTRACT_COLUMNS:
+        return lambda row: encode_row(row, raw_format)
+    columns = EXTRACT_COLUMNS[table_name]
+    if raw_format == "json":
+        separator, opening, closing = ",\n  ", "{\n  ", "\n}"
+        keys = [json.dumps(column_name) + ": " for column_name in columns]
+    else:
+        separator, opening, closing = ",", "{", "}"
+        keys = [json.dumps(column_name) + ":" for column_name in columns]
+    fields = list(zip(columns, keys, [JSON_ENCODERS[column_type] for column_type in columns.values()]))
+
+    def encode(row):
+        values = [key + ("null" if (value := row[column_name]) is None else encoder(value))
+                  for column_name, key, encoder in fields]
+        return (opening + separator.join(values) + closing).encode("utf-8")
+
+    return encode
+
+def encode_float(value):
+    """
+    Utility function, JSON encoder of the 'float' EXTRACT_COLUMNS type. NaN and infinity are not valid
+    JSON, so they are written as null
+
+    Args:
+        value (float | Decimal): non-null value
+
+    Returns:
+        str: JSON number, or null
+    """
+
+    if type(value) not in (float, Decimal, int):
+        return encode_value(value)
+    value = float(value)
+    return repr(value) if math.isfinite(value) else "null"
+
+def encode_value(value):
+    """
+    Utility function, JSON encoder for values that are not of their column's declared type
+
+    Args:
+        value: non-null value
+
+    Raises:
+        TypeError: error raised if the value cannot be serialised (see serialise_object)
+
+    Returns:
+        str: JSON value
+    """
+
+    return json.dumps(value, default=serialise_object)
+
+def arrow_schema(table_name):
+    """
+    Utility function, builds the pyarrow schema of a table in EXTRACT_COLUMNS
+
+    Args:
+        table_name (str): DB table name
+
+    Returns:
+        pyarrow.Schema: declared column types, None if the table is not in EXTRACT_COLUMNS
+    """
+
+    if table_name not in EXTRACT_COLUMNS:
+        return None
+    import pyarrow as pa
+    arrow_types = {"int": pa.int64(), "float": pa.float64(), "str": pa.string(), "timestamp": pa.timestamp("us")}
+    return pa.schema([(column_name, arrow_types[column_type])
+                      for column_name, column_type in EXTRACT_COLUMNS[table_name].items()])
+
+def join_encoded_rows(encoded_rows, raw_format="json"):
+    """
+    Utility function, joins rows from encode_row into the body of a raw object
+
+    Args:
+        encoded_rows (list): list of encoded rows
+        raw_format (str, optional): 'json' or 'ndjson.gz'. Defaults to 'json'.
+
+    Returns:
+        bytes: a JSON array, or gzip compressed newline-delimited JSON
+    """
+
+    if raw_format == "ndjson.gz":
+        return gzip.compress(b"\n".join(encoded_rows) + b"\n")
+    return b"[\n" + b",\n".join(encoded_rows) + b"\n]"
+
+def serialise_rows(rows, raw_format="json", table_name=None):
+    """
+    Utility function, serialises rows into the body of a raw object, with the EXTRACT_COLUMNS
+    types of table_name if it has any
+
+    Args:
+        rows (list): List of dictionaries containing table row data
+        raw_format (str, optional): one of RAW_FORMATS. Defaults to 'json'.
+        table_name (str, optional): DB table the rows come from. Defaults to None.
+
+    Raises:
+        ValueError: error raised if raw_format is not one of RAW_FORMATS
+
+    Returns:
+        bytes: object body
+    """
+
+    if raw_format not in RAW_FORMATS:
+        raise ValueError(f"Unknown raw format {raw_format}")
+    if raw_format == "parquet":
+        import pyarrow.parquet as pq
+        buffer = BytesIO()
+        pq.write_table(rows_to_arrow(rows, arrow_schema(table_name)), buffer)
+        return buffer.getvalue()
+    if raw_format == "json" and table_name not in EXTRACT_COLUMNS:
+        return json.dumps(rows, default=serialise_object, indent=2).encode("utf-8")
+    encode = row_encoder(table_name, raw_format)
+    return join_encoded_rows([encode(row) for row in rows], raw_format)
+
+def rows_to_arrow(rows, schema=None):
+    """
+    Utility function, converts rows into a typed pyarrow Table. Decimals become floats as in the JSON
+    formats and columns that are entirely null are typed as strings, unless a schema is given
+
+    Args:
+        rows (list): List of dictionaries containing table row data
+        schema (pyarrow.Schema, optional): schema of earlier batches of the same table. Defaults to None.
+
+    Returns:
+        pyarrow.Table: table with one column per key of the first row
+    """
+
+    import pyarrow as pa
+    columns = {}
+    for column_name in rows[0]:
+        values = [row[column_name] for row in rows]
+        if any(isinstance(value, Decimal) for value in values):
+            values = [None if value is None else float(value) for value in values]
+        columns[column_name] = values
+    if schema is not None:
+        return pa.table(columns, schema=schema)
+    table = pa.table(columns)
+    schema = pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+                        for field in table.schema])
+    return table.cast(schema)
+
+def get_conn(extract_client):
+    """
+    Utility function, returns the module's database connection, opening it on first use and keeping it
+    open between warm invocations. Before being handed out the connection is checked with a ROLLBACK,
+    which also ends any transaction a failed invocation left open, and is replaced by a new one if the
+    check fails
+
+    Args:
+        extract_client (Object): a boto3 client object to query the S3 bucket
+
+    Returns:
+        Connection (Object): open pg8000.native connection
+    """
+
+    global db_connection
+    if db_connection is not None:
+        try:
+            db_connection.run("ROLLBACK")
+            return db_connection
+        except (DatabaseError, InterfaceError, OSError):
+            close_conn()
+    db_connection = create_conn(extract_client)
+    return db_connection
+
+def close_conn():
+    """
+    Utility function, closes the module's database connection if one is open. Lambda stops an execution
+    environment without running Python exit handlers, so a connection still open at that point is not
+    closed here; the server drops it once the client is gone or idle_session_timeout is reached
+    """
+
+    global db_connection
+    if db_connection is not None:
+        try:
+            db_connection.close()
+        except (InterfaceError, OSError):
+            pass
+        db_connection = None
+
 def create_conn(extract_client):
     """
     Utility function, creates a database connection based on the environmental variables.
@@ -150,21 +973,72 @@ def create_conn(extract_client):
 
 def get_db_password(extract_client):
     """
-    Utility function, collects password credentials from S3 backend bucket
+    Utility function, returns the 'totesys' database password from the credential provider (see get_credential)
+
+    Args:
+        extract_client (Object): a boto3 client object to query the S3 bucket
+
+    Returns:
+        str: database password
+    """
+
+    return get_credential(extract_client, "totesys")
+
+def get_credential(extract_client, name):
+    """
+    Utility function, returns a named credential, reading it from the CREDENTIAL_BACKEND at most once
+    every CREDENTIAL_TTL seconds (default 300) so warm invocations skip the lookup and rotated
+    credentials are picked up once the cached value expires
 
     Args:
         extract_client (Object): a boto3 client object to query the S3 bucket
+        name (str): credential name, e.g. 'totesys' or 'warehouse'
 
     Returns:
-        pw_dict['totesys'] (str): value from dict object
+        str: credential value
+    """
+
+    backend = os.environ.get("CREDENTIAL_BACKEND", "s3")
+    cached = credential_cache.get((backend, name))
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    value = read_credential(extract_client, backend, name)
+    credential_cache[(backend, name)] = (time.monotonic() + float(os.environ.get("CREDENTIAL_TTL", 300)), value)
+    return value
+
+def read_credential(extract_client, backend, name):
     """
+    Utility function, reads a named credential from a backend:
+        - 's3': secrets/secrets.json in the BACKEND_S3 bucket
+        - 'file': the JSON file at CREDENTIALS_FILE, same layout as secrets.json
+        - 'env': the <NAME>_PASSWORD environment variable, e.g. TOTESYS_PASSWORD
+
+    Args:
+        extract_client (Object): a boto3 client object to query the S3 bucket
+        backend (str): one of CREDENTIAL_BACKENDS
+        name (str): credential name
 
-    key = 'secrets/secrets.json'
-    bucket = os.environ["BACKEND_S3"] # 'bucket-to-hold-tf-state-for-terraform'
-    pw_file = extract_client.get_object(Bucket=bucket, Key=key)
-    pw_dict = json.loads(pw_file["Body"].read().decode("utf-8"))
-    return pw_dict['totesys']
+    Raises:
+        ValueError: if the backend is not one of CREDENTIAL_BACKENDS
+
+    Returns:
+        str: credential value
+    """
 
+    match backend:
+        case "s3":
+            key = 'secrets/secrets.json'
+            bucket = os.environ["BACKEND_S3"]
+            pw_file = extract_client.get_object(Bucket=bucket, Key=key)
+            pw_dict = json.loads(pw_file["Body"].read().decode("utf-8"))
+        case "file":
+            with open(os.environ["CREDENTIALS_FILE"]) as f:
+                pw_dict = json.load(f)
+        case "env":
+            return os.environ[f"{name.upper()}_PASSWORD"]
+        case _:
+            raise ValueError(f"Unknown credential backend: {backend}, expected one of {CREDENTIAL_BACKENDS}")
+    return pw_dict[name]
 
 def serialise_object(obj):
     """
@@ -1,17 +1,45 @@
-import pandas as pd
-import awswrangler as wr
 from pg8000.native import Connection
-from pg8000.exceptions import DatabaseError
+from pg8000.exceptions import DatabaseError, InterfaceError
 from datetime import datetime,UTC
 import boto3
 import os
+import time
 import json
-from pprint import pprint # for local viewing
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 # import dotenv #local implementation
+# pandas and awswrangler are imported inside the functions that use them to keep cold starts short
+
+DIMENSION_KEYS = {
+    "dim_counterparty": "counterparty_id",
+    "dim_currency": "currency_id",
+    "dim_date": "date_id",
+    "dim_design": "design_id",
+    "dim_location": "location_id",
+    "dim_staff": "staff_id",
+}
+
+# database connection kept open between warm invocations, see get_conn
+db_connection = None
+
+CREDENTIAL_BACKENDS = ["s3", "file", "env"]
+
+# (backend, name) -> (expiry on time.monotonic(), value), kept between warm invocations
+credential_cache = {}
+
+TABLE_DEPENDENCIES = {
+    "fact_sales_order": ["dim_counterparty", "dim_currency", "dim_date", "dim_design", "dim_location", "dim_staff"],
+}
 
 def lambda_load(events, context):
     """
-    AWS Lambda entry point for uploading stored parquet files to Data Warehouse
+    AWS Lambda entry point for uploading stored parquet files to Data Warehouse.
+    Files are grouped by table and loaded dimensions first, facts last (see load_in_dependency_order);
+    LOAD_WORKERS > 1 loads the tables of each level concurrently on separate connections.
+    The main connection is reused between warm invocations (see get_conn).
+    The LOAD_MODE environment variable selects how each table is written (see load_df_into_warehouse).
+    LOAD_MODE 'atomic' instead stages every table of the event in parallel and publishes them all in
+    one transaction (see stage_and_publish), raising on any database error
 
     Args:
         events (dict): 
@@ -36,20 +64,74 @@ def lambda_load(events, context):
                 "total_tables_updated":0,
                 "items_inserted_into_db": [] }
 
+    import pandas as pd
+
     processed_bucket = os.environ["PROCESSED_S3"]
     s3_client = boto3.client('s3')
     items_inserted_into_db = []
-    db = create_conn(s3_client)
+    db = get_conn(s3_client)
+    load_mode = os.environ.get("LOAD_MODE", "insert")
+    workers = int(os.environ.get("LOAD_WORKERS", 1))
+    df_dict = {}
     for file_key in events["new_keys"]:
-        df = parquet_to_df(file_key, processed_bucket)
         table_name = file_key.split('/')[1]
-        updated_table_dict = insert_df_into_warehouse(db, df, table_name)
-        items_inserted_into_db.append(updated_table_dict)
+        df = parquet_to_df(file_key, processed_bucket)
+        df_dict[table_name] = pd.concat([df_dict[table_name], df], ignore_index=True) if table_name in df_dict else df
+    df_dict = {table_name: df_dict[table_name] for level in schedule_load_levels(df_dict) for table_name in level}
+    if load_mode == "atomic":
+        items_inserted_into_db = stage_and_publish(
+            db, df_dict, lambda: create_conn(s3_client),
+            workers=workers,
+            merge_dimensions=os.environ.get("LOAD_PUBLISH", "append") == "merge",
+        )
+    else:
+        items_inserted_into_db = load_in_dependency_order(
+            db, df_dict, lambda: create_conn(s3_client), load_mode, workers
+        )
     return {"message": "completed loading",
         "timestamp": datetime.now(UTC).isoformat()[:-6],
         "total_tables_updated":len(items_inserted_into_db),
         "items_inserted_into_db": items_inserted_into_db }
     
+def get_conn(s3_client):
+    """
+    Utility function, returns the module's database connection, opening it on first use and keeping it
+    open between warm invocations. Before being handed out the connection is checked with a ROLLBACK,
+    which also ends any transaction a failed invocation left open, and is replaced by a new one if the
+    check fails
+
+    Args:
+        s3_client (Object): a boto3 client object to query the S3 bucket
+
+    Returns:
+        Connection (Object): open pg8000.native connection
+    """
+
+    global db_connection
+    if db_connection is not None:
+        try:
+            db_connection.run("ROLLBACK")
+            return db_connection
+        except (DatabaseError, InterfaceError, OSError):
+            close_conn()
+    db_connection = create_conn(s3_client)
+    return db_connection
+
+def close_conn():
+    """
+    Utility function, closes the module's database connection if one is open. Lambda stops an execution
+    environment without running Python exit handlers, so a connection still open at that point is not
+    closed here; the server drops it once the client is gone or idle_session_timeout is reached
+    """
+
+    global db_connection
+    if db_connection is not None:
+        try:
+            db_connection.close()
+        except (InterfaceError, OSError):
+            pass
+        db_connection = None
+
 def create_conn(s3_client):
     """
     Utility function, creates a database connection based on the environmental variables.
@@ -73,20 +155,72 @@ def create_conn(s3_client):
 
 def get_db_password(s3_client):
     """
-    Utility function, collects password credentials from S3 backend bucket
+    Utility function, returns the 'warehouse' database password from the credential provider (see get_credential)
 
     Args:
-        extract_client (Object): a boto3 client object to query the S3 bucket
+        s3_client (Object): a boto3 client object to query the S3 bucket
 
     Returns:
-        pw_dict['totesys'] (str): value from dict object
+        str: database password
     """
 
-    key = 'secrets/secrets.json'
-    bucket = os.environ['BACKEND_S3']
-    pw_file = s3_client.get_object(Bucket=bucket, Key=key)
-    pw_dict = json.loads(pw_file["Body"].read().decode("utf-8"))
-    return pw_dict['warehouse']
+    return get_credential(s3_client, "warehouse")
+
+def get_credential(s3_client, name):
+    """
+    Utility function, returns a named credential, reading it from the CREDENTIAL_BACKEND at most once
+    every CREDENTIAL_TTL seconds (default 300) so warm invocations skip the lookup and rotated
+    credentials are picked up once the cached value expires
+
+    Args:
+        s3_client (Object): a boto3 client object to query the S3 bucket
+        name (str): credential name, e.g. 'totesys' or 'warehouse'
+
+    Returns:
+        str: credential value
+    """
+
+    backend = os.environ.get("CREDENTIAL_BACKEND", "s3")
+    cached = credential_cache.get((backend, name))
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    value = read_credential(s3_client, backend, name)
+    credential_cache[(backend, name)] = (time.monotonic() + float(os.environ.get("CREDENTIAL_TTL", 300)), value)
+    return value
+
+def read_credential(s3_client, backend, name):
+    """
+    Utility function, reads a named credential from a backend:
+        - 's3': secrets/secrets.json in the BACKEND_S3 bucket
+        - 'file': the JSON file at CREDENTIALS_FILE, same layout as secrets.json
+        - 'env': the <NAME>_PASSWORD environment variable, e.g. TOTESYS_PASSWORD
+
+    Args:
+        s3_client (Object): a boto3 client object to query the S3 bucket
+        backend (str): one of CREDENTIAL_BACKENDS
+        name (str): credential name
+
+    Raises:
+        ValueError: if the backend is not one of CREDENTIAL_BACKENDS
+
+    Returns:
+        str: credential value
+    """
+
+    match backend:
+        case "s3":
+            key = 'secrets/secrets.json'
+            bucket = os.environ["BACKEND_S3"]
+            pw_file = s3_client.get_object(Bucket=bucket, Key=key)
+            pw_dict = json.loads(pw_file["Body"].read().decode("utf-8"))
+        case "file":
+            with open(os.environ["CREDENTIALS_FILE"]) as f:
+                pw_dict = json.load(f)
+        case "env":
+            return os.environ[f"{name.upper()}_PASSWORD"]
+        case _:
+            raise ValueError(f"Unknown credential backend: {backend}, expected one of {CREDENTIAL_BACKENDS}")
+    return pw_dict[name]
 
 def parquet_to_df(file_key, processed_bucket):
     """
@@ -100,10 +234,120 @@ def parquet_to_df(file_key, processed_bucket):
     Returns:
         DataFrame Object: Pandas DataFrame object containing converted data
     """
+    import awswrangler as wr
+
     df = wr.s3.read_parquet(path=f's3://{processed_bucket}/{file_key}')
     # print(df.head(10))
     return df
 
+def schedule_load_levels(table_names):
+    """
+    Utility function that orders tables for loading using TABLE_DEPENDENCIES. Tables in the same level
+    do not depend on each other and can be loaded at the same time; every table comes after the tables
+    it references. Dependencies that are not being loaded are assumed to be in the warehouse already
+
+    Args:
+        table_names (iterable): names of the tables to load
+
+    Raises:
+        ValueError: if the dependencies contain a cycle
+
+    Returns:
+        list: lists of table names, one per level, in load order
+    """
+    remaining = {
+        table_name: {dep for dep in TABLE_DEPENDENCIES.get(table_name, []) if dep in table_names}
+        for table_name in table_names
+    }
+    levels = []
+    while remaining:
+        level = [table_name for table_name, deps in remaining.items() if not deps]
+        if not level:
+            raise ValueError(f"Circular table dependencies: {sorted(remaining)}")
+        for table_name in level:
+            del remaining[table_name]
+        for deps in remaining.values():
+            deps.difference_update(level)
+        levels.append(level)
+    return levels
+
+def load_in_dependency_order(db, df_dict, connect, load_mode="insert", workers=1):
+    """
+    Utility function that loads several tables level by level (see schedule_load_levels), so facts are
+    only written once the dimensions they reference have committed. With more than one worker the tables
+    of a level are loaded concurrently, each on its own connection from connect; otherwise db is used.
+    A table whose dependency failed to load is skipped
+
+    Args:
+        db (pg8000 Object): pg8000.Native.Connection object used when loading serially
+        df_dict (dict): table names (k) and DataFrames to load (v)
+        connect (callable): returns a new pg8000.Native.Connection for concurrent loads
+        load_mode (str, optional): see load_df_into_warehouse. Defaults to "insert".
+        workers (int, optional): maximum tables loaded at the same time. Defaults to 1.
+
+    Returns:
+        list: dicts of table_name (k) and count of rows inserted or the error raised (v), in load order
+    """
+    def load_table(table_name):
+        if workers <= 1:
+            return load_df_into_warehouse(db, df_dict[table_name], table_name, load_mode)
+        table_db = connect()
+        try:
+            return load_df_into_warehouse(table_db, df_dict[table_name], table_name, load_mode)
+        finally:
+            table_db.close()
+
+    items_inserted_into_db = []
+    failed = set()
+    for level in schedule_load_levels(df_dict):
+        ready = []
+        for table_name in level:
+            failed_deps = failed.intersection(TABLE_DEPENDENCIES.get(table_name, []))
+            if failed_deps:
+                print(f"Skipping {table_name}, dependencies failed: {sorted(failed_deps)}")
+                failed.add(table_name)
+                items_inserted_into_db.append({table_name: f"skipped, dependencies failed: {sorted(failed_deps)}"})
+            else:
+                ready.append(table_name)
+        if not ready:
+            continue
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(ready)))) as executor:
+            results = list(executor.map(load_table, ready))
+        for table_name, result in zip(ready, results):
+            if isinstance(result[table_name], Exception):
+                failed.add(table_name)
+            items_inserted_into_db.append(result)
+    return items_inserted_into_db
+
+def load_df_into_warehouse(db, df, table_name, load_mode="insert"):
+    """
+    Utility function that loads DataFrame rows into a relational database with the chosen load mode
+
+    Args:
+        db (pg8000 Object): pg8000.Native.Connection object
+        df (DataFrame Object): Pandas DataFrame object containing data to be inserted
+        table_name (str): DB table name to be loaded
+        load_mode (str, optional): 'insert' (single INSERT statement), 'copy' (COPY FROM STDIN)
+                                   'executemany' (batched prepared INSERT) or 'merge' (upsert dimensions
+                                   on their key, append facts). Defaults to 'insert'.
+
+    Raises:
+        ValueError: error raised if load_mode is not recognised
+
+    Returns:
+        dict: table_name (k) and count of rows loaded (v), or the DatabaseError raised (v)
+    """
+    match load_mode:
+        case "insert":
+            return insert_df_into_warehouse(db, df, table_name)
+        case "copy":
+            return copy_df_into_warehouse(db, df, table_name)
+        case "executemany":
+            return executemany_df_into_warehouse(db, df, table_name)
+        case "merge":
+            return merge_df_into_warehouse(db, df, table_name)
+    raise ValueError(f"Unknown load mode {load_mode}")
+
 def insert_df_into_warehouse(db, df, table_name):
     """
     Utility function to insert DataFrame rows into a relational database
@@ -144,6 +388,271 @@ def insert_df_into_warehouse(db, df, table_name):
     
 
 
+def copy_df_into_warehouse(db, df, table_name, chunk_rows=10000):
+    """
+    Utility function to bulk load DataFrame rows into a relational database with COPY FROM STDIN.
+    Rows are sent as CSV in chunks of chunk_rows, so the whole table is never held as one string
+
+    Args:
+        db (pg8000 Object): pg8000.Native.Connection object
+        df (DataFrame Object): Pandas DataFrame object containing data to be inserted
+        table_name (str): DB table name to be loaded
+        chunk_rows (int, optional): rows per CSV chunk. Defaults to 10000.
+
+    Returns:
+        dict: table_name (k) and count of rows copied (v), or the DatabaseError raised (v)
+    """
+    column_string = ', '.join(df.columns)
+    query = f"COPY {table_name} ({column_string}) FROM STDIN WITH (FORMAT csv)"
+    try:
+        db.run(query, stream=df_to_csv_chunks(df, chunk_rows))
+    except DatabaseError as e:
+        print(e)
+        print("problem in",table_name)
+        return {table_name:e}
+
+    return {table_name:db.row_count}
+
+
+def df_to_csv_chunks(df, chunk_rows=10000):
+    """
+    Utility function that lazily converts a DataFrame to CSV text for COPY FROM STDIN, chunk_rows rows at a time
+
+    Args:
+        df (DataFrame Object): Pandas DataFrame object
+        chunk_rows (int, optional): rows per CSV chunk. Defaults to 10000.
+
+    Returns:
+        generator: CSV strings without a header row
+    """
+    return (
+        df.iloc[start:start + chunk_rows].to_csv(index=False, header=False)
+        for start in range(0, len(df), chunk_rows)
+    )
+
+
+def merge_df_into_warehouse(db, df, table_name):
+    """
+    Utility function to upsert dimension rows. The batch is copied into a temporary staging table and
+    applied with one INSERT ... ON CONFLICT DO UPDATE on the dimension key from DIMENSION_KEYS, so updated
+    source rows replace their previous version instead of duplicating it. Tables without a dimension key
+    (facts) are appended with COPY
+
+    Args:
+        db (pg8000 Object): pg8000.Native.Connection object
+        df (DataFrame Object): Pandas DataFrame object containing data to be merged
+        table_name (str): DB table name to be loaded, which must have a unique constraint on its key
+
+    Returns:
+        dict: table_name (k) and count of rows inserted or updated (v), or the DatabaseError raised (v)
+    """
+    if table_name not in DIMENSION_KEYS:
+        return copy_df_into_warehouse(db, df, table_name)
+
+    key = DIMENSION_KEYS[table_name]
+    df = df.drop_duplicates(subset=key, keep="last")
+    stage_name = f"stage_{table_name}"
+    column_string = ', '.join(df.columns)
+    try:
+        db.run("START TRANSACTION")
+        db.run(f"CREATE TEMP TABLE {stage_name} ON COMMIT DROP AS SELECT {column_string} FROM {table_name} WITH NO DATA")
+        db.run(f"COPY {stage_name} ({column_string}) FROM STDIN WITH (FORMAT csv)", stream=df_to_csv_chunks(df))
+        db.run(publish_statement(table_name, stage_name, list(df.columns), merge=True))
+        row_count = db.row_count
+        db.run("COMMIT")
+    except DatabaseError as e:
+        db.run("ROLLBACK")
+        print(e)
+        print("problem in",table_name)
+        return {table_name:e}
+
+    return {table_name:row_count}
+
+
+def publish_statement(table_name, stage_name, columns, merge=False):
+    """
+    Utility function that builds the statement copying staged rows into their target table
+
+    Args:
+        table_name (str): target DB table name
+        stage_name (str): staging table name
+        columns (list): column names to copy
+        merge (bool, optional): upsert on the DIMENSION_KEYS key of dimension tables. Defaults to False.
+
+    Returns:
+        str: INSERT ... SELECT statement
+    """
+    column_string = ', '.join(columns)
+    query = f"INSERT INTO {table_name} ({column_string}) SELECT {column_string} FROM {stage_name}"
+    if not merge or table_name not in DIMENSION_KEYS:
+        return query
+    key = DIMENSION_KEYS[table_name]
+    update_string = ', '.join(f"{column} = EXCLUDED.{column}" for column in columns if column != key)
+    conflict_action = f"DO UPDATE SET {update_string}" if update_string else "DO NOTHING"
+    return f"{query} ON CONFLICT ({key}) {conflict_action}"
+
+
+def stage_and_publish(db, df_dict, connect, workers=4, merge_dimensions=False):
+    """
+    Utility function that loads several tables atomically. Each DataFrame is first copied into its own
+    UNLOGGED staging table without indexes or constraints, on up to 'workers' connections in parallel. All staged tables
+    are then published to their targets and the staging tables dropped in one short transaction on db,
+    so the warehouse sees either every table of the event or none of them, and a failed run can be retried
+
+    Args:
+        db (pg8000 Object): pg8000.Native.Connection object used to publish
+        df_dict (dict): table names (k) and DataFrames to load (v)
+        connect (callable): returns a new pg8000.Native.Connection for staging
+        workers (int, optional): maximum tables staged at the same time. Defaults to 4.
+        merge_dimensions (bool, optional): upsert dimension tables on their key instead of appending. Defaults to False.
+
+    Raises:
+        Exception: error raised by staging or publishing, after the staging tables are dropped (see drop_staging_tables)
+
+    Returns:
+        list: dicts of table_name (k) and count of rows published (v), in df_dict order
+    """
+    run_id = uuid.uuid4().hex[:8]
+    stage_names = {table_name: f"stage_{table_name}_{run_id}" for table_name in df_dict}
+
+    def stage_table(table_name):
+        df = df_dict[table_name]
+        if merge_dimensions and table_name in DIMENSION_KEYS:
+            df = df.drop_duplicates(subset=DIMENSION_KEYS[table_name], keep="last")
+        stage_db = connect()
+        try:
+            stage_db.run(
+                f"CREATE UNLOGGED TABLE {stage_names[table_name]} AS "
+                f"SELECT {', '.join(df.columns)} FROM {table_name} WITH NO DATA"
+            )
+            stage_db.run(
+                f"COPY {stage_names[table_name]} ({', '.join(df.columns)}) FROM STDIN WITH (FORMAT csv)",
+                stream=df_to_csv_chunks(df),
+            )
+        finally:
+            stage_db.close()
+        return list(df.columns)
+
+    published = False
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(df_dict)))) as executor:
+            staged_columns = dict(zip(df_dict, executor.map(stage_table, df_dict)))
+
+        items_inserted_into_db = []
+        db.run("START TRANSACTION")
+        try:
+            for table_name, columns in staged_columns.items():
+                db.run(publish_statement(table_name, stage_names[table_name], columns, merge_dimensions))
+                items_inserted_into_db.append({table_name: db.row_count})
+            db.run(f"DROP TABLE {', '.join(stage_names.values())}")
+            db.run("COMMIT")
+            published = True
+        except DatabaseError:
+            db.run("ROLLBACK")
+            raise
+    except Exception as e:
+        print(e)
+        raise
+    finally:
+        if not published:
+            drop_staging_tables(db, connect, list(stage_names.values()))
+    return items_inserted_into_db
+
+
+def drop_staging_tables(db, connect, stage_names):
+    """
+    Utility function, drops the staging tables of a failed stage_and_publish. The tables are dropped on db
+    unless it is no longer usable, e.g. after a network error, in which case a new connection is opened.
+    A failure to drop is printed rather than raised, so that it does not hide the error that stopped the load
+
+    Args:
+        db (pg8000 Object): pg8000.Native.Connection object used to publish
+        connect (callable): returns a new pg8000.Native.Connection
+        stage_names (list): staging table names, some of which may not exist
+    """
+
+    drop_statement = f"DROP TABLE IF EXISTS {', '.join(stage_names)}"
+    try:
+        db.run("ROLLBACK")
+        db.run(drop_statement)
+        return
+    except (DatabaseError, InterfaceError, OSError) as e:
+        print(e)
+    try:
+        cleanup_db = connect()
+        try:
+            cleanup_db.run(drop_statement)
+        finally:
+            cleanup_db.close()
+    except Exception as e:
+        print(e)
+
+
+def df_to_rows(df):
+    """
+    Utility function that converts DataFrame rows to lists of Python values, with None for missing values
+
+    Args:
+        df (DataFrame Object): Pandas DataFrame object
+
+    Returns:
+        list: list of row value lists
+    """
+    return df.astype(object).where(df.notna(), None).values.tolist()
+
+
+def executemany_df_into_warehouse(db, df, table_name, batch_rows=None):
+    """
+    Utility function to insert DataFrame rows with a parameterised multi-row INSERT. One statement per
+    batch size is prepared and reused for every batch, values are sent as parameters rather than
+    being formatted into SQL, and the table is loaded in a single transaction
+
+    Args:
+        db (pg8000 Object): pg8000.Native.Connection object
+        df (DataFrame Object): Pandas DataFrame object containing data to be inserted
+        table_name (str): DB table name to be loaded
+        batch_rows (int, optional): rows per INSERT. Defaults to INSERT_BATCH_ROWS or 1000,
+                                    capped at the 65535 parameters PostgreSQL allows per statement.
+
+    Returns:
+        dict: table_name (k) and count of rows inserted (v), or the DatabaseError raised (v)
+    """
+    if batch_rows is None:
+        batch_rows = int(os.environ.get("INSERT_BATCH_ROWS", 1000))
+    column_count = max(len(df.columns), 1)
+    batch_rows = max(1, min(batch_rows, 65535 // column_count))
+    column_string = ', '.join(df.columns)
+    rows = df_to_rows(df)
+
+    def insert_statement(row_count):
+        values = ', '.join(
+            '(' + ', '.join(f":v{row * column_count + col}" for col in range(column_count)) + ')'
+            for row in range(row_count)
+        )
+        return db.prepare(f"INSERT INTO {table_name} ({column_string}) VALUES {values}")
+
+    statements = {}
+    try:
+        db.run("START TRANSACTION")
+        for start in range(0, len(rows), batch_rows):
+            batch = rows[start:start + batch_rows]
+            if len(batch) not in statements:
+                statements[len(batch)] = insert_statement(len(batch))
+            params = [item for row in batch for item in row]
+            statements[len(batch)].run(**{f"v{i}": item for i, item in enumerate(params)})
+        db.run("COMMIT")
+    except DatabaseError as e:
+        db.run("ROLLBACK")
+        print(e)
+        print("problem in",table_name)
+        return {table_name:e}
+    finally:
+        for statement in statements.values():
+            statement.close()
+
+    return {table_name:len(rows)}
+
+
 # if __name__ == "__main__":
 #    events = {
 #         "message": "completed transformation",
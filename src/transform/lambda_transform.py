@@ -1,16 +1,89 @@
 import boto3
-import pandas as pd
 from datetime import datetime, UTC
 import os
 from decimal import Decimal
-import awswrangler as wr
 import json
+import gzip
+import codecs
+import re
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+import threading
 
 # import dotenv  # for local runs
+# pandas, numpy and pyarrow are imported inside the functions that use them to keep cold starts short
+
+SNAPSHOT_TABLES = {"department": "department_id", "address": "address_id"}
+
+# suffix of compacted db_state segments, see compact_state_segments
+COMPACTED_SUFFIX = ".compacted.parquet"
+
+# ISO 4217 currency names, extend here to name further codes
+CURRENCY_NAMES = {
+    "AED": "UAE dirham",
+    "ARS": "Argentine peso",
+    "AUD": "Australian dollar",
+    "BRL": "Brazilian real",
+    "CAD": "Canadian dollar",
+    "CHF": "Swiss franc",
+    "CLP": "Chilean peso",
+    "CNY": "Chinese yuan",
+    "COP": "Colombian peso",
+    "CZK": "Czech koruna",
+    "DKK": "Danish krone",
+    "EGP": "Egyptian pound",
+    "EUR": "Euro",
+    "GBP": "British pound",
+    "HKD": "Hong Kong dollar",
+    "HUF": "Hungarian forint",
+    "IDR": "Indonesian rupiah",
+    "ILS": "Israeli new shekel",
+    "INR": "Indian rupee",
+    "ISK": "Icelandic krona",
+    "JPY": "Japanese yen",
+    "KES": "Kenyan shilling",
+    "KRW": "South Korean won",
+    "MXN": "Mexican peso",
+    "MYR": "Malaysian ringgit",
+    "NGN": "Nigerian naira",
+    "NOK": "Norwegian krone",
+    "NZD": "New Zealand dollar",
+    "PHP": "Philippine peso",
+    "PKR": "Pakistani rupee",
+    "PLN": "Polish zloty",
+    "RON": "Romanian leu",
+    "SAR": "Saudi riyal",
+    "SEK": "Swedish krona",
+    "SGD": "Singapore dollar",
+    "THB": "Thai baht",
+    "TRY": "Turkish lira",
+    "TWD": "New Taiwan dollar",
+    "UAH": "Ukrainian hryvnia",
+    "USD": "US dollar",
+    "VND": "Vietnamese dong",
+    "ZAR": "South African rand",
+}
+UNKNOWN_CURRENCY_NAME = "Unknown currency"
+
+# tables whose transform joins against the snapshot of another table
+TRANSFORM_DEPENDENCIES = {"staff": ["department"], "counterparty": ["address"]}
+
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# characters that can still extend a number already decoded from the buffer
+JSON_NUMBER_TAIL = re.compile(r"[0-9eE.+-]*")
+
+# (bucket, key) -> (ETag, DataFrame), kept between warm invocations
+reference_cache = OrderedDict()
+reference_cache_lock = threading.Lock()
 
 def lambda_transform(events, context):
     """
-    AWS Lambda entry point for transforming newly ingested JSON data files into processed Parquet files
+    AWS Lambda entry point for transforming newly ingested JSON data files into processed Parquet files.
+    TRANSFORM_ENGINE 'arrow' processes each table as pyarrow Tables (see mvp_transform_arrow)
+    instead of pandas DataFrames (default 'pandas').
+    TRANSFORM_WORKERS > 1 transforms independent tables concurrently (see transform_keys)
     Args:
         events (dict):
             - 'timestamp': Event trigger time
@@ -38,18 +111,16 @@ def lambda_transform(events, context):
     s3_client = boto3.client("s3")
     ingestion_bucket = os.environ["INGESTION_S3"]
     processed_bucket = os.environ["PROCESSED_S3"]
-    list_of_transformed_keys = []
-    for new_key in events["new_keys"]:
-        table_name, new_df = append_json_raw_tables(
-            s3_client, ingestion_bucket, new_key, processed_bucket
-        )
-        transformed_dict = mvp_transform_df(
-            s3_client, table_name, new_df, processed_bucket
-        )
-        parquet_key_list = save_parquet_to_s3(processed_bucket, transformed_dict, events["timestamp"])
-        if len(parquet_key_list):
-            list_of_transformed_keys += parquet_key_list
-        
+    list_of_transformed_keys = transform_keys(
+        s3_client,
+        ingestion_bucket,
+        processed_bucket,
+        events["new_keys"],
+        events["timestamp"],
+        workers=int(os.environ.get("TRANSFORM_WORKERS", 1)),
+        engine=os.environ.get("TRANSFORM_ENGINE", "pandas"),
+    )
+
     timestamp = datetime.now(UTC).isoformat()
     timestamp = timestamp.replace("+00:00", "")
     return {
@@ -59,33 +130,171 @@ def lambda_transform(events, context):
         "new_keys": list_of_transformed_keys,
     }
 
+def transform_keys(s3_client, ingestion_bucket, processed_bucket, new_keys, extract_time, workers=1, engine="pandas"):
+    """
+    Transforms raw ingestion objects and saves the results, up to 'workers' tables at a time.
+    Each table's keys are processed in event order by one task, so its db_state and snapshot are
+    only written by one thread. Tables run level by level (see schedule_transform_levels), so a
+    table only starts once the tables whose snapshots it joins against are up to date.
+    Outputs are uploaded on a separate pool while later tables are transformed
+
+    Args:
+        s3_client (Object): S3 client for fetching and writing objects
+        ingestion_bucket (str): Name of the S3 bucket containing new raw data
+        processed_bucket (str): Name of the S3 bucket for db_state and transformed files
+        new_keys (list): raw object keys of the event
+        extract_time (str): timestamp string used to structure S3 keys
+        workers (int, optional): maximum tables transformed and uploads run at the same time. Defaults to 1.
+        engine (str, optional): 'pandas' or 'arrow'. Defaults to "pandas".
+
+    Returns:
+        list: keys of the saved Parquet files, in the order of new_keys
+    """
+
+    keys_by_table = {}
+    for position, new_key in enumerate(new_keys):
+        keys_by_table.setdefault(new_key.split("/")[1], []).append((position, new_key))
+    uploads = [None] * len(new_keys)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as upload_executor:
+
+        def transform_table(table_name):
+            for position, new_key in keys_by_table[table_name]:
+                transformed_dict = transform_raw_key(s3_client, ingestion_bucket, processed_bucket, new_key, engine)
+                uploads[position] = upload_executor.submit(
+                    save_transformed, s3_client, processed_bucket, transformed_dict, extract_time, engine
+                )
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for level in schedule_transform_levels(keys_by_table):
+                list(executor.map(transform_table, level))
+
+    list_of_transformed_keys = []
+    for upload in uploads:
+        list_of_transformed_keys += upload.result()
+    return list_of_transformed_keys
+
+
+def schedule_transform_levels(table_names):
+    """
+    Orders tables for transforming using TRANSFORM_DEPENDENCIES. Tables in the same level do not
+    depend on each other; every table comes after the tables whose snapshots it reads.
+    Dependencies that are not in the event are assumed to be up to date already
+
+    Args:
+        table_names (iterable): names of the tables to transform
+
+    Raises:
+        ValueError: if the dependencies contain a cycle
+
+    Returns:
+        list: lists of table names, one per level, in transform order
+    """
+
+    remaining = {
+        table_name: {dep for dep in TRANSFORM_DEPENDENCIES.get(table_name, []) if dep in table_names}
+        for table_name in table_names
+    }
+    levels = []
+    while remaining:
+        level = [table_name for table_name, deps in remaining.items() if not deps]
+        if not level:
+            raise ValueError(f"Circular table dependencies: {sorted(remaining)}")
+        for table_name in level:
+            del remaining[table_name]
+        for deps in remaining.values():
+            deps.difference_update(level)
+        levels.append(level)
+    return levels
+
+
+def transform_raw_key(s3_client, ingestion_bucket, processed_bucket, new_key, engine="pandas"):
+    """
+    Appends one raw ingestion object to the db_state and transforms it with the chosen engine
+
+    Args:
+        s3_client (Object): S3 client for fetching and writing objects
+        ingestion_bucket (str): Name of the S3 bucket containing new raw data
+        processed_bucket (str): Name of the S3 bucket for db_state and reference data
+        new_key (str): raw object key
+        engine (str, optional): 'pandas' or 'arrow'. Defaults to "pandas".
+
+    Returns:
+        dict: transformed DataFrames or pyarrow Tables keyed by target table name, None for tables without a transform
+    """
+
+    if engine == "arrow":
+        table_name, new_table = append_raw_table_arrow(s3_client, ingestion_bucket, new_key, processed_bucket)
+        return mvp_transform_arrow(s3_client, table_name, new_table, processed_bucket)
+    table_name, new_df = append_json_raw_tables(s3_client, ingestion_bucket, new_key, processed_bucket)
+    return mvp_transform_df(s3_client, table_name, new_df, processed_bucket)
+
+
+def save_transformed(s3_client, processed_bucket, transformed_dict, extract_time, engine="pandas"):
+    """
+    Saves the output of transform_raw_key with the writer of its engine
+
+    Args:
+        s3_client (Object): S3 client for writing objects
+        processed_bucket (str): Target S3 bucket for storing the Parquet files
+        transformed_dict (dict): output of transform_raw_key
+        extract_time (str): timestamp string used to structure S3 keys
+        engine (str, optional): 'pandas' or 'arrow'. Defaults to "pandas".
+
+    Returns:
+        list: List of S3 keys for the saved Parquet files
+    """
+
+    if engine == "arrow":
+        return save_arrow_to_s3(s3_client, processed_bucket, transformed_dict, extract_time)
+    return save_parquet_to_s3(s3_client, processed_bucket, transformed_dict, extract_time)
+
+
 def table_name_to_df(s3_client, table_name, bucket_name):
     """
-    Loads a table's full historical JSON data from S3 into a pandas DataFrame
+    Loads a table's full historical data from the db_state in S3 into a pandas DataFrame.
+    A legacy db_state/{table_name}_all.json file, if present and not yet compacted, is read before the Parquet segments
 
     Args:
         s3_client (Object): Boto3 S3 client for accessing the bucket
         table_name (str): Name of the table to load
-        bucket_name (str): S3 bucket containing the db_state JSON files
+        bucket_name (str): S3 bucket containing the db_state files
 
     Returns:
         pandas.DataFrame: DataFrame containing the table's full data
     """
         
-    """key is generated in next line"""
-    key = f"db_state/{table_name}_all.json"
-    new_object = s3_client.get_object(Bucket=bucket_name, Key=key)
-    new_json = json.loads(new_object["Body"].read().decode("utf-8"))
-    new_df = pd.DataFrame.from_dict(data=new_json, orient='columns')
+    import pandas as pd
 
+    df_list = []
+    segment_keys = list_state_segments(s3_client, bucket_name, table_name)
+    # a compacted segment already holds the rows of the legacy file
+    if not (segment_keys and segment_keys[0].endswith(COMPACTED_SUFFIX)):
+        try:
+            key = f"db_state/{table_name}_all.json"
+            new_object = s3_client.get_object(Bucket=bucket_name, Key=key)
+            new_json = json.loads(new_object["Body"].read().decode("utf-8"))
+            df_list.append(pd.DataFrame.from_dict(data=new_json, orient='columns'))
+        except s3_client.exceptions.NoSuchKey:
+            pass
+    for key in segment_keys:
+        new_object = s3_client.get_object(Bucket=bucket_name, Key=key)
+        df_list.append(pd.read_parquet(BytesIO(new_object["Body"].read())))
+    if not df_list:
+        return pd.DataFrame()
+
+    new_df = pd.concat(df_list, ignore_index=True)
     return new_df
 
 
-def save_parquet_to_s3(bucket_name, transformed_dict, extract_time):
+def save_parquet_to_s3(s3_client, bucket_name, transformed_dict, extract_time):
     """
-    Saves transformed DataFrames as Parquet files to an S3 bucket with timestamped keys
+    Saves transformed DataFrames as Parquet files to an S3 bucket with timestamped keys.
+    Files are written in memory and uploaded with the shared client, which is safe to use from
+    the upload threads of transform_keys
 
     Args:
+        s3_client (Object): S3 client for writing objects
         bucket_name (str): Target S3 bucket for storing the Parquet files
         transformed_dict (dict): Dictionary of table names to pandas DataFrames
         extract_time (str): timestamp string used to structure S3 keys
@@ -100,12 +309,9 @@ def save_parquet_to_s3(bucket_name, transformed_dict, extract_time):
     for transform_name, new_df in transformed_dict.items():
         date, time = extract_time.split("T")
         key = f"dev/{transform_name}/{date}/{transform_name}_{time}.parquet"
-
-        wr.s3.to_parquet(
-            df=new_df,
-            path=f"s3://{bucket_name}/{key}",
-            dataset=False
-        )
+        buffer = BytesIO()
+        new_df.to_parquet(buffer, index=False)
+        s3_client.put_object(Bucket=bucket_name, Body=buffer.getvalue(), Key=key)
         key_list.append(key)
     return key_list
 
@@ -113,7 +319,7 @@ def save_parquet_to_s3(bucket_name, transformed_dict, extract_time):
 def mvp_transform_df(s3_client, table_name, new_df, processed_bucket):
     """
     Applies table-specific transformation logic to raw DataFrame
-    Depending on the table name, this function merges the new data with reference data when required
+    Depending on the table name, this function merges the new data with the latest snapshot of reference data when required
 
     Args:
         s3_client (Object): S3 client for accessing reference and state files
@@ -125,9 +331,11 @@ def mvp_transform_df(s3_client, table_name, new_df, processed_bucket):
         dict: Dictionary of transformed DataFrames keyed by their target table names 
     """
 
+    import pandas as pd
+
     match table_name:
         case "staff":
-            department_df = table_name_to_df(s3_client, "department", processed_bucket)
+            department_df = latest_table_df(s3_client, "department", processed_bucket)
             dim_staff = pd.merge(new_df, department_df, how="left", on="department_id")
             dim_staff = dim_staff.loc[
                 :,
@@ -142,7 +350,7 @@ def mvp_transform_df(s3_client, table_name, new_df, processed_bucket):
             ]
             return {"dim_staff": dim_staff}
         case "address":
-            address_df = table_name_to_df(s3_client, "address", processed_bucket)
+            address_df = latest_table_df(s3_client, "address", processed_bucket)
             dim_location = address_df.loc[
                 :,
                 [
@@ -160,7 +368,7 @@ def mvp_transform_df(s3_client, table_name, new_df, processed_bucket):
             return {"dim_location": dim_location}
         
         case "counterparty":
-            address_df = table_name_to_df(s3_client, "address", processed_bucket)
+            address_df = latest_table_df(s3_client, "address", processed_bucket)
             dim_counterparty = pd.merge(
                 new_df,
                 address_df,
@@ -203,16 +411,7 @@ def mvp_transform_df(s3_client, table_name, new_df, processed_bucket):
             return {"dim_design": dim_design}
         
         case "currency":
-            currency_dict = {
-                "GBP": "British pound",
-                "USD": "US dollar",
-                "EUR": "Euro",
-                "CHF": "Swiss franc",
-            }
-            for row in range(len(new_df)):
-                new_df.loc[row, "currency_name"] = currency_dict[
-                    new_df.loc[row, "currency_code"]
-                ]
+            new_df["currency_name"] = map_currency_names(new_df["currency_code"])
             dim_currency = new_df.loc[:, ["currency_id", "currency_code", "currency_name"]]
             return {"dim_currency": dim_currency}
 
@@ -264,57 +463,148 @@ def mvp_transform_df(s3_client, table_name, new_df, processed_bucket):
                 ],
                 ignore_index=True,
             )
-            #below merging with dbstate Series main_dates
-            try:
-                new_object = s3_client.get_object(Bucket=processed_bucket, Key="db_state/date_all.json")
-                dates_dict = json.loads(new_object["Body"].read().decode("utf-8"))
-                main_dates = dates_dict.values()
-
-                main_set = set(main_dates)
-                new_set = set(new_dates)
-                unique_new_set = new_set.difference(main_set)
-
-                if len(unique_new_set) == 0: #no nwq unique dates, just return sales data
-                    return {"fact_sales_order": fact_sales_order}
-                
-                unique_new_dates = pd.Series(list(unique_new_set))
-                merged_set = main_set.union(new_set)
-                merged_dates = pd.Series(list(merged_set))
-            
-            except s3_client.exceptions.NoSuchKey:
-                unique_new_dates = new_dates.drop_duplicates(ignore_index=True)
-                merged_dates = unique_new_dates.copy()
-
-            wr.s3.to_json(merged_dates, path=f"s3://{processed_bucket}/db_state/date_all.json")
-
-            dim_date = pd.DataFrame()
-            dim_date["date_str"] = unique_new_dates
-            dim_date["date_id"] = [
-                datetime.strptime(date, "%Y-%m-%d") for date in unique_new_dates
-            ]
+            unique_new_dates = register_new_dates(s3_client, processed_bucket, new_dates)
+            if len(unique_new_dates) == 0: #no new unique dates, just return sales data
+                return {"fact_sales_order": fact_sales_order}
 
-            dim_date["year"] = [d.year for d in dim_date["date_id"]]
-            dim_date["month"] = [d.month for d in dim_date["date_id"]]
-            dim_date["day"] = [d.day for d in dim_date["date_id"]]
+            dim_date = build_dim_date(unique_new_dates)
 
-            dim_date.drop(columns=["date_str"], inplace=True)
-            dim_date["day_of_week"] = [d.weekday() for d in dim_date["date_id"]]
-            dim_date["day_name"] = [d.day_name() for d in dim_date["date_id"]]
-            dim_date["month_name"] = [d.month_name() for d in dim_date["date_id"]]
-            dim_date["quarter"] = [d.quarter for d in dim_date["date_id"]]
-            
             return {"dim_date": dim_date, "fact_sales_order": fact_sales_order}
 
 
+def load_date_registry(s3_client, bucket_name):
+    """
+    Loads the registry of dates already in dim_date from db_state/date_registry.bin, a sorted array
+    of little-endian int32 day numbers since 1970-01-01. If it does not exist yet it is seeded from
+    a legacy db_state/date_all.json file, or starts empty
+
+    Args:
+        s3_client (Object): Boto3 S3 client for accessing the bucket
+        bucket_name (str): S3 bucket containing the db_state files
+
+    Returns:
+        numpy.ndarray: sorted unique int32 day numbers
+    """
+
+    import pandas as pd
+    import numpy as np
+
+    try:
+        new_object = s3_client.get_object(Bucket=bucket_name, Key="db_state/date_registry.bin")
+        return np.frombuffer(new_object["Body"].read(), dtype="<i4")
+    except s3_client.exceptions.NoSuchKey:
+        pass
+    try:
+        new_object = s3_client.get_object(Bucket=bucket_name, Key="db_state/date_all.json")
+        dates_dict = json.loads(new_object["Body"].read().decode("utf-8"))
+        return dates_to_day_numbers(pd.Series(list(dates_dict.values())))
+    except s3_client.exceptions.NoSuchKey:
+        return np.array([], dtype="<i4")
+
+
+def dates_to_day_numbers(date_strings):
+    """
+    Converts 'YYYY-MM-DD' strings to sorted unique int32 day numbers since 1970-01-01
+
+    Args:
+        date_strings (pandas.Series | pyarrow.ChunkedArray): dates
+
+    Returns:
+        numpy.ndarray: sorted unique int32 day numbers
+    """
+
+    import numpy as np
+
+    dates = np.asarray(date_strings, dtype=object).astype("datetime64[D]")
+    return np.unique(dates.astype("int64")).astype("<i4")
+
+
+def register_new_dates(s3_client, bucket_name, date_strings):
+    """
+    Finds the dates that are not in the date registry yet and adds them to it. Membership is a binary
+    search of the sorted registry, and the registry (4 bytes per date) is only written when dates are added
+
+    Args:
+        s3_client (Object): Boto3 S3 client for accessing the bucket
+        bucket_name (str): S3 bucket containing the db_state files
+        date_strings (pandas.Series | pyarrow.ChunkedArray): 'YYYY-MM-DD' dates referenced by new rows
+
+    Returns:
+        pandas.Series: sorted 'YYYY-MM-DD' strings of the dates that were not registered before
+    """
+
+    import pandas as pd
+    import numpy as np
+
+    registry = load_date_registry(s3_client, bucket_name)
+    day_numbers = dates_to_day_numbers(date_strings)
+    positions = np.searchsorted(registry, day_numbers)
+    known = positions < len(registry)
+    known[known] = registry[positions[known]] == day_numbers[known]
+    new_day_numbers = day_numbers[~known]
+    if len(new_day_numbers):
+        merged = np.union1d(registry, new_day_numbers).astype("<i4")
+        s3_client.put_object(Bucket=bucket_name, Body=merged.tobytes(), Key="db_state/date_registry.bin")
+    new_dates = new_day_numbers.astype("int64").astype("datetime64[D]").astype(str)
+    return pd.Series(new_dates, dtype=object)
+
+
+def build_dim_date(date_strings):
+    """
+    Builds dim_date rows for a Series of 'YYYY-MM-DD' strings, computing every calendar
+    attribute with vectorised datetime accessors rather than per-date Python calls
+
+    Args:
+        date_strings (pandas.Series): dates to add to dim_date
+
+    Returns:
+        pandas.DataFrame: date_id, year, month, day, day_of_week, day_name, month_name and quarter columns
+    """
+
+    import pandas as pd
+
+    date_id = pd.to_datetime(pd.Series(date_strings).reset_index(drop=True), format="%Y-%m-%d")
+    return pd.DataFrame(
+        {
+            "date_id": date_id,
+            "year": date_id.dt.year.astype("int64"),
+            "month": date_id.dt.month.astype("int64"),
+            "day": date_id.dt.day.astype("int64"),
+            "day_of_week": date_id.dt.weekday.astype("int64"),
+            "day_name": date_id.dt.day_name(),
+            "month_name": date_id.dt.month_name(),
+            "quarter": date_id.dt.quarter.astype("int64"),
+        }
+    )
+
+
+def map_currency_names(currency_codes):
+    """
+    Looks up the names of a Series of ISO 4217 currency codes in CURRENCY_NAMES in a single pass
+
+    Args:
+        currency_codes (pandas.Series): currency codes
+
+    Returns:
+        pandas.Series: currency names, UNKNOWN_CURRENCY_NAME for codes missing from CURRENCY_NAMES
+    """
+
+    return currency_codes.map(CURRENCY_NAMES).fillna(UNKNOWN_CURRENCY_NAME)
+
+
 def append_json_raw_tables(s3_client, ingestion_bucket, new_json_key, processed_bucket):
     """
-    Appends new ingested JSON data to existing processed data and updates the db_state in S3
+    Appends new ingested JSON data to the db_state in S3 as a new Parquet segment,
+    so that each run only writes its own rows. The raw object is streamed into a DataFrame
+    one batch of RAW_BATCH_ROWS rows at a time (see iter_raw_batches). Segments are compacted once there are
+    more than STATE_MAX_SEGMENTS of them. Tables in SNAPSHOT_TABLES also have their
+    latest-row-per-key snapshot updated
 
     Args:
         s3_client (Object): S3 client for fetching and writing objects
         ingestion_bucket (str): Name of the S3 bucket containing new raw data
-        new_json_key (str): Key of the new JSON file in the ingestion bucket
-        processed_bucket (str): Name of the S3 bucket to update with merged data
+        new_json_key (str): Key of the new JSON file (or chunk manifest) in the ingestion bucket
+        processed_bucket (str): Name of the S3 bucket holding the db_state segments
 
     Returns:
         tuple: (table_name, new_df)
@@ -322,27 +612,720 @@ def append_json_raw_tables(s3_client, ingestion_bucket, new_json_key, processed_
             - new_df (pandas.DataFrame): DataFrame created from the new JSON file
     """
 
+    import pandas as pd
+
     print(f'json_s3: {s3_client}')
     table_name = new_json_key.split("/")[1]
 
-    main_json_key_overwritten = f"db_state/{table_name}_all.json"
-    new_object = s3_client.get_object(Bucket=ingestion_bucket, Key=new_json_key)
-    new_json = json.loads(new_object["Body"].read().decode("utf-8"))
-    new_df = pd.DataFrame.from_dict(data=new_json, orient='columns')
+    batch_dfs = [
+        pd.DataFrame.from_dict(data=batch, orient='columns')
+        for batch in iter_raw_batches(s3_client, ingestion_bucket, new_json_key)
+    ]
+    new_df = pd.concat(batch_dfs, ignore_index=True) if batch_dfs else pd.DataFrame()
+
+    save_state_segment(s3_client, processed_bucket, table_name, new_df)
+    compact_state_segments(s3_client, processed_bucket, table_name)
+    if table_name in SNAPSHOT_TABLES:
+        update_latest_snapshot(s3_client, processed_bucket, table_name, new_df)
+  
+    return (table_name, new_df)
+
+
+def latest_rows(df, primary_key):
+    """
+    Keeps the most recently updated row for each primary key
+
+    Args:
+        df (pandas.DataFrame): rows of a table, possibly with several versions of a key
+        primary_key (str): name of the primary key column
+
+    Returns:
+        pandas.DataFrame: one row per primary key, sorted by primary key
+    """
+
+    if df.empty:
+        return df
+    if "last_updated" in df.columns:
+        df = df.sort_values(by="last_updated", kind="stable")
+    latest_df = df.drop_duplicates(subset=primary_key, keep="last")
+    return latest_df.sort_values(by=primary_key).reset_index(drop=True)
+
+
+def latest_table_df(s3_client, table_name, bucket_name):
+    """
+    Loads the latest-row-per-key snapshot of a table in SNAPSHOT_TABLES from db_state/{table_name}_latest.parquet.
+    Snapshots are kept in reference_cache between warm invocations and revalidated with a conditional
+    GET on their ETag, so an unchanged snapshot is neither downloaded nor parsed again.
+    If the snapshot does not exist yet it is built from the table's full history and saved
+
+    Args:
+        s3_client (Object): Boto3 S3 client for accessing the bucket
+        table_name (str): Name of the table to load
+        bucket_name (str): S3 bucket containing the db_state files
+
+    Returns:
+        pandas.DataFrame: DataFrame containing the latest version of every row
+    """
+
+    import pandas as pd
 
+    key = f"db_state/{table_name}_latest.parquet"
+    cached = reference_cache.get((bucket_name, key))
     try:
-        main_df = table_name_to_df(s3_client, table_name, processed_bucket)
-        merged_df = pd.concat([main_df, new_df], ignore_index=True)
+        if cached:
+            new_object = s3_client.get_object(Bucket=bucket_name, Key=key, IfNoneMatch=cached[0])
+        else:
+            new_object = s3_client.get_object(Bucket=bucket_name, Key=key)
     except s3_client.exceptions.NoSuchKey:
-        merged_df = new_df.copy()
+        latest_df = latest_rows(table_name_to_df(s3_client, table_name, bucket_name), SNAPSHOT_TABLES[table_name])
+        save_latest_snapshot(s3_client, bucket_name, table_name, latest_df)
+        return latest_df
+    except ClientError as err:
+        if cached and err.response["Error"]["Code"] in ("304", "NotModified"):
+            with reference_cache_lock:
+                if (bucket_name, key) in reference_cache:
+                    reference_cache.move_to_end((bucket_name, key))
+            return cached[1].copy()
+        raise
+    latest_df = pd.read_parquet(BytesIO(new_object["Body"].read()))
+    cache_reference_df(bucket_name, key, new_object["ETag"], latest_df)
+    return latest_df
 
-    df_dict = merged_df.T.to_dict()
-    df_list = list(df_dict.values())
-    
-    s3_client.put_object(Bucket=processed_bucket, Body=json.dumps(df_list, default=serialise_object, indent=2), 
-            Key=main_json_key_overwritten)
-  
-    return (table_name, new_df)
+
+def update_latest_snapshot(s3_client, bucket_name, table_name, new_df):
+    """
+    Merges new rows into the latest-row-per-key snapshot of a table in SNAPSHOT_TABLES,
+    so that the snapshot grows with the number of distinct keys rather than the number of updates
+
+    Args:
+        s3_client (Object): Boto3 S3 client for accessing the bucket
+        bucket_name (str): S3 bucket containing the db_state files
+        table_name (str): Name of the table
+        new_df (pandas.DataFrame): newly ingested rows
+
+    Returns:
+        pandas.DataFrame: the updated snapshot
+    """
+
+    import pandas as pd
+
+    latest_df = latest_table_df(s3_client, table_name, bucket_name)
+    latest_df = latest_rows(pd.concat([latest_df, new_df], ignore_index=True), SNAPSHOT_TABLES[table_name])
+    save_latest_snapshot(s3_client, bucket_name, table_name, latest_df)
+    return latest_df
+
+
+def save_latest_snapshot(s3_client, bucket_name, table_name, latest_df):
+    """
+    Writes the latest-row-per-key snapshot of a table and caches it under the new ETag,
+    so that later reads in this or a warm invocation revalidate instead of downloading
+
+    Args:
+        s3_client (Object): Boto3 S3 client for accessing the bucket
+        bucket_name (str): S3 bucket containing the db_state files
+        table_name (str): Name of the table
+        latest_df (pandas.DataFrame): one row per primary key
+
+    Returns:
+        str: key of the snapshot
+    """
+
+    key = f"db_state/{table_name}_latest.parquet"
+    buffer = BytesIO()
+    latest_df.to_parquet(buffer, index=False)
+    response = s3_client.put_object(Bucket=bucket_name, Body=buffer.getvalue(), Key=key)
+    cache_reference_df(bucket_name, key, response["ETag"], latest_df)
+    return key
+
+
+def cache_reference_df(bucket_name, key, etag, df):
+    """
+    Stores a copy of a reference DataFrame in reference_cache, evicting the least recently used
+    entries beyond REFERENCE_CACHE_SIZE (default 8)
+
+    Args:
+        bucket_name (str): S3 bucket of the object
+        key (str): S3 key of the object
+        etag (str): ETag of the object the DataFrame was read from or written to
+        df (pandas.DataFrame): parsed object
+    """
+
+    with reference_cache_lock:
+        reference_cache[(bucket_name, key)] = (etag, df.copy())
+        reference_cache.move_to_end((bucket_name, key))
+        while len(reference_cache) > int(os.environ.get("REFERENCE_CACHE_SIZE", 8)):
+            reference_cache.popitem(last=False)
+
+
+def list_state_segments(s3_client, bucket_name, table_name):
+    """
+    Lists the db_state Parquet segment keys of a table, oldest first. A compacted segment
+    ({segment}.compacted.parquet, see compact_state_segments) holds every row up to the segment it
+    is named after, so segments up to that one are left out even if an interrupted compaction did
+    not get to delete them
+
+    Args:
+        s3_client (Object): Boto3 S3 client for accessing the bucket
+        bucket_name (str): S3 bucket containing the db_state segments
+        table_name (str): Name of the table
+
+    Returns:
+        list: sorted list of segment keys, starting with the latest compacted segment if there is one
+    """
+
+    segment_keys = list_segment_objects(s3_client, bucket_name, table_name)
+    compacted_keys = [key for key in segment_keys if key.endswith(COMPACTED_SUFFIX)]
+    if not compacted_keys:
+        return segment_keys
+    compacted_key = max(compacted_keys, key=compacted_segment_position)
+    covered_up_to = compacted_segment_position(compacted_key)
+    return [compacted_key] + [key for key in segment_keys
+                              if not key.endswith(COMPACTED_SUFFIX) and key > covered_up_to]
+
+
+def list_segment_objects(s3_client, bucket_name, table_name):
+    """
+    Lists every Parquet object under a table's db_state prefix, including segments already
+    merged into a compacted segment
+
+    Args:
+        s3_client (Object): Boto3 S3 client for accessing the bucket
+        bucket_name (str): S3 bucket containing the db_state segments
+        table_name (str): Name of the table
+
+    Returns:
+        list: sorted list of keys
+    """
+
+    segment_keys = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=f"db_state/{table_name}/"):
+        segment_keys += [obj["Key"] for obj in page.get("Contents", []) if obj["Key"].endswith(".parquet")]
+    return sorted(segment_keys)
+
+
+def compacted_segment_position(key):
+    """
+    Returns the key of the newest segment a segment covers: itself for plain segments, and the
+    segment it is named after for compacted ones
+
+    Args:
+        key (str): segment key
+
+    Returns:
+        str: plain segment key
+    """
+
+    if key.endswith(COMPACTED_SUFFIX):
+        return key[:-len(COMPACTED_SUFFIX)] + ".parquet"
+    return key
+
+
+def save_state_segment(s3_client, bucket_name, table_name, new_df, key=None):
+    """
+    Writes a DataFrame to the db_state of a table as a Parquet segment. Segment keys embed
+    the UTC write time, so listing them in key order gives the order they were appended in
+
+    Args:
+        s3_client (Object): Boto3 S3 client for accessing the bucket
+        bucket_name (str): S3 bucket containing the db_state segments
+        table_name (str): Name of the table
+        new_df (pandas.DataFrame | pyarrow.Table): rows to append
+        key (str, optional): segment key to write. Defaults to a new timestamped key.
+
+    Returns:
+        str: key of the written segment
+    """
+
+    if key is None:
+        timestamp = datetime.now(UTC).isoformat().replace("+00:00", "")
+        key = f"db_state/{table_name}/{table_name}_{timestamp}.parquet"
+    buffer = BytesIO()
+    if hasattr(new_df, "to_parquet"):
+        new_df.to_parquet(buffer, index=False)
+    else:
+        import pyarrow.parquet as pq
+        pq.write_table(new_df, buffer)
+    s3_client.put_object(Bucket=bucket_name, Body=buffer.getvalue(), Key=key)
+    return key
+
+
+def compact_state_segments(s3_client, bucket_name, table_name, max_segments=None):
+    """
+    Merges a table's db_state segments (and any legacy {table_name}_all.json file) into one
+    segment once there are more than max_segments of them. The merged rows are written to a new
+    {newest segment}.compacted.parquet key before the older objects are deleted, and readers skip
+    the segments it covers (see list_state_segments), so a failure part way neither loses nor
+    duplicates rows
+
+    Args:
+        s3_client (Object): Boto3 S3 client for accessing the bucket
+        bucket_name (str): S3 bucket containing the db_state segments
+        table_name (str): Name of the table
+        max_segments (int, optional): Defaults to STATE_MAX_SEGMENTS or 48.
+
+    Returns:
+        str: key of the compacted segment, None if no compaction was needed
+    """
+
+    if max_segments is None:
+        max_segments = int(os.environ.get("STATE_MAX_SEGMENTS", 48))
+    segment_keys = list_state_segments(s3_client, bucket_name, table_name)
+    if len(segment_keys) <= max_segments:
+        return None
+
+    compacted_df = table_name_to_df(s3_client, table_name, bucket_name)
+    covered_up_to = compacted_segment_position(segment_keys[-1])
+    compacted_key = save_state_segment(s3_client, bucket_name, table_name, compacted_df,
+                                       key=covered_up_to[:-len(".parquet")] + COMPACTED_SUFFIX)
+    old_keys = [key for key in list_segment_objects(s3_client, bucket_name, table_name)
+                if key != compacted_key and compacted_segment_position(key) <= covered_up_to]
+    old_keys.append(f"db_state/{table_name}_all.json")
+    for i in range(0, len(old_keys), 1000):
+        s3_client.delete_objects(
+            Bucket=bucket_name,
+            Delete={"Objects": [{"Key": key} for key in old_keys[i:i + 1000]], "Quiet": True},
+        )
+    return compacted_key
+
+
+def read_raw_rows(s3_client, ingestion_bucket, raw_key):
+    """
+    Reads every row of a raw ingestion object (see iter_raw_batches)
+
+    Args:
+        s3_client (Object): S3 client for fetching objects
+        ingestion_bucket (str): Name of the S3 bucket containing raw data
+        raw_key (str): Key of the raw file or chunk manifest
+
+    Returns:
+        list: List of dictionaries containing table row data
+    """
+
+    rows = []
+    for batch in iter_raw_batches(s3_client, ingestion_bucket, raw_key):
+        rows += batch
+    return rows
+
+
+def iter_raw_batches(s3_client, ingestion_bucket, raw_key, batch_rows=None):
+    """
+    Reads the rows of a raw ingestion object in batches, detecting its format from the key suffix:
+    '.manifest.json' chunk manifests (rows of every listed chunk are returned in order),
+    '.ndjson.gz' gzip newline-delimited JSON, '.parquet' and otherwise a JSON array.
+    JSON is parsed incrementally as the body streams in, so only the current batch of rows is
+    held in memory rather than the raw bytes, the decoded text and the parsed list at once.
+    The body is read RAW_READ_CHUNK_BYTES (default 65536) at a time; botocore's default of
+    1024 makes parsing about twice as slow as json.loads.
+    Parquet timestamps are returned as ISO strings so that every format gives the same rows
+
+    Args:
+        s3_client (Object): S3 client for fetching objects
+        ingestion_bucket (str): Name of the S3 bucket containing raw data
+        raw_key (str): Key of the raw file or chunk manifest
+        batch_rows (int, optional): rows per batch. Defaults to RAW_BATCH_ROWS or 5000.
+
+    Yields:
+        list: up to batch_rows dictionaries containing table row data
+    """
+
+    if batch_rows is None:
+        batch_rows = int(os.environ.get("RAW_BATCH_ROWS", 5000))
+    raw_object = s3_client.get_object(Bucket=ingestion_bucket, Key=raw_key)
+    if raw_key.endswith(".manifest.json"):
+        for chunk in json.loads(raw_object["Body"].read().decode("utf-8"))["chunks"]:
+            yield from iter_raw_batches(s3_client, ingestion_bucket, chunk["key"], batch_rows)
+        return
+    if raw_key.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(BytesIO(raw_object["Body"].read()))
+        for record_batch in parquet_file.iter_batches(batch_size=batch_rows):
+            yield timestamps_to_iso(record_batch).to_pylist()
+        return
+    if raw_key.endswith(".ndjson.gz"):
+        with gzip.GzipFile(fileobj=raw_object["Body"]) as lines:
+            rows = (json.loads(line) for line in lines if line.strip())
+            yield from batched_rows(rows, batch_rows)
+        return
+    chunk_size = int(os.environ.get("RAW_READ_CHUNK_BYTES", 65536))
+    yield from batched_rows(iter_json_array(raw_object["Body"].iter_chunks(chunk_size)), batch_rows)
+
+
+def batched_rows(rows, batch_rows):
+    """
+    Groups an iterable of rows into lists of at most batch_rows rows
+
+    Args:
+        rows (iterable): rows
+        batch_rows (int): maximum rows per list
+
+    Yields:
+        list: consecutive rows
+    """
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_rows:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_json_array(chunks):
+    """
+    Incrementally parses a JSON array from byte chunks, yielding each element as soon as it is
+    complete. Only the unparsed tail of the stream is buffered between chunks
+
+    Args:
+        chunks (iterable): bytes of a UTF-8 JSON array, in order
+
+    Raises:
+        json.JSONDecodeError: if the stream is not a complete JSON array
+
+    Yields:
+        element of the array
+    """
+
+    decoder = json.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    expecting = "["
+    for chunk in chunks:
+        buffer += utf8_decoder.decode(chunk)
+        pos = 0
+        while True:
+            pos = JSON_WHITESPACE.match(buffer, pos).end()
+            if pos == len(buffer):
+                break
+            if expecting == "[":
+                if buffer[pos] != "[":
+                    raise json.JSONDecodeError("Expecting '['", buffer, pos)
+                expecting = "element or ]"
+                pos += 1
+            elif expecting == ", or ]":
+                if buffer[pos] == "]":
+                    return
+                if buffer[pos] != ",":
+                    raise json.JSONDecodeError("Expecting ',' delimiter", buffer, pos)
+                expecting = "element"
+                pos += 1
+            else:
+                if expecting == "element or ]" and buffer[pos] == "]":
+                    return
+                try:
+                    element, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    break  # the element continues in the next chunk
+                if (not isinstance(element, (dict, list, str))
+                        and JSON_NUMBER_TAIL.match(buffer, end).end() == len(buffer)):
+                    break  # a number or literal may continue in the next chunk
+                yield element
+                expecting = ", or ]"
+                pos = end
+        buffer = buffer[pos:]
+    if buffer.strip() and expecting in ("element", "element or ]"):
+        decoder.raw_decode(buffer, JSON_WHITESPACE.match(buffer).end())
+    raise json.JSONDecodeError(f"Expecting {expecting}", buffer, len(buffer))
+
+def append_raw_table_arrow(s3_client, ingestion_bucket, new_raw_key, processed_bucket):
+    """
+    Arrow engine counterpart of append_json_raw_tables: reads a raw ingestion object into a
+    pyarrow Table and appends it to the db_state as a new Parquet segment. Tables in SNAPSHOT_TABLES
+    also have their latest-row-per-key snapshot updated
+
+    Args:
+        s3_client (Object): S3 client for fetching and writing objects
+        ingestion_bucket (str): Name of the S3 bucket containing new raw data
+        new_raw_key (str): Key of the new raw file (or chunk manifest) in the ingestion bucket
+        processed_bucket (str): Name of the S3 bucket holding the db_state segments
+
+    Returns:
+        tuple: (table_name, new_table)
+            - table_name (str): Extracted table name from the S3 key
+            - new_table (pyarrow.Table): rows of the new raw file
+    """
+
+    table_name = new_raw_key.split("/")[1]
+    new_table = read_raw_table(s3_client, ingestion_bucket, new_raw_key)
+
+    save_state_segment(s3_client, processed_bucket, table_name, new_table)
+    compact_state_segments(s3_client, processed_bucket, table_name)
+    if table_name in SNAPSHOT_TABLES:
+        update_latest_snapshot(s3_client, processed_bucket, table_name, new_table.to_pandas())
+
+    return (table_name, new_table)
+
+
+def read_raw_table(s3_client, ingestion_bucket, raw_key):
+    """
+    Reads a raw ingestion object into a pyarrow Table. Parquet objects are read column by column
+    without building Python rows; the other formats are converted one batch at a time (see iter_raw_batches)
+
+    Args:
+        s3_client (Object): S3 client for fetching objects
+        ingestion_bucket (str): Name of the S3 bucket containing raw data
+        raw_key (str): Key of the raw file or chunk manifest
+
+    Returns:
+        pyarrow.Table: rows of the object, timestamps as ISO strings
+    """
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if raw_key.endswith(".parquet"):
+        raw_object = s3_client.get_object(Bucket=ingestion_bucket, Key=raw_key)
+        return timestamps_to_iso(pq.read_table(BytesIO(raw_object["Body"].read())))
+    tables = [pa.Table.from_pylist(batch) for batch in iter_raw_batches(s3_client, ingestion_bucket, raw_key)]
+    return pa.concat_tables(tables, promote_options="permissive") if tables else pa.table({})
+
+
+def timestamps_to_iso(table):
+    """
+    Replaces the timestamp columns of a pyarrow Table with ISO 8601 strings, as found in JSON raw files.
+    Like datetime.isoformat, microseconds are only written when they are not zero
+
+    Args:
+        table (pyarrow.Table): table to convert
+
+    Returns:
+        pyarrow.Table: table with string columns in place of timestamps
+    """
+
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    for i, field in enumerate(table.schema):
+        if pa.types.is_timestamp(field.type):
+            column = table.column(i)
+            # %S on a seconds timestamp has no fraction, the microseconds are appended separately
+            seconds = pc.strftime(column.cast(pa.timestamp("s", field.type.tz), safe=False), format="%Y-%m-%dT%H:%M:%S")
+            micros = pc.add(pc.multiply(pc.millisecond(column), 1000), pc.microsecond(column))
+            fraction = pc.if_else(pc.equal(micros, 0), "",
+                                  pc.binary_join_element_wise(".", pc.utf8_lpad(pc.cast(micros, pa.string()), 6, "0"), ""))
+            table = table.set_column(i, field.name, pc.binary_join_element_wise(seconds, fraction, ""))
+    return table
+
+
+def left_join_arrow(left, right, left_on, right_on, right_columns):
+    """
+    Left joins columns of right onto left, keeping the row order of left as pandas.merge does.
+    All-null columns of right are joined as strings
+
+    Args:
+        left (pyarrow.Table): table whose rows are all kept
+        right (pyarrow.Table): lookup table, one row per right_on value
+        left_on (str): join column of left
+        right_on (str): join column of right
+        right_columns (list): columns of right to add
+
+    Returns:
+        pyarrow.Table: left with right_columns appended
+    """
+
+    import numpy as np
+    import pyarrow as pa
+
+    left = left.append_column("__row", pa.array(np.arange(len(left))))
+    right = right.select([right_on] + right_columns)
+    # Acero cannot join all-null columns, which pandas reads as null type
+    right = right.cast(pa.schema([
+        field.with_type(pa.string()) if pa.types.is_null(field.type) else field for field in right.schema
+    ]))
+    joined = left.join(right, keys=left_on, right_keys=right_on, join_type="left outer")
+    return joined.sort_by("__row").drop_columns(["__row"])
+
+
+def map_currency_names_arrow(currency_codes):
+    """
+    Arrow engine counterpart of map_currency_names
+
+    Args:
+        currency_codes (pyarrow.ChunkedArray): currency codes
+
+    Returns:
+        pyarrow.ChunkedArray: currency names, UNKNOWN_CURRENCY_NAME for codes missing from CURRENCY_NAMES
+    """
+
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    positions = pc.index_in(currency_codes, value_set=pa.array(list(CURRENCY_NAMES)))
+    names = pc.take(pa.array(list(CURRENCY_NAMES.values())), positions)
+    return pc.fill_null(names, UNKNOWN_CURRENCY_NAME)
+
+
+def build_dim_date_arrow(date_strings):
+    """
+    Arrow engine counterpart of build_dim_date
+
+    Args:
+        date_strings (pyarrow.Array): 'YYYY-MM-DD' dates to add to dim_date
+
+    Returns:
+        pyarrow.Table: date_id, year, month, day, day_of_week, day_name, month_name and quarter columns
+    """
+
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    date_id = pc.strptime(date_strings, format="%Y-%m-%d", unit="ns")
+    return pa.table(
+        {
+            "date_id": date_id,
+            "year": pc.year(date_id),
+            "month": pc.month(date_id),
+            "day": pc.day(date_id),
+            "day_of_week": pc.day_of_week(date_id),
+            "day_name": pc.strftime(date_id, format="%A"),
+            "month_name": pc.strftime(date_id, format="%B"),
+            "quarter": pc.quarter(date_id),
+        }
+    )
+
+
+def mvp_transform_arrow(s3_client, table_name, new_table, processed_bucket):
+    """
+    Arrow engine counterpart of mvp_transform_df, producing the same tables with pyarrow compute
+    kernels. The reference snapshots it joins against are small and shared with the pandas engine
+    through reference_cache, so they are converted rather than re-read
+
+    Args:
+        s3_client (Object): S3 client for accessing reference and state files
+        table_name (str): Name of the table being transformed
+        new_table (pyarrow.Table): Raw ingested rows to transform
+        processed_bucket (str): S3 bucket containing historical processed data
+
+    Returns:
+        dict: Dictionary of transformed pyarrow Tables keyed by their target table names
+    """
+
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    match table_name:
+        case "staff":
+            department_table = pa.Table.from_pandas(
+                latest_table_df(s3_client, "department", processed_bucket), preserve_index=False
+            )
+            dim_staff = left_join_arrow(
+                new_table, department_table, "department_id", "department_id", ["department_name", "location"]
+            )
+            return {"dim_staff": dim_staff.select(
+                ["staff_id", "first_name", "last_name", "department_name", "location", "email_address"]
+            )}
+        case "address":
+            address_table = pa.Table.from_pandas(
+                latest_table_df(s3_client, "address", processed_bucket), preserve_index=False
+            )
+            dim_location = address_table.select(
+                ["address_id", "address_line_1", "address_line_2", "district",
+                 "city", "postal_code", "country", "phone"]
+            )
+            return {"dim_location": dim_location.rename_columns(["location_id"] + dim_location.column_names[1:])}
+
+        case "counterparty":
+            address_table = pa.Table.from_pandas(
+                latest_table_df(s3_client, "address", processed_bucket), preserve_index=False
+            )
+            address_columns = ["address_line_1", "address_line_2", "district", "city", "postal_code", "country", "phone"]
+            dim_counterparty = left_join_arrow(
+                new_table, address_table, "legal_address_id", "address_id", address_columns
+            ).select(["counterparty_id", "counterparty_legal_name"] + address_columns)
+            return {"dim_counterparty": dim_counterparty.rename_columns([
+                "counterparty_id",
+                "counterparty_legal_name",
+                "counterparty_legal_address_line_1",
+                "counterparty_legal_address_line_2",
+                "counterparty_legal_district",
+                "counterparty_legal_city",
+                "counterparty_legal_postal_code",
+                "counterparty_legal_country",
+                "counterparty_legal_phone_number",
+            ])}
+
+        case "design":
+            dim_design = new_table.select(["design_id", "design_name", "file_location", "file_name"])
+            return {"dim_design": dim_design.sort_by("design_id")}
+
+        case "currency":
+            dim_currency = new_table.select(["currency_id", "currency_code"])
+            return {"dim_currency": dim_currency.append_column(
+                "currency_name", map_currency_names_arrow(dim_currency.column("currency_code"))
+            )}
+
+        case "sales_order":
+            columns = {}
+            for name in ["created_at", "last_updated"]:
+                parts = pc.extract_regex(pc.cast(new_table.column(name), pa.string()), r"^(?P<date>[^T]*)T?(?P<time>.*)$")
+                columns[name] = (pc.struct_field(parts, "date"), pc.struct_field(parts, "time"))
+            fact_sales_order = pa.table(
+                {
+                    "sales_order_id": new_table.column("sales_order_id"),
+                    "created_date": columns["created_at"][0],
+                    "created_time": columns["created_at"][1],
+                    "last_updated_date": columns["last_updated"][0],
+                    "last_updated_time": columns["last_updated"][1],
+                    "sales_staff_id": new_table.column("staff_id"),
+                    "counterparty_id": new_table.column("counterparty_id"),
+                    "units_sold": new_table.column("units_sold"),
+                    "unit_price": new_table.column("unit_price"),
+                    "currency_id": new_table.column("currency_id"),
+                    "design_id": new_table.column("design_id"),
+                    "agreed_payment_date": pc.cast(new_table.column("agreed_payment_date"), pa.string()),
+                    "agreed_delivery_date": pc.cast(new_table.column("agreed_delivery_date"), pa.string()),
+                    "agreed_delivery_location_id": new_table.column("agreed_delivery_location_id"),
+                }
+            )
+
+            # generating dim_date
+            new_dates = pa.chunked_array(
+                [
+                    chunk
+                    for name in ["created_date", "last_updated_date", "agreed_delivery_date", "agreed_payment_date"]
+                    for chunk in fact_sales_order.column(name).chunks
+                ],
+                type=pa.string(),
+            )
+            unique_new_dates = register_new_dates(s3_client, processed_bucket, new_dates)
+            if len(unique_new_dates) == 0: #no new unique dates, just return sales data
+                return {"fact_sales_order": fact_sales_order}
+
+            dim_date = build_dim_date_arrow(pa.array(unique_new_dates, type=pa.string()))
+
+            return {"dim_date": dim_date, "fact_sales_order": fact_sales_order}
+
+
+def save_arrow_to_s3(s3_client, bucket_name, transformed_dict, extract_time):
+    """
+    Arrow engine counterpart of save_parquet_to_s3, writing pyarrow Tables under the same keys
+
+    Args:
+        s3_client (Object): S3 client for writing objects
+        bucket_name (str): Target S3 bucket for storing the Parquet files
+        transformed_dict (dict): Dictionary of table names to pyarrow Tables
+        extract_time (str): timestamp string used to structure S3 keys
+
+    Returns:
+        list: List of S3 keys for the saved Parquet files
+    """
+
+    import pyarrow.parquet as pq
+
+    key_list = []
+    if not transformed_dict:
+        return key_list
+    for transform_name, new_table in transformed_dict.items():
+        date, time = extract_time.split("T")
+        key = f"dev/{transform_name}/{date}/{transform_name}_{time}.parquet"
+        buffer = BytesIO()
+        pq.write_table(new_table, buffer)
+        s3_client.put_object(Bucket=bucket_name, Body=buffer.getvalue(), Key=key)
+        key_list.append(key)
+    return key_list
 
 
 def serialise_object(obj):
@@ -4,6 +4,11 @@ resource "aws_cloudwatch_event_rule" "scheduler" {
   description = "tigger step function every 20 mins"
   schedule_expression = "rate(20 minutes)" 
   state = "ENABLED" # temporarily disabled 
+
+  # lambda_probe shortens the rate while tables keep changing and lengthens it again when they stop
+  lifecycle {
+    ignore_changes = [schedule_expression]
+  }
 }
 
 # scheduler targeting state machine 
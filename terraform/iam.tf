@@ -54,6 +54,33 @@ resource "aws_iam_role_policy_attachment" "lambda_s3_write_policy_attachment" {
   policy_arn = aws_iam_policy.s3_write_policy.arn
   }
 
+# Define policy document letting the probe lambda adjust the schedule rate
+# and check whether a previous run of the state machine is still in progress
+data "aws_iam_policy_document" "schedule_policy_doc" {
+  statement {
+    effect = "Allow"
+    actions = ["events:DescribeRule", "events:PutRule"]
+    resources = [aws_cloudwatch_event_rule.scheduler.arn]
+  }
+  statement {
+    effect = "Allow"
+    actions = ["states:ListExecutions"]
+    resources = [aws_sfn_state_machine.totes-state-machine.arn]
+  }
+}
+
+# Create schedule policy
+resource "aws_iam_policy" "schedule_policy" {
+  name = "schedule-policy-lambda_probe"
+  policy = data.aws_iam_policy_document.schedule_policy_doc.json
+}
+
+# Attach schedule policy
+resource "aws_iam_role_policy_attachment" "lambda_schedule_policy_attachment" {
+  role = aws_iam_role.iam_for_lambda.name
+  policy_arn = aws_iam_policy.schedule_policy.arn
+  }
+
 # ---------------------
 # Step function section 
 # ---------------------
@@ -87,6 +114,7 @@ data "aws_iam_policy_document" "state_machine_policy_doc" {
     effect = "Allow"
     actions = ["lambda:InvokeFunction"]
     resources = [
+      aws_lambda_function.probe_lambda.arn,
       aws_lambda_function.extract_lambda.arn, 
       aws_lambda_function.transform_lambda.arn,
       aws_lambda_function.load_lambda.arn
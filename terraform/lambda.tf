@@ -30,7 +30,9 @@ resource "aws_lambda_function" "extract_lambda" {
   handler       = "lambda_extract.lambda_extract"
   source_code_hash = data.archive_file.lambda_extract.output_base64sha256
   runtime = "python3.13"
-  layers = [aws_lambda_layer_version.extract_dependencies_layer.arn]
+  layers = [aws_lambda_layer_version.extract_dependencies_layer.arn,
+  "arn:aws:lambda:eu-west-2:336392948345:layer:AWSSDKPandas-Python313:2" # pyarrow for RAW_FORMAT = "parquet"
+  ]
   timeout = 300
 
 
@@ -43,6 +45,35 @@ resource "aws_lambda_function" "extract_lambda" {
       DBNAME = "totesys" #sample, user to change
       HOST = "sample_OTP_db" #sample, user to change
       PORT = 5432
+      RAW_FORMAT = "json" # json, ndjson.gz or parquet
+    }
+  }
+}
+
+# Probe lambda, shares the extract package and checks for changed tables before each run
+resource "aws_lambda_function" "probe_lambda" {
+  filename      = "${path.root}/deployments/lambda_extract.zip"
+  function_name = "lambda_probe"
+  role          = aws_iam_role.iam_for_lambda.arn
+  handler       = "lambda_extract.lambda_probe"
+  source_code_hash = data.archive_file.lambda_extract.output_base64sha256
+  runtime = "python3.13"
+  layers = [aws_lambda_layer_version.extract_dependencies_layer.arn]
+  timeout = 60
+
+
+  environment {
+    variables = {
+
+      BACKEND_S3 = "sample_bucket-to-hold-tf-state-for-terraform" #sample, user to change
+      INGESTION_S3 = aws_s3_bucket.ingestion_s3.bucket
+      DBUSER = "project_team_08" #sample, user to change
+      DBNAME = "totesys" #sample, user to change
+      HOST = "sample_OTP_db" #sample, user to change
+      PORT = 5432
+      SCHEDULE_RULE = aws_cloudwatch_event_rule.scheduler.name
+      SCHEDULE_MIN_MINUTES = 5
+      SCHEDULE_MAX_MINUTES = 20
     }
   }
 }
@@ -91,6 +122,8 @@ resource "aws_lambda_function" "transform_lambda" {
       BACKEND_S3 = "bucket-to-hold-tf-state-for-terraform" #sample, user to change
       INGESTION_S3 = aws_s3_bucket.ingestion_s3.bucket
       PROCESSED_S3 = aws_s3_bucket.processed_s3.bucket
+      TRANSFORM_ENGINE = "pandas" # pandas or arrow
+      TRANSFORM_WORKERS = 1 # tables transformed at the same time
     }
   }
 }
@@ -3,29 +3,14 @@ resource "aws_sfn_state_machine" "totes-state-machine" {
   name     = "totes-state-machine"
   role_arn = aws_iam_role.iam_for_state_machine.arn
 
-  definition = <<EOF
-{
-  "Comment": "returns team 8 test",
-  "StartAt": "lambda_extract",
-  "States": {
-    "lambda_extract": {
-      "Type": "Task",
-      "Resource": "${aws_lambda_function.extract_lambda.arn}",
-      "Next": "lambda_transform"
-    },
-    "lambda_transform": {
-      "Type": "Task",
-      "Resource": "${aws_lambda_function.transform_lambda.arn}",
-      "Next":"lambda_load"
-    },
-    "lambda_load": {
-    "Type": "Task",
-    "Resource": "${aws_lambda_function.load_lambda.arn}",
-    "End": true
-      }
-  }
-}
-EOF
+  # runs stop after the probe when no table has changed or a previous run is still in progress, otherwise
+  # stages run one after another, the tables of a stage are transformed and loaded 4 at a time
+  definition = templatefile("${path.module}/state_machine.asl.json", {
+    probe_lambda_arn     = aws_lambda_function.probe_lambda.arn
+    extract_lambda_arn   = aws_lambda_function.extract_lambda.arn
+    transform_lambda_arn = aws_lambda_function.transform_lambda.arn
+    load_lambda_arn      = aws_lambda_function.load_lambda.arn
+  })
 
   logging_configuration {
     log_destination        = "${aws_cloudwatch_log_group.log_group_for_sfn.arn}:*"
@@ -12,6 +12,11 @@ def db():
     yield db
     db.close()
 
+@pytest.fixture(autouse=True)
+def reset_db_connection(monkeypatch):
+    monkeypatch.setattr("src.extract.lambda_extract.db_connection", None)
+    monkeypatch.setattr("src.extract.lambda_extract.credential_cache", {})
+
 @pytest.fixture(scope='class')
 def aws_credentials():
     os.environ["aws_access_key_id"]="Test"
@@ -56,6 +61,7 @@ class TestLambdaExtract:
 
         # mock db 
         mock_db = Mock()
+        mock_db.run.return_value = [(table_name, 1) for table_name in TABLE_NAMES]
         mock_create_conn.return_value = mock_db
         
         bucket_name = "team-08-ingestion-20250528081548341900000001"
@@ -85,7 +91,7 @@ class TestLambdaExtract:
         
         result = lambda_extract(None, None)
         assert type(result) == dict
-        assert len(result) == 4
+        assert len(result) == 5
 
     def test_lambda_extract_returns_a_dict_with_correct_keys(self, mock_boto3_client, mock_create_conn, mock_save_to_s3,
                                 mock_get_data, mock_get_last_timestamps, 
@@ -96,6 +102,7 @@ class TestLambdaExtract:
         
         # mock db 
         mock_db = Mock()
+        mock_db.run.return_value = [(table_name, 1) for table_name in TABLE_NAMES]
         mock_create_conn.return_value = mock_db
 
         bucket_name = "team-08-ingestion-20250528081548341900000001"
@@ -123,7 +130,7 @@ class TestLambdaExtract:
         mock_save_to_s3.side_effect = ["dev/address/2025-06-06/address_08:53:25.773840.json"] + [None] * 10
         
         result = lambda_extract(None, None)
-        expected_keys = ["message", "timestamp", "total_new_files", "new_keys"]
+        expected_keys = ["message", "timestamp", "total_new_files", "new_keys", "work_stages"]
         for key in result:
             assert key in expected_keys
     
@@ -136,6 +143,7 @@ class TestLambdaExtract:
         
         # mock db 
         mock_db = Mock()
+        mock_db.run.return_value = [(table_name, 1) for table_name in TABLE_NAMES]
         mock_create_conn.return_value = mock_db
 
         bucket_name = "team-08-ingestion-20250528081548341900000001"
@@ -177,6 +185,7 @@ class TestLambdaExtract:
         
         # mock db 
         mock_db = Mock()
+        mock_db.run.return_value = [(table_name, 1) for table_name in TABLE_NAMES]
         mock_create_conn.return_value = mock_db
         
         bucket_name = "team-08-ingestion-20250528081548341900000001"
@@ -210,7 +219,177 @@ class TestLambdaExtract:
         assert result["timestamp"] == "2025-06-09T13:24:39.123889"
         assert result["total_new_files"] == 1
         assert result["new_keys"] == ["dev/address/2025-06-06/address_08:53:25.773840.json"]
+        assert result["work_stages"] == [[{"message": "completed ingestion", "timestamp": "2025-06-09T13:24:39.123889",
+                                           "total_new_files": 1, "new_keys": result["new_keys"]}]]
+
+
+class TestBuildWorkStages:
+    def test_keys_are_grouped_by_pipeline_stage(self):
+        new_keys = ["dev/sales_order/2025-06-06/sales_order_08:53.json", "dev/staff/2025-06-06/staff_08:53.json",
+                    "dev/address/2025-06-06/address_08:53.json", "dev/design/2025-06-06/design_08:53.json"]
+        result = build_work_stages(new_keys, "2025-06-06T08:53")
+        assert [[item["new_keys"][0].split("/")[1] for item in stage] for stage in result] == \
+            [["address", "design"], ["staff"], ["sales_order"]]
+        assert result[0][0] == {"message": "completed ingestion", "timestamp": "2025-06-06T08:53",
+                                "total_new_files": 1, "new_keys": ["dev/address/2025-06-06/address_08:53.json"]}
+
+    def test_no_keys_gives_no_stages(self):
+        assert build_work_stages([], "2025-06-06T08:53") == []
+
+class TestExtractTable:
+    @patch("src.extract.lambda_extract.get_data")
+    def test_extract_table_writes_single_object_by_default(self, mock_get_data, s3_client_with_bucket, monkeypatch):
+        extract_client, bucket_name = s3_client_with_bucket
+        monkeypatch.delenv("RAW_CHUNK_ROWS", raising=False)
+        monkeypatch.delenv("RAW_CHUNK_MB", raising=False)
+        mock_get_data.return_value = ([{'fake':1}], "2025-05-30T10:33.4323")
+        extract_time, key = extract_table(Mock(), extract_client, bucket_name, 'fake_data')
+        assert extract_time == "2025-05-30T10:33.4323"
+        assert key == "dev/fake_data/2025-05-30/fake_data_10:33.4323.json"
+
+    @patch("src.extract.lambda_extract.get_data")
+    def test_extract_table_writes_manifest_when_chunking(self, mock_get_data, s3_client_with_bucket, monkeypatch):
+        extract_client, bucket_name = s3_client_with_bucket
+        monkeypatch.setenv("RAW_CHUNK_ROWS", "1")
+        mock_get_data.return_value = ([{'fake':1}, {'fake':2}], "2025-05-30T10:33.4323")
+        _, key = extract_table(Mock(), extract_client, bucket_name, 'fake_data')
+        assert key == "dev/fake_data/2025-05-30/fake_data_10:33.4323.manifest.json"
+        assert extract_client.list_objects_v2(Bucket=bucket_name)['KeyCount'] == 3
+
+    def test_extract_table_ends_the_stream_transaction_before_returning(self, db, s3_client_with_bucket, monkeypatch):
+        extract_client, bucket_name = s3_client_with_bucket
+        monkeypatch.setenv("EXTRACT_MODE", "stream")
+        monkeypatch.setenv("RAW_CHUNK_ROWS", "3")
+        _, key = extract_table(db, extract_client, bucket_name, 'department')
+        assert key.endswith(".manifest.json")
+        assert db.run("SELECT count(*) FROM pg_cursors") == [[0]]
+
+@patch("src.extract.lambda_extract.extract_table")
+@patch("src.extract.lambda_extract.create_conn")
+class TestExtractTablesConcurrently:
+    def test_results_are_in_table_order(self, mock_create_conn, mock_extract_table):
+        mock_create_conn.side_effect = lambda _: Mock()
+        mock_extract_table.side_effect = lambda db, client, bucket, table_name, last_extract: (
+            last_extract, f"dev/{table_name}.json")
+        table_names = ["address", "counterparty", "currency", "department"]
+        last_timestamp_dict = {table_name: f"2025-06-0{i}" for i, table_name in enumerate(table_names)}
+
+        result = extract_tables_concurrently(Mock(), "test_bucket", table_names, last_timestamp_dict, 3)
+
+        assert result == [(last_timestamp_dict[table_name], f"dev/{table_name}.json") for table_name in table_names]
+
+    def test_pool_is_bounded_and_connections_closed(self, mock_create_conn, mock_extract_table):
+        conns = []
+        def new_conn(_):
+            conns.append(Mock())
+            return conns[-1]
+        mock_create_conn.side_effect = new_conn
+        mock_extract_table.return_value = ("2025-06-09T13:24:39.123889", None)
+
+        extract_tables_concurrently(Mock(), "test_bucket", ["address"] * 11, {}, 4)
+
+        assert len(conns) == 4
+        assert all(conn.close.called for conn in conns)
 
+    def test_errors_are_raised_after_closing_connections(self, mock_create_conn, mock_extract_table):
+        conn = Mock()
+        mock_create_conn.return_value = conn
+        mock_extract_table.side_effect = RuntimeError("upload failed")
+
+        with pytest.raises(RuntimeError):
+            extract_tables_concurrently(Mock(), "test_bucket", ["address", "staff"], {}, 2)
+        assert conn.close.called
+
+@patch("src.extract.lambda_extract.get_conn")
+@patch("src.extract.lambda_extract.extract_tables_concurrently")
+@patch("src.extract.lambda_extract.boto3.client")
+class TestLambdaExtractConcurrently:
+    def test_lambda_extract_uses_worker_pool(self, mock_boto3_client, mock_extract_concurrently, mock_get_conn,
+                                             s3_client_with_bucket, monkeypatch):
+        s3_client, bucket_name = s3_client_with_bucket
+        mock_get_conn.return_value.run.return_value = [(table_name, 1) for table_name in TABLE_NAMES]
+        mock_boto3_client.return_value = s3_client
+        monkeypatch.setenv("INGESTION_S3", bucket_name)
+        monkeypatch.setenv("EXTRACT_WORKERS", "4")
+        mock_extract_concurrently.return_value = [("2025-06-09T13:24:39.123889", None)] * 10 + [
+            ("2025-06-09T13:24:39.123889", "dev/sales_order/2025-06-09/sales_order_13:24:39.123889.json")]
+
+        result = lambda_extract(None, None)
+
+        assert mock_extract_concurrently.call_args.args[4] == 4
+        assert result["new_keys"] == ["dev/sales_order/2025-06-09/sales_order_13:24:39.123889.json"]
+        timestamps, _ = get_last_timestamps(s3_client, bucket_name)
+        assert timestamps["sales_order"] == "2025-06-09T13:24:39.123889"
+
+    def test_lambda_extract_keeps_timestamps_when_a_table_fails(self, mock_boto3_client, mock_extract_concurrently, mock_get_conn,
+                                                                s3_client_with_bucket, monkeypatch):
+        s3_client, bucket_name = s3_client_with_bucket
+        mock_get_conn.return_value.run.return_value = [(table_name, 1) for table_name in TABLE_NAMES]
+        mock_boto3_client.return_value = s3_client
+        monkeypatch.setenv("INGESTION_S3", bucket_name)
+        monkeypatch.setenv("EXTRACT_WORKERS", "4")
+        mock_extract_concurrently.side_effect = RuntimeError("upload failed")
+
+        with pytest.raises(RuntimeError):
+            lambda_extract(None, None)
+        timestamps, _ = get_last_timestamps(s3_client, bucket_name)
+        assert timestamps == {}
+
+@patch("src.extract.lambda_extract.extract_table")
+@patch("src.extract.lambda_extract.get_conn")
+@patch("src.extract.lambda_extract.boto3.client")
+class TestLambdaExtractChangedTables:
+    def test_only_changed_tables_are_extracted(self, mock_boto3_client, mock_get_conn, mock_extract_table,
+                                               s3_client_with_bucket, monkeypatch):
+        s3_client, bucket_name = s3_client_with_bucket
+        mock_boto3_client.return_value = s3_client
+        monkeypatch.setenv("INGESTION_S3", bucket_name)
+        monkeypatch.delenv("EXTRACT_WORKERS", raising=False)
+        last_timestamps = {table_name: "2025-06-09T14:09:23.675428" for table_name in TABLE_NAMES}
+        s3_client.put_object(Bucket=bucket_name, Key="db_state/extraction_timestamps.json", Body=json.dumps(last_timestamps))
+        mock_get_conn.return_value.run.return_value = [(table_name, int(table_name == "staff")) for table_name in TABLE_NAMES]
+        mock_extract_table.return_value = ("2025-06-10T10:04:36.847261", "dev/staff/2025-06-10/staff_10:04:36.847261.json")
+
+        result = lambda_extract(None, None)
+
+        assert [call.args[3] for call in mock_extract_table.call_args_list] == ["staff"]
+        assert result["new_keys"] == ["dev/staff/2025-06-10/staff_10:04:36.847261.json"]
+        timestamps, _ = get_last_timestamps(s3_client, bucket_name)
+        assert timestamps == {**last_timestamps, "staff": "2025-06-10T10:04:36.847261"}
+        assert result["timestamp"] > "2025-06-10T10:04:36.847261"
+
+    def test_nothing_changed_extracts_no_tables(self, mock_boto3_client, mock_get_conn, mock_extract_table,
+                                                s3_client_with_bucket, monkeypatch):
+        s3_client, bucket_name = s3_client_with_bucket
+        mock_boto3_client.return_value = s3_client
+        monkeypatch.setenv("INGESTION_S3", bucket_name)
+        monkeypatch.setenv("EXTRACT_WORKERS", "4")
+        last_timestamps = {table_name: "2025-06-09T14:09:23.675428" for table_name in TABLE_NAMES}
+        s3_client.put_object(Bucket=bucket_name, Key="db_state/extraction_timestamps.json", Body=json.dumps(last_timestamps))
+        mock_get_conn.return_value.run.return_value = [(table_name, 0) for table_name in TABLE_NAMES]
+
+        result = lambda_extract(None, None)
+
+        mock_extract_table.assert_not_called()
+        assert result["total_new_files"] == 0
+        assert result["work_stages"] == []
+        timestamps, _ = get_last_timestamps(s3_client, bucket_name)
+        assert timestamps == last_timestamps
+
+    def test_changed_tables_from_probe_are_not_counted_again(self, mock_boto3_client, mock_get_conn, mock_extract_table,
+                                                             s3_client_with_bucket, monkeypatch):
+        s3_client, bucket_name = s3_client_with_bucket
+        mock_boto3_client.return_value = s3_client
+        monkeypatch.setenv("INGESTION_S3", bucket_name)
+        monkeypatch.delenv("EXTRACT_WORKERS", raising=False)
+        last_timestamps = {table_name: "2025-06-09T14:09:23.675428" for table_name in TABLE_NAMES}
+        s3_client.put_object(Bucket=bucket_name, Key="db_state/extraction_timestamps.json", Body=json.dumps(last_timestamps))
+        mock_extract_table.return_value = ("2025-06-10T10:04:36.847261", None)
+
+        lambda_extract({"changed": True, "changed_tables": ["staff", "address"]}, None)
+
+        assert [call.args[3] for call in mock_extract_table.call_args_list] == ["address", "staff"]
+        mock_get_conn.return_value.run.assert_not_called()
 
 class TestGetDataFunction:    
     def test_get_data_from_database_first_ingestion(self, db):
@@ -218,9 +397,7 @@ class TestGetDataFunction:
         assert isinstance(new_dict_list, list)
         assert len(new_dict_list) >= 8
         assert isinstance(new_dict_list[0], dict)
-        for key in ["department_id", "department_name", "location", 
-                    "manager", "created_at", "last_updated"]:
-            assert key in new_dict_list[0].keys()
+        assert list(new_dict_list[0]) == ["department_id", "department_name", "location", "last_updated"]
         assert isinstance(extract_time, str)
 
     def test_get_data_when_there_are_no_updates(self, db):
@@ -234,6 +411,53 @@ class TestGetDataFunction:
         assert new_dict_list == []
         assert extract_time == last_extract
 
+class TestBuildQuery:
+    def test_build_query_without_last_extract(self):
+        assert build_query("payment") == "SELECT * FROM payment"
+
+    def test_build_query_with_last_extract(self):
+        result = build_query("payment", "2025-05-28")
+        assert result == "SELECT * FROM payment WHERE last_updated > '2025-05-28'"
+
+    def test_build_query_selects_extract_columns(self):
+        result = build_query("department", "2025-05-28")
+        assert result == ("SELECT department_id, department_name, location, last_updated FROM department "
+                          "WHERE last_updated > '2025-05-28'")
+
+class TestStreamData:
+    def test_stream_data_yields_batches_of_rows(self, db):
+        with stream_data(db, "department", batch_size=3) as (batches, extract_time):
+            batch_list = list(batches)
+        assert isinstance(extract_time, str)
+        assert all(len(batch) <= 3 for batch in batch_list)
+        rows = [row for batch in batch_list for row in batch]
+        assert len(rows) >= 8
+        assert list(rows[0]) == ["department_id", "department_name", "location", "last_updated"]
+
+    def test_stream_data_when_there_are_no_updates(self, db):
+        with stream_data(db, "department", "2025-05-28") as (batches, _):
+            assert list(batches) == []
+
+    def test_stream_data_handles_DataBaseError(self, db):
+        last_extract = "2025-04-04"
+        with stream_data(db, "fake_table", last_extract) as (batches, extract_time):
+            assert list(batches) == []
+        assert extract_time == last_extract
+        assert db.run("SELECT 1") == [[1]]
+
+    def test_transaction_ends_with_the_block_even_if_batches_are_not_read(self, db):
+        with stream_data(db, "department", batch_size=3) as (batches, _):
+            next(batches)
+            assert db.run("SELECT count(*) FROM pg_cursors") == [[1]]
+        assert db.run("SELECT count(*) FROM pg_cursors") == [[0]]
+
+    def test_transaction_is_rolled_back_when_the_block_raises(self, db):
+        with pytest.raises(RuntimeError):
+            with stream_data(db, "department", batch_size=3) as (batches, _):
+                next(batches)
+                raise RuntimeError("upload failed")
+        assert db.run("SELECT count(*) FROM pg_cursors") == [[0]]
+
 class TestSaveToS3:
     def test_save_to_s3_when_sql_table_has_values(self, s3_client_with_bucket):
         extract_client, bucket_name = s3_client_with_bucket
@@ -256,6 +480,189 @@ class TestSaveToS3:
         result = save_to_s3(extract_client, bucket_name, new_dict_list, table_name, extract_time)
         assert result == None
 
+class TestSaveStreamToS3:
+    def test_save_stream_to_s3_writes_all_batches(self, s3_client_with_bucket):
+        extract_client, bucket_name = s3_client_with_bucket
+        extract_time = "2025-05-30T10:33.4323"
+        batches = iter([[{'fake':1}, {'fake':2}], [{'fake':3}]])
+        table_name = 'fake_data'
+        expected_key = f"dev/{table_name}/2025-05-30/{table_name}_10:33.4323.json"
+        result = save_stream_to_s3(extract_client, bucket_name, batches, table_name, extract_time)
+        assert result == expected_key
+        file_content = extract_client.get_object(Bucket=bucket_name, Key= expected_key)
+        file_dict = json.loads(file_content["Body"].read().decode("utf-8"))
+        assert file_dict == [{'fake':1}, {'fake':2}, {'fake':3}]
+
+    def test_save_stream_to_s3_when_there_are_no_rows(self, s3_client_with_bucket):
+        extract_client, bucket_name = s3_client_with_bucket
+        result = save_stream_to_s3(extract_client, bucket_name, iter([]), 'fake_data', "2025-05-30T10:33.4323")
+        assert result == None
+        assert extract_client.list_objects_v2(Bucket=bucket_name)['KeyCount'] == 0
+
+class TestSaveChunksToS3:
+    def test_save_chunks_to_s3_splits_rows_by_max_rows(self, s3_client_with_bucket):
+        extract_client, bucket_name = s3_client_with_bucket
+        extract_time = "2025-05-30T10:33.4323"
+        batches = [[{'fake':i} for i in range(5)]]
+        result = save_chunks_to_s3(extract_client, bucket_name, batches, 'fake_data', extract_time, max_rows=2)
+        assert result == "dev/fake_data/2025-05-30/fake_data_10:33.4323.manifest.json"
+        manifest_content = extract_client.get_object(Bucket=bucket_name, Key=result)
+        manifest = json.loads(manifest_content["Body"].read().decode("utf-8"))
+        assert manifest["total_rows"] == 5
+        assert [chunk["rows"] for chunk in manifest["chunks"]] == [2, 2, 1]
+        assert manifest["chunks"][0]["key"] == "dev/fake_data/2025-05-30/fake_data_10:33.4323/part_00000.json"
+        rows = []
+        for chunk in manifest["chunks"]:
+            chunk_content = extract_client.get_object(Bucket=bucket_name, Key=chunk["key"])
+            body = chunk_content["Body"].read()
+            assert len(body) == chunk["bytes"]
+            rows += json.loads(body.decode("utf-8"))
+        assert rows == batches[0]
+
+    def test_save_chunks_to_s3_splits_rows_by_max_bytes(self, s3_client_with_bucket):
+        extract_client, bucket_name = s3_client_with_bucket
+        batches = iter([[{'fake':'x' * 100}] * 3, [{'fake':'y' * 100}] * 3])
+        result = save_chunks_to_s3(extract_client, bucket_name, batches, 'fake_data', "2025-05-30T10:33.4323", max_bytes=250)
+        manifest_content = extract_client.get_object(Bucket=bucket_name, Key=result)
+        manifest = json.loads(manifest_content["Body"].read().decode("utf-8"))
+        assert manifest["total_rows"] == 6
+        assert [chunk["rows"] for chunk in manifest["chunks"]] == [2, 2, 2]
+        assert all(chunk["bytes"] <= 250 for chunk in manifest["chunks"])
+
+    def test_save_chunks_to_s3_when_there_are_no_rows(self, s3_client_with_bucket):
+        extract_client, bucket_name = s3_client_with_bucket
+        result = save_chunks_to_s3(extract_client, bucket_name, [[]], 'fake_data', "2025-05-30T10:33.4323", max_rows=2)
+        assert result == None
+        assert extract_client.list_objects_v2(Bucket=bucket_name)['KeyCount'] == 0
+
+class TestRawFormats:
+    rows = [{'id': 1, 'name': 'a', 'price': Decimal('3.21'), 'note': None,
+             'last_updated': datetime(2025, 6, 6, 9, 22, 10, 153000)},
+            {'id': 2, 'name': "o'b", 'price': Decimal('10.00'), 'note': None,
+             'last_updated': datetime(2025, 6, 7, 9, 22, 10, 153000)}]
+
+    def test_serialise_rows_as_json(self):
+        result = json.loads(serialise_rows(self.rows, "json"))
+        assert result[1]['price'] == 10.0
+        assert result[0]['last_updated'] == "2025-06-06T09:22:10.153000"
+
+    def test_serialise_rows_as_ndjson_gz(self):
+        lines = gzip.decompress(serialise_rows(self.rows, "ndjson.gz")).splitlines()
+        assert [json.loads(line) for line in lines] == json.loads(serialise_rows(self.rows, "json"))
+
+    def test_serialise_rows_as_parquet(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pq.read_table(BytesIO(serialise_rows(self.rows, "parquet")))
+        assert table.num_rows == 2
+        assert pa.types.is_integer(table.schema.field('id').type)
+        assert pa.types.is_floating(table.schema.field('price').type)
+        assert pa.types.is_timestamp(table.schema.field('last_updated').type)
+        assert pa.types.is_string(table.schema.field('note').type)
+        assert table.column('name').to_pylist() == ['a', "o'b"]
+
+    def test_serialise_rows_raises_ValueError_for_unknown_format(self):
+        with pytest.raises(ValueError):
+            serialise_rows(self.rows, "csv")
+
+    def test_save_to_s3_uses_format_suffix(self, s3_client_with_bucket):
+        extract_client, bucket_name = s3_client_with_bucket
+        result = save_to_s3(extract_client, bucket_name, self.rows, 'fake_data', "2025-05-30T10:33.4323", "ndjson.gz")
+        assert result == "dev/fake_data/2025-05-30/fake_data_10:33.4323.ndjson.gz"
+        body = extract_client.get_object(Bucket=bucket_name, Key=result)["Body"].read()
+        # gzip headers hold the compression time, so the contents are compared
+        assert gzip.decompress(body) == gzip.decompress(serialise_rows(self.rows, "ndjson.gz"))
+
+    def test_save_stream_to_s3_as_ndjson_gz(self, s3_client_with_bucket):
+        extract_client, bucket_name = s3_client_with_bucket
+        result = save_stream_to_s3(extract_client, bucket_name, iter([self.rows[:1], self.rows[1:]]),
+                                   'fake_data', "2025-05-30T10:33.4323", "ndjson.gz")
+        body = extract_client.get_object(Bucket=bucket_name, Key=result)["Body"].read()
+        assert gzip.decompress(body) == gzip.decompress(serialise_rows(self.rows, "ndjson.gz"))
+
+    def test_save_stream_to_s3_as_parquet(self, s3_client_with_bucket):
+        import pyarrow.parquet as pq
+        extract_client, bucket_name = s3_client_with_bucket
+        result = save_stream_to_s3(extract_client, bucket_name, iter([self.rows[:1], [], self.rows[1:]]),
+                                   'fake_data', "2025-05-30T10:33.4323", "parquet")
+        assert result == "dev/fake_data/2025-05-30/fake_data_10:33.4323.parquet"
+        body = extract_client.get_object(Bucket=bucket_name, Key=result)["Body"].read()
+        table = pq.read_table(BytesIO(body))
+        assert table.column('id').to_pylist() == [1, 2]
+        assert table.column('price').to_pylist() == [3.21, 10.0]
+
+    def test_save_chunks_to_s3_as_parquet(self, s3_client_with_bucket):
+        import pyarrow.parquet as pq
+        extract_client, bucket_name = s3_client_with_bucket
+        result = save_chunks_to_s3(extract_client, bucket_name, [self.rows], 'fake_data', "2025-05-30T10:33.4323",
+                                   max_rows=1, raw_format="parquet")
+        manifest = json.loads(extract_client.get_object(Bucket=bucket_name, Key=result)["Body"].read())
+        assert manifest["raw_format"] == "parquet"
+        assert manifest["chunks"][1]["key"] == "dev/fake_data/2025-05-30/fake_data_10:33.4323/part_00001.parquet"
+        body = extract_client.get_object(Bucket=bucket_name, Key=manifest["chunks"][1]["key"])["Body"].read()
+        assert pq.read_table(BytesIO(body)).column('id').to_pylist() == [2]
+
+class TestTypedEncoding:
+    rows = [{'sales_order_id': 1, 'created_at': datetime(2025, 6, 6, 9, 22, 10, 153000),
+             'last_updated': datetime(2025, 6, 6, 9, 22, 10, 153000), 'design_id': 3, 'staff_id': 7,
+             'counterparty_id': None, 'units_sold': 100, 'unit_price': Decimal('3.21'), 'currency_id': 2,
+             'agreed_delivery_date': '2025-06-08', 'agreed_payment_date': 'caf\u00e9 "x"',
+             'agreed_delivery_location_id': 4}]
+
+    @pytest.mark.parametrize("raw_format", ["json", "ndjson.gz"])
+    def test_row_encoder_matches_encode_row(self, raw_format):
+        encode = row_encoder("sales_order", raw_format)
+        assert encode(self.rows[0]) == encode_row(self.rows[0], raw_format)
+
+    def test_non_finite_floats_are_written_as_null(self):
+        encode = row_encoder("sales_order", "ndjson.gz")
+        for value in [float("nan"), float("inf"), Decimal("NaN"), Decimal("-Infinity")]:
+            assert json.loads(encode({**self.rows[0], 'unit_price': value}))['unit_price'] is None
+
+    def test_values_of_other_types_fall_back_to_serialise_object(self):
+        row = {**self.rows[0], 'units_sold': Decimal('5.5'), 'staff_id': True, 'agreed_delivery_date': 20250608,
+               'created_at': "2025-06-06T09:22:10"}
+        encode = row_encoder("sales_order", "ndjson.gz")
+        assert encode(row) == encode_row(row, "ndjson.gz")
+        with pytest.raises(TypeError):
+            encode({**row, 'design_id': object()})
+
+    def test_serialise_rows_as_json_with_extract_columns(self):
+        result = json.loads(serialise_rows(self.rows, "json", "sales_order"))
+        assert result == json.loads(serialise_rows(self.rows, "json"))
+
+    def test_serialise_rows_as_parquet_uses_declared_types(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pq.read_table(BytesIO(serialise_rows(self.rows, "parquet", "sales_order")))
+        assert table.schema == arrow_schema("sales_order")
+        assert pa.types.is_integer(table.schema.field('counterparty_id').type)
+        assert table.column('unit_price').to_pylist() == [3.21]
+
+    def test_tables_without_extract_columns_have_no_schema(self):
+        assert arrow_schema("payment") is None
+
+    def test_save_chunks_to_s3_as_parquet_sizes_chunks_by_arrow_bytes(self, s3_client_with_bucket):
+        import pyarrow.parquet as pq
+        extract_client, bucket_name = s3_client_with_bucket
+        batches = iter([[{'id': i, 'text': 'x' * 1000} for i in range(3)], [], [{'id': 3, 'text': 'y' * 1000}] * 2])
+        with patch("src.extract.lambda_extract.encode_row") as mock_encode_row:
+            result = save_chunks_to_s3(extract_client, bucket_name, batches, 'fake_data', "2025-05-30T10:33.4323",
+                                       max_bytes=2500, raw_format="parquet")
+        mock_encode_row.assert_not_called()
+        manifest = json.loads(extract_client.get_object(Bucket=bucket_name, Key=result)["Body"].read())
+        assert [chunk["rows"] for chunk in manifest["chunks"]] == [2, 2, 1]
+        ids = []
+        for chunk in manifest["chunks"]:
+            body = extract_client.get_object(Bucket=bucket_name, Key=chunk["key"])["Body"].read()
+            ids += pq.read_table(BytesIO(body)).column('id').to_pylist()
+        assert ids == [0, 1, 2, 3, 3]
+
+    def test_iter_arrow_chunks_gives_a_larger_row_its_own_chunk(self):
+        batches = [[{'id': 1, 'text': 'x'}, {'id': 2, 'text': 'y' * 5000}, {'id': 3, 'text': 'z'}]]
+        chunks = list(iter_arrow_chunks(batches, max_bytes=100))
+        assert [chunk.column('id').to_pylist() for chunk in chunks] == [[1], [2], [3]]
+
 class TestGetLastTimeStamps:
     def test_get_last_timestamps_returns_dict_and_key(self, s3_client_with_bucket):
         s3_client, bucket_name = s3_client_with_bucket
@@ -265,6 +672,145 @@ class TestGetLastTimeStamps:
         assert type(result[0]) == dict
         assert type(result[1]) == str
 
+class TestCountChangedRows:
+    def test_counts_rows_updated_since_last_extract(self, db):
+        latest = db.run("SELECT max(last_updated) FROM address")[0][0]
+        last_timestamps = {"address": latest.isoformat(), "staff": "2000-01-01T00:00:00"}
+        result = count_changed_rows(db, ["address", "staff", "design"], last_timestamps)
+
+        assert result == {"address": 0,
+                          "staff": db.run("SELECT count(*) FROM staff")[0][0],
+                          "design": db.run("SELECT count(*) FROM design")[0][0]}
+
+    def test_a_failing_table_does_not_stop_the_others(self, db):
+        result = count_changed_rows(db, ["address", "fake_table"], {})
+
+        assert result == {"address": db.run("SELECT count(*) FROM address")[0][0], "fake_table": None}
+        assert find_changed_tables(["address", "fake_table"], result,
+                                   {"address": "2000-01-01T00:00:00", "fake_table": "2000-01-01T00:00:00"}) == ["address", "fake_table"]
+
+class TestFindChangedTables:
+    def test_tables_with_new_rows_or_never_extracted_have_changed(self):
+        changed_rows = {"address": 2, "staff": 0, "currency": 0, "design": 0}
+        last_timestamps = {"address": "2025-06-09T14:09:23.675428", "staff": "2025-06-09T14:09:23.728582",
+                           "currency": "2025-06-09T14:09:23.685458"}
+        assert find_changed_tables(list(changed_rows), changed_rows, last_timestamps) == ["address", "design"]
+
+class TestAdaptSchedule:
+    @pytest.fixture
+    def events_client(self, aws_credentials):
+        with mock_aws():
+            events_client = boto3.client("events", region_name="eu-west-2")
+            events_client.put_rule(Name="trigger_step_function", ScheduleExpression="rate(20 minutes)",
+                                   Description="trigger step function", State="ENABLED")
+            yield events_client
+
+    def test_interval_halves_while_tables_change_down_to_minimum(self, events_client):
+        intervals = [adapt_schedule(events_client, "trigger_step_function", True, 5, 20) for _ in range(3)]
+        rule = events_client.describe_rule(Name="trigger_step_function")
+
+        assert intervals == [10, 5, 5]
+        assert rule["ScheduleExpression"] == "rate(5 minutes)"
+        assert rule["Description"] == "trigger step function"
+
+    def test_interval_doubles_while_unchanged_up_to_maximum(self, events_client):
+        events_client.put_rule(Name="trigger_step_function", ScheduleExpression="rate(1 minute)")
+        intervals = [adapt_schedule(events_client, "trigger_step_function", False, 1, 20) for _ in range(6)]
+
+        assert intervals == [2, 4, 8, 16, 20, 20]
+        assert events_client.describe_rule(Name="trigger_step_function")["ScheduleExpression"] == "rate(20 minutes)"
+
+    def test_rate_expressions(self):
+        assert parse_rate("rate(1 hour)") == 60
+        assert rate_expression(1) == "rate(1 minute)"
+        with pytest.raises(ValueError):
+            parse_rate("cron(0 12 * * ? *)")
+
+@patch("src.extract.lambda_extract.count_changed_rows")
+@patch("src.extract.lambda_extract.create_conn")
+class TestLambdaProbe:
+    def test_reports_changed_tables_without_schedule_rule(self, mock_create_conn, mock_count_changed_rows,
+                                                         s3_client_with_bucket, monkeypatch):
+        s3_client, bucket_name = s3_client_with_bucket
+        monkeypatch.setenv("INGESTION_S3", bucket_name)
+        monkeypatch.delenv("SCHEDULE_RULE", raising=False)
+        s3_client.put_object(Bucket=bucket_name, Key="db_state/extraction_timestamps.json",
+                             Body=json.dumps({table_name: "2025-06-09T14:09:23.675428" for table_name in TABLE_NAMES}))
+        mock_count_changed_rows.return_value = {table_name: 0 for table_name in TABLE_NAMES}
+
+        result = lambda_probe({}, None)
+        assert result["changed"] is False
+        assert result["changed_tables"] == []
+        assert result["interval_minutes"] is None
+
+        mock_count_changed_rows.return_value = {table_name: int(table_name == "address") for table_name in TABLE_NAMES}
+        result = lambda_probe({}, None)
+        assert result["changed"] is True
+        assert result["changed_tables"] == ["address"]
+
+    @pytest.fixture
+    def state_machine(self, s3_client):
+        sfn_client = boto3.client("stepfunctions", region_name="eu-west-2")
+        state_machine_arn = sfn_client.create_state_machine(
+            name="totes-state-machine", roleArn="arn:aws:iam::123456789012:role/iam_for_state_machine",
+            definition=json.dumps({"StartAt": "done", "States": {"done": {"Type": "Succeed"}}}))["stateMachineArn"]
+        return sfn_client, state_machine_arn
+
+    def test_skips_while_another_execution_is_running(self, mock_create_conn, mock_count_changed_rows,
+                                                      state_machine, monkeypatch):
+        sfn_client, state_machine_arn = state_machine
+        monkeypatch.setattr("boto3.client", lambda service_name: sfn_client)
+        previous = sfn_client.start_execution(stateMachineArn=state_machine_arn, name="previous")["executionArn"]
+        current = sfn_client.start_execution(stateMachineArn=state_machine_arn, name="current")["executionArn"]
+
+        assert other_running_executions(sfn_client, current) == [previous]
+        result = lambda_probe({"execution_arn": current}, None)
+        assert result["changed"] is False
+        assert result["changed_tables"] == []
+        mock_count_changed_rows.assert_not_called()
+        mock_create_conn.assert_not_called()
+
+    def test_runs_when_no_other_execution_is_running(self, mock_create_conn, mock_count_changed_rows,
+                                                     state_machine, s3_client_with_bucket, monkeypatch):
+        sfn_client, state_machine_arn = state_machine
+        s3_client, bucket_name = s3_client_with_bucket
+        monkeypatch.setenv("INGESTION_S3", bucket_name)
+        monkeypatch.delenv("SCHEDULE_RULE", raising=False)
+        monkeypatch.setattr("boto3.client", lambda service_name: sfn_client if service_name == "stepfunctions" else s3_client)
+        current = sfn_client.start_execution(stateMachineArn=state_machine_arn, name="current")["executionArn"]
+        finished = sfn_client.start_execution(stateMachineArn=state_machine_arn, name="finished")["executionArn"]
+        sfn_client.stop_execution(executionArn=finished)
+        mock_count_changed_rows.return_value = {table_name: 1 for table_name in TABLE_NAMES}
+
+        assert other_running_executions(sfn_client, current) == []
+        result = lambda_probe({"execution_arn": current}, None)
+        assert result["changed"] is True
+        assert result["changed_tables"] == TABLE_NAMES
+
+@patch("src.extract.lambda_extract.create_conn")
+class TestGetConn:
+    def test_connection_is_reused_while_healthy(self, mock_create_conn):
+        assert get_conn(None) is get_conn(None)
+        assert mock_create_conn.call_count == 1
+
+    def test_connection_is_replaced_when_check_fails(self, mock_create_conn):
+        broken_conn = Mock()
+        broken_conn.run.side_effect = InterfaceError("network error")
+        new_conn = Mock()
+        mock_create_conn.side_effect = [broken_conn, new_conn]
+        get_conn(None)
+
+        assert get_conn(None) is new_conn
+        broken_conn.close.assert_called_once()
+
+    def test_close_conn_closes_the_connection(self, mock_create_conn):
+        conn = get_conn(None)
+        close_conn()
+
+        conn.close.assert_called_once()
+        get_conn(None)
+        assert mock_create_conn.call_count == 2
+
 class TestGetDbPassword:
     def test_get_db_password_returns_str(self, s3_client):
         extract_client = s3_client
@@ -277,6 +823,35 @@ class TestGetDbPassword:
         assert type(result) == str
         assert result == "password" 
 
+class TestGetCredential:
+    def test_credential_is_cached_within_ttl(self, monkeypatch):
+        monkeypatch.setenv("BACKEND_S3", "backend_bucket")
+        mock_client = Mock()
+        mock_client.get_object.side_effect = lambda **_: {"Body": BytesIO(b'{"totesys": "password"}')}
+
+        assert get_credential(mock_client, "totesys") == "password"
+        assert get_credential(mock_client, "totesys") == "password"
+        assert mock_client.get_object.call_count == 1
+
+    def test_credential_is_read_again_after_ttl(self, monkeypatch):
+        monkeypatch.setenv("CREDENTIAL_BACKEND", "env")
+        monkeypatch.setenv("CREDENTIAL_TTL", "0")
+        monkeypatch.setenv("TOTESYS_PASSWORD", "old_password")
+        assert get_db_password(None) == "old_password"
+
+        monkeypatch.setenv("TOTESYS_PASSWORD", "new_password")
+        assert get_db_password(None) == "new_password"
+
+    def test_file_backend_reads_json_file(self, monkeypatch):
+        monkeypatch.setenv("CREDENTIAL_BACKEND", "file")
+        monkeypatch.setenv("CREDENTIALS_FILE", "tests/data/secrets.json")
+        assert get_db_password(None) == "password"
+
+    def test_unknown_backend_raises_ValueError(self, monkeypatch):
+        monkeypatch.setenv("CREDENTIAL_BACKEND", "vault")
+        with pytest.raises(ValueError):
+            get_db_password(None)
+
 class TestSerialiseObjectFunction:
     def test_serialise_object_returns_isoformat(self):
         test_datetime = datetime(2025, 6, 6, 9, 22, 10, 153000) 
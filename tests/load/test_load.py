@@ -8,6 +8,11 @@ import dotenv
 from pg8000.native import Connection
 
 
+@pytest.fixture(autouse=True)
+def reset_db_connection(monkeypatch):
+    monkeypatch.setattr("src.load.lambda_load.db_connection", None)
+    monkeypatch.setattr("src.load.lambda_load.credential_cache", {})
+
 @pytest.fixture 
 def aws_credentials():
     os.environ["aws_access_key_id"]="test"
@@ -140,6 +145,230 @@ class TestDFInsertToWarehouseFunction:
         assert result[0][1] == result[1][1]
         assert result[0][8] != result[1][8] and result[1][8] == 200
 
+class TestCopyDFIntoWarehouseFunction:
+
+    def test_df_copied_into_empty_warehouse_table(self, test_db):
+        df = pd.read_parquet(f"tests/data/dim_location.parquet")
+        result = copy_df_into_warehouse(test_db, df, "dim_location", chunk_rows=7)
+        db_content = test_db.run("SELECT * FROM dim_location ORDER BY location_id;")
+        assert result == {"dim_location": 30}
+        assert len(db_content) == 30
+        assert db_content[0][0] == 1
+        assert db_content[0][4] == "New Patienceburgh"
+        assert db_content[1][4] == "Aliso Viejo"
+        assert db_content[1][3] == None
+
+        fact_df = pd.read_parquet(f"tests/data/fact_sales_order.parquet")
+        fact_result = copy_df_into_warehouse(test_db, fact_df, "fact_sales_order")
+        fact_content = test_db.run("SELECT * FROM fact_sales_order;")
+        assert fact_result == {"fact_sales_order": 1}
+        assert fact_content[0][1] == 14549
+        assert fact_content[0][11] == 322
+
+    def test_copy_returns_error_for_missing_table(self, test_db):
+        df = pd.read_parquet(f"tests/data/dim_location.parquet")
+        result = copy_df_into_warehouse(test_db, df, "fake_table")
+        assert isinstance(result["fake_table"], DatabaseError)
+
+class TestExecutemanyDFIntoWarehouseFunction:
+
+    def test_df_inserted_in_batches(self, test_db):
+        df = pd.read_parquet(f"tests/data/dim_location.parquet")
+        df.loc[0, "address_line_1"] = "6826 O'Herzog Via"
+        result = executemany_df_into_warehouse(test_db, df, "dim_location", batch_rows=7)
+        db_content = test_db.run("SELECT * FROM dim_location ORDER BY location_id;")
+        assert result == {"dim_location": 30}
+        assert len(db_content) == 30
+        assert db_content[0][1] == "6826 O'Herzog Via"
+        assert db_content[1][4] == "Aliso Viejo"
+        assert db_content[1][3] == None
+
+        fact_df = pd.read_parquet(f"tests/data/fact_sales_order.parquet")
+        fact_result = executemany_df_into_warehouse(test_db, fact_df, "fact_sales_order")
+        fact_content = test_db.run("SELECT * FROM fact_sales_order;")
+        assert fact_result == {"fact_sales_order": 1}
+        assert fact_content[0][1] == 14549
+        assert str(fact_content[0][9]) == "3.21"
+
+    def test_failed_batch_rolls_back_whole_table(self, test_db):
+        df = pd.read_parquet(f"tests/data/dim_location.parquet")
+        df["location_id"] = df["location_id"].astype(object)
+        df.loc[20, "location_id"] = "not a number"
+        result = executemany_df_into_warehouse(test_db, df, "dim_location", batch_rows=7)
+        assert isinstance(result["dim_location"], DatabaseError)
+        assert test_db.run("SELECT count(*) FROM dim_location;") == [[30]]
+
+class TestMergeDFIntoWarehouseFunction:
+
+    def test_dimension_rows_are_inserted_then_updated(self, test_db):
+        test_db.run('DROP TABLE IF EXISTS dim_location;')
+        test_db.run("""CREATE TABLE dim_location (
+                location_id int PRIMARY KEY,
+                address_line_1 varchar,
+                address_line_2 varchar,
+                district varchar,
+                city varchar,
+                postal_code varchar,
+                country varchar,
+                phone varchar);""")
+        df = pd.read_parquet(f"tests/data/dim_location.parquet")
+        result = merge_df_into_warehouse(test_db, df, "dim_location")
+        assert result == {"dim_location": 30}
+
+        update_df = df.loc[[1, 1, 2]].reset_index(drop=True)
+        update_df.loc[0, "city"] = "Superseded"
+        update_df.loc[1, "city"] = "Renamed"
+        update_df.loc[2, "phone"] = "0000 000000"
+        result = merge_df_into_warehouse(test_db, update_df, "dim_location")
+        db_content = test_db.run("SELECT location_id, city, phone FROM dim_location ORDER BY location_id;")
+        assert result == {"dim_location": 2}
+        assert len(db_content) == 30
+        assert db_content[1][1] == "Renamed"
+        assert db_content[2][2] == "0000 000000"
+        assert test_db.run("SELECT count(*) FROM pg_tables WHERE tablename = 'stage_dim_location';") == [[0]]
+
+    def test_fact_rows_are_appended(self, test_db):
+        fact_df = pd.read_parquet(f"tests/data/fact_sales_order.parquet")
+        merge_df_into_warehouse(test_db, fact_df, "fact_sales_order")
+        result = merge_df_into_warehouse(test_db, fact_df, "fact_sales_order")
+        assert result == {"fact_sales_order": 1}
+        assert test_db.run("SELECT count(*) FROM fact_sales_order;") == [[2]]
+
+    def test_merge_without_unique_key_rolls_back(self, test_db):
+        test_db.run('DROP TABLE IF EXISTS dim_location;')
+        test_db.run("CREATE TABLE dim_location (location_id int, city varchar);")
+        df = pd.DataFrame({"location_id": [1], "city": ["Leeds"]})
+        result = merge_df_into_warehouse(test_db, df, "dim_location")
+        assert isinstance(result["dim_location"], DatabaseError)
+        assert test_db.run("SELECT count(*) FROM dim_location;") == [[0]]
+
+class TestStageAndPublishFunction:
+
+    @pytest.fixture
+    def connect(self, test_db):
+        dotenv.load_dotenv()
+        return lambda: Connection(database=os.environ["LOCALDB"], user=os.environ["LOCALUSER"],
+                                  password=os.environ["LOCALPASSWORD"])
+
+    def test_all_tables_are_published(self, test_db, connect):
+        df_dict = {
+            "dim_location": pd.read_parquet(f"tests/data/dim_location.parquet"),
+            "fact_sales_order": pd.read_parquet(f"tests/data/fact_sales_order.parquet"),
+        }
+        result = stage_and_publish(test_db, df_dict, connect, workers=2)
+
+        assert result == [{"dim_location": 30}, {"fact_sales_order": 1}]
+        assert test_db.run("SELECT count(*) FROM dim_location;") == [[30]]
+        assert test_db.run("SELECT sales_order_id FROM fact_sales_order;") == [[14549]]
+        assert test_db.run("SELECT count(*) FROM pg_tables WHERE tablename LIKE 'stage_%';") == [[0]]
+
+    def test_nothing_is_published_when_one_table_fails(self, test_db, connect):
+        df_dict = {
+            "dim_location": pd.read_parquet(f"tests/data/dim_location.parquet"),
+            "fake_table": pd.DataFrame({"fake_id": [1]}),
+        }
+        with pytest.raises(DatabaseError):
+            stage_and_publish(test_db, df_dict, connect, workers=2)
+
+        assert test_db.run("SELECT count(*) FROM dim_location;") == [[30]]
+        assert test_db.run("SELECT count(*) FROM pg_tables WHERE tablename LIKE 'stage_%';") == [[0]]
+
+    def test_publish_failure_rolls_back_every_table(self, test_db, connect):
+        fact_df = pd.read_parquet(f"tests/data/fact_sales_order.parquet")
+        fact_df["sales_record_id"] = test_db.run("SELECT max(sales_record_id) FROM fact_sales_order;")[0][0]
+        df_dict = {
+            "dim_location": pd.read_parquet(f"tests/data/dim_location.parquet"),
+            "fact_sales_order": fact_df,
+        }
+        with pytest.raises(DatabaseError):
+            stage_and_publish(test_db, df_dict, connect)
+
+        assert test_db.run("SELECT count(*) FROM dim_location;") == [[30]]
+        assert test_db.run("SELECT count(*) FROM fact_sales_order;") == [[1]]
+        assert test_db.run("SELECT count(*) FROM pg_tables WHERE tablename LIKE 'stage_%';") == [[0]]
+
+    def test_staging_tables_are_dropped_when_a_staging_connection_fails(self, test_db, connect):
+        connections = iter([connect, lambda: (_ for _ in ()).throw(OSError("connection refused"))])
+        df_dict = {
+            "dim_location": pd.read_parquet(f"tests/data/dim_location.parquet"),
+            "fact_sales_order": pd.read_parquet(f"tests/data/fact_sales_order.parquet"),
+        }
+        with pytest.raises(OSError):
+            stage_and_publish(test_db, df_dict, lambda: next(connections)(), workers=1)
+
+        assert test_db.run("SELECT count(*) FROM pg_tables WHERE tablename LIKE 'stage_%';") == [[0]]
+
+    def test_staging_tables_are_dropped_on_a_new_connection_when_db_is_lost(self, test_db, connect):
+        class LostConnection:
+            def run(self, sql, **params):
+                raise InterfaceError("network error")
+
+        df_dict = {"dim_location": pd.read_parquet(f"tests/data/dim_location.parquet")}
+        with pytest.raises(InterfaceError):
+            stage_and_publish(LostConnection(), df_dict, connect)
+
+        assert test_db.run("SELECT count(*) FROM pg_tables WHERE tablename LIKE 'stage_%';") == [[0]]
+
+class TestScheduleLoadLevelsFunction:
+
+    def test_dimensions_are_scheduled_before_facts(self):
+        result = schedule_load_levels(["fact_sales_order", "dim_staff", "dim_date"])
+        assert result == [["dim_staff", "dim_date"], ["fact_sales_order"]]
+
+    def test_dependencies_not_being_loaded_are_ignored(self):
+        assert schedule_load_levels(["fact_sales_order"]) == [["fact_sales_order"]]
+
+class TestLoadInDependencyOrderFunction:
+
+    @pytest.fixture
+    def connect(self, test_db):
+        dotenv.load_dotenv()
+        return lambda: Connection(database=os.environ["LOCALDB"], user=os.environ["LOCALUSER"],
+                                  password=os.environ["LOCALPASSWORD"])
+
+    def test_dimensions_are_loaded_before_facts(self, test_db, connect):
+        df_dict = {
+            "fact_sales_order": pd.read_parquet(f"tests/data/fact_sales_order.parquet"),
+            "dim_location": pd.read_parquet(f"tests/data/dim_location.parquet"),
+        }
+        result = load_in_dependency_order(test_db, df_dict, connect, "copy", workers=2)
+
+        assert result == [{"dim_location": 30}, {"fact_sales_order": 1}]
+        assert test_db.run("SELECT count(*) FROM dim_location;") == [[30]]
+
+    def test_facts_are_skipped_when_a_dimension_fails(self, test_db, connect):
+        df_dict = {
+            "fact_sales_order": pd.read_parquet(f"tests/data/fact_sales_order.parquet"),
+            "dim_location": pd.DataFrame({"fake_column": [1]}),
+        }
+        result = load_in_dependency_order(test_db, df_dict, connect, "copy")
+
+        assert isinstance(result[0]["dim_location"], DatabaseError)
+        assert result[1]["fact_sales_order"].startswith("skipped")
+        assert test_db.run("SELECT count(*) FROM fact_sales_order;") == [[1]]
+
+class TestLoadDFIntoWarehouseFunction:
+
+    def test_load_df_into_warehouse_raises_ValueError_for_unknown_mode(self):
+        with pytest.raises(ValueError):
+            load_df_into_warehouse(None, pd.DataFrame(), "dim_location", "fake_mode")
+
+class TestGetConn:
+
+    def test_dropped_connection_is_reopened(self, test_db, monkeypatch):
+        dotenv.load_dotenv()
+        monkeypatch.setattr("src.load.lambda_load.create_conn", lambda _: Connection(
+            database=os.environ["LOCALDB"], user=os.environ["LOCALUSER"], password=os.environ["LOCALPASSWORD"]))
+        first_conn = get_conn(None)
+        assert get_conn(None) is first_conn
+
+        first_conn.close()
+        second_conn = get_conn(None)
+
+        assert second_conn is not first_conn
+        assert second_conn.run("SELECT count(*) FROM dim_location;") == test_db.run("SELECT count(*) FROM dim_location;")
+        close_conn()
+
 class TestGetDbPassword:
     def test_get_db_password_returns_str(self, s3_client):
         extract_client = s3_client
@@ -152,6 +381,14 @@ class TestGetDbPassword:
         assert type(result) == str
         assert result == "password" 
 
+    def test_get_db_password_is_cached_from_env_backend(self, monkeypatch):
+        monkeypatch.setenv("CREDENTIAL_BACKEND", "env")
+        monkeypatch.setenv("WAREHOUSE_PASSWORD", "password")
+        assert get_db_password(None) == "password"
+
+        monkeypatch.delenv("WAREHOUSE_PASSWORD")
+        assert get_db_password(None) == "password"
+
 class TestLoadLambdaHandler:
 
     def test_lambda_load_integration_with_no_event(self, s3_client, s3_client_bucket_with_parquet_file, test_db, monkeypatch):
@@ -169,6 +406,15 @@ class TestLoadLambdaHandler:
         assert result.keys() == {'message', 'timestamp', 'total_tables_updated', 'items_inserted_into_db'}
 
 
+    def test_lambda_load_with_no_event_does_not_import_pandas(self):
+        import subprocess
+        import sys
+        script = ("import sys; from src.load.lambda_load import lambda_load; "
+                  "lambda_load({'timestamp': '2025-06-10T09:05:38.560879', 'total_new_files': 0, 'new_keys': []}, None); "
+                  "print(sorted(name for name in ('pandas', 'awswrangler', 'pyarrow') if name in sys.modules))")
+        result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+        assert result.stdout.strip() == "[]"
+
     def test_lambda_load_integration_with_an_event(self, s3_client, s3_client_bucket_with_parquet_file, test_db, monkeypatch):
             monkeypatch.setenv("PROCESSED_S3", 'processed_bucket')
             monkeypatch.setattr("src.load.lambda_load.create_conn", lambda _: test_db)
@@ -205,3 +451,40 @@ class TestLoadLambdaHandler:
             assert result['items_inserted_into_db'][0].keys() == {'fact_sales_order'}
             assert result['total_tables_updated'] == 1
 
+
+
+    def test_lambda_load_integration_with_copy_load_mode(self, s3_client, s3_client_bucket_with_parquet_file, test_db, monkeypatch):
+            monkeypatch.setenv("PROCESSED_S3", 'processed_bucket')
+            monkeypatch.setenv("LOAD_MODE", 'copy')
+            monkeypatch.setattr("src.load.lambda_load.create_conn", lambda _: test_db)
+
+            events = {
+                "message": "completed transformation",
+                "timestamp": '2025-06-10T09:05:38.560879',
+                "total_new_files": 1,
+                "new_keys": ["dev/fact_sales_order"]
+            }
+            result = lambda_load(events, context=None)
+
+            assert result['items_inserted_into_db'] == [{'fact_sales_order': 1}]
+            assert result['total_tables_updated'] == 1
+
+
+    def test_lambda_load_integration_with_atomic_load_mode(self, s3_client, s3_client_bucket_with_parquet_file, test_db, monkeypatch):
+            monkeypatch.setenv("PROCESSED_S3", 'processed_bucket')
+            monkeypatch.setenv("LOAD_MODE", 'atomic')
+            monkeypatch.setattr("src.load.lambda_load.create_conn", lambda _: Connection(
+                database=os.environ["LOCALDB"], user=os.environ["LOCALUSER"], password=os.environ["LOCALPASSWORD"]))
+            rows_before = test_db.run('SELECT count(*) FROM fact_sales_order;')[0][0]
+
+            events = {
+                "message": "completed transformation",
+                "timestamp": '2025-06-10T09:05:38.560879',
+                "total_new_files": 2,
+                "new_keys": ["dev/fact_sales_order", "dev/fact_sales_order"]
+            }
+            result = lambda_load(events, context=None)
+
+            assert result['items_inserted_into_db'] == [{'fact_sales_order': 2}]
+            assert result['total_tables_updated'] == 1
+            assert test_db.run('SELECT count(*) FROM fact_sales_order;')[0][0] == rows_before + 2
@@ -0,0 +1,217 @@
+"""
+Local stand-in for AWS Step Functions, used to run terraform/state_machine.asl.json in tests.
+Runs the subset of the Amazon States Language the project uses (Task, Map, Pass, Choice and Succeed
+states with InputPath, Parameters, ItemsPath, ResultPath, OutputPath and MaxConcurrency) and invokes the lambda handlers
+in-process, so the pipeline can be exercised against moto instead of deployed Lambdas.
+"""
+
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+EXECUTION_ARN = "arn:aws:states:eu-west-2:123456789012:execution:totes-state-machine:local"
+
+
+def load_definition(path, variables):
+    """
+    Reads a state machine definition and replaces each terraform templatefile variable
+    (e.g. ${extract_lambda_arn}) with its own name, so Task Resources can be looked up in a dict of handlers.
+    Like templatefile, only ${...} is replaced, so '$$.' context paths are kept
+
+    Args:
+        path (str): path of the .asl.json definition
+        variables (list): templatefile variable names
+
+    Returns:
+        dict: parsed definition
+    """
+
+    with open(path) as definition_file:
+        definition = re.sub(r"\$\{(\w+)\}", lambda match: match.group(1) if match.group(1) in variables else match.group(0),
+                            definition_file.read())
+    return json.loads(definition)
+
+
+def run_state_machine(definition, handlers, state_input, context=None):
+    """
+    Runs a state machine definition from StartAt until a state with End
+
+    Args:
+        definition (dict): state machine, or the ItemProcessor of a Map state
+        handlers (dict): Resource values (k) and callables taking (event, context) (v)
+        state_input: input of the first state
+        context (dict, optional): context object read by '$$.' paths. Defaults to an execution with EXECUTION_ARN.
+
+    Returns:
+        output of the last state
+    """
+
+    context = context or {"Execution": {"Id": EXECUTION_ARN}}
+    state_name = definition["StartAt"]
+    data = state_input
+    while True:
+        state = definition["States"][state_name]
+        if state["Type"] == "Choice":
+            state_name = choose_next(state, data)
+            continue
+        data = run_state(state, handlers, data, context)
+        if state.get("End") or state["Type"] in ("Succeed", "Fail"):
+            return data
+        state_name = state["Next"]
+
+
+def run_state(state, handlers, data, context):
+    """
+    Runs one state and applies its InputPath, Parameters, ResultPath and OutputPath. Map iterations run on up
+    to MaxConcurrency threads (0 or unset runs every item at once)
+
+    Args:
+        state (dict): state definition
+        handlers (dict): Resource values (k) and handlers (v)
+        data: state input
+        context (dict): context object read by '$$.' paths
+
+    Raises:
+        NotImplementedError: for state types the harness does not support
+
+    Returns:
+        state output
+    """
+
+    state_input = select(data, state.get("InputPath", "$"))
+    if "Parameters" in state and state["Type"] != "Map":
+        state_input = build_parameters(state["Parameters"], state_input, context)
+    match state["Type"]:
+        case "Task":
+            # results pass through JSON as they do between Lambda and Step Functions
+            result = json.loads(json.dumps(handlers[state["Resource"]](state_input, None)))
+        case "Map":
+            items = select(state_input, state.get("ItemsPath", "$"))
+            processor = state.get("ItemProcessor", state.get("Iterator"))
+            workers = state.get("MaxConcurrency", 0) or max(1, len(items))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                result = list(executor.map(lambda item: run_state_machine(processor, handlers, item, context), items))
+        case "Pass":
+            result = state.get("Result", state_input)
+        case "Succeed":
+            result = state_input
+        case _:
+            raise NotImplementedError(f"State type {state['Type']} is not supported by the harness")
+    return select(apply_result_path(data, result, state.get("ResultPath", "$")), state.get("OutputPath", "$"))
+
+
+def choose_next(state, data):
+    """
+    Picks the next state of a Choice state: the Next of the first matching rule, otherwise Default
+
+    Args:
+        state (dict): Choice state definition
+        data: state input
+
+    Raises:
+        NotImplementedError: for comparison operators the harness does not support
+
+    Returns:
+        str: name of the next state
+    """
+
+    comparisons = {"BooleanEquals": lambda value, expected: value is expected,
+                   "StringEquals": lambda value, expected: value == expected,
+                   "NumericEquals": lambda value, expected: value == expected,
+                   "NumericGreaterThan": lambda value, expected: value > expected}
+    for rule in state["Choices"]:
+        operators = [key for key in rule if key not in ("Variable", "Next")]
+        if len(operators) != 1 or operators[0] not in comparisons:
+            raise NotImplementedError(f"Choice rule {rule} is not supported by the harness")
+        if comparisons[operators[0]](select(data, rule["Variable"]), rule[operators[0]]):
+            return rule["Next"]
+    return state["Default"]
+
+
+def build_parameters(parameters, data, context):
+    """
+    Builds a state's Parameters: keys ending in '.$' take the value of their path, read from the
+    context object for '$$.' paths and from the state input otherwise
+
+    Args:
+        parameters (dict): Parameters of the state
+        data: state input after InputPath
+        context (dict): context object
+
+    Returns:
+        dict: the new state input
+    """
+
+    built = {}
+    for key, value in parameters.items():
+        if key.endswith(".$"):
+            built[key[:-2]] = select(context, value[1:]) if value.startswith("$$.") else select(data, value)
+        elif isinstance(value, dict):
+            built[key] = build_parameters(value, data, context)
+        else:
+            built[key] = value
+    return built
+
+
+def select(data, path):
+    """
+    Evaluates a '$' or '$.field.field' path against data
+
+    Args:
+        data: JSON value
+        path (str): path
+
+    Returns:
+        selected value
+    """
+
+    for field in path_fields(path):
+        data = data[field]
+    return data
+
+
+def apply_result_path(data, result, path):
+    """
+    Places a state's result in its input as ResultPath does. A null ResultPath discards the result
+
+    Args:
+        data: state input
+        result: state result
+        path (str | None): ResultPath
+
+    Returns:
+        combined value
+    """
+
+    if path is None:
+        return data
+    fields = path_fields(path)
+    if not fields:
+        return result
+    combined = json.loads(json.dumps(data))
+    target = combined
+    for field in fields[:-1]:
+        target = target.setdefault(field, {})
+    target[fields[-1]] = result
+    return combined
+
+
+def path_fields(path):
+    """
+    Splits a '$' or '$.field.field' path into its field names
+
+    Args:
+        path (str): path
+
+    Raises:
+        NotImplementedError: for paths other than plain field access
+
+    Returns:
+        list: field names
+    """
+
+    if path == "$":
+        return []
+    if not path.startswith("$.") or any(char in path for char in "[]*?@"):
+        raise NotImplementedError(f"Path {path} is not supported by the harness")
+    return path[2:].split(".")
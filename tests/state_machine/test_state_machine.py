@@ -0,0 +1,112 @@
+from tests.state_machine.harness import EXECUTION_ARN, load_definition, run_state_machine
+from src.extract.lambda_extract import build_work_stages
+from src.transform.lambda_transform import lambda_transform
+from moto import mock_aws
+from io import BytesIO
+import pandas as pd
+import pytest
+import boto3
+import os
+
+DEFINITION_PATH = "terraform/state_machine.asl.json"
+LAMBDA_ARNS = ["probe_lambda_arn", "extract_lambda_arn", "transform_lambda_arn", "load_lambda_arn"]
+
+@pytest.fixture
+def aws_credentials():
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_SECURITY_TOKEN"] = "testing"
+    os.environ["AWS_SESSION_TOKEN"] = "testing"
+    os.environ["AWS_DEFAULT_REGION"] = "eu-west-2"
+
+@pytest.fixture
+def s3_client(aws_credentials, monkeypatch):
+    with mock_aws():
+        s3_client = boto3.client("s3")
+        for bucket_name in ["ingestion-bucket", "processed-bucket"]:
+            s3_client.create_bucket(Bucket=bucket_name,
+                                    CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+        monkeypatch.setenv("INGESTION_S3", "ingestion-bucket")
+        monkeypatch.setenv("PROCESSED_S3", "processed-bucket")
+        monkeypatch.setattr("boto3.client", lambda _: s3_client)
+        yield s3_client
+
+@pytest.fixture
+def raw_keys(s3_client):
+    raw_keys = []
+    for table_name in ["sales_order", "staff", "counterparty", "department", "address", "design", "currency"]:
+        key = f"dev/{table_name}/2025-06-10/{table_name}_10:04:36.847261.json"
+        with open(f"tests/data/{table_name}.json", "rb") as jsonfile:
+            s3_client.put_object(Bucket="ingestion-bucket", Key=key, Body=jsonfile.read())
+        raw_keys.append(key)
+    return raw_keys
+
+def changed_probe(events, context):
+    return {"message": "completed probe", "changed": True, "changed_tables": ["sales_order"], "interval_minutes": 10}
+
+
+class TestStateMachineDefinition:
+
+    def test_tables_are_transformed_and_loaded_stage_by_stage(self, s3_client, raw_keys):
+        loaded_tables = []
+
+        def fake_extract(events, context):
+            return {"message": "completed ingestion", "timestamp": "2025-06-10T10:04:36.847261",
+                    "total_new_files": len(raw_keys), "new_keys": raw_keys,
+                    "work_stages": build_work_stages(raw_keys, "2025-06-10T10:04:36.847261")}
+
+        def fake_load(events, context):
+            loaded_tables.append([key.split("/")[1] for key in events["new_keys"]])
+            return {"message": "completed loading", "total_tables_updated": len(events["new_keys"])}
+
+        definition = load_definition(DEFINITION_PATH, LAMBDA_ARNS)
+        handlers = {"probe_lambda_arn": changed_probe, "extract_lambda_arn": fake_extract,
+                    "transform_lambda_arn": lambda_transform,
+                    "load_lambda_arn": fake_load}
+        result = run_state_machine(definition, handlers, {})
+
+        assert [len(stage) for stage in result["load_results"]] == [4, 2, 1]
+        assert sorted(loaded_tables[-1]) == ["dim_date", "fact_sales_order"]
+        assert sorted(sum(loaded_tables[4:6], [])) == ["dim_counterparty", "dim_staff"]
+
+        dim_staff_keys = s3_client.list_objects_v2(Bucket="processed-bucket", Prefix="dev/dim_staff/")["Contents"]
+        dim_staff = pd.read_parquet(BytesIO(
+            s3_client.get_object(Bucket="processed-bucket", Key=dim_staff_keys[0]["Key"])["Body"].read()))
+        assert dim_staff["department_name"].notna().all()
+
+    def test_no_work_stages_skips_transform_and_load(self, s3_client):
+        def fail(events, context):
+            raise AssertionError("should not be invoked")
+
+        definition = load_definition(DEFINITION_PATH, LAMBDA_ARNS)
+        handlers = {"probe_lambda_arn": changed_probe,
+                    "extract_lambda_arn": lambda events, context: {"total_new_files": 0, "new_keys": [], "work_stages": []},
+                    "transform_lambda_arn": fail, "load_lambda_arn": fail}
+        result = run_state_machine(definition, handlers, {})
+
+        assert result["load_results"] == []
+
+    def test_unchanged_tables_end_the_run_after_the_probe(self, s3_client):
+        def fail(events, context):
+            raise AssertionError("should not be invoked")
+
+        probe_result = {"message": "completed probe", "changed": False, "changed_tables": [], "interval_minutes": 20}
+        definition = load_definition(DEFINITION_PATH, LAMBDA_ARNS)
+        handlers = {"probe_lambda_arn": lambda events, context: probe_result,
+                    "extract_lambda_arn": fail, "transform_lambda_arn": fail, "load_lambda_arn": fail}
+        result = run_state_machine(definition, handlers, {})
+
+        assert result == probe_result
+
+    def test_probe_is_passed_the_execution_arn(self, s3_client):
+        probe_events = []
+
+        def probe(events, context):
+            probe_events.append(events)
+            return {"message": "skipped probe, previous run still in progress", "changed": False,
+                    "changed_tables": [], "interval_minutes": None}
+
+        definition = load_definition(DEFINITION_PATH, LAMBDA_ARNS)
+        run_state_machine(definition, {"probe_lambda_arn": probe}, {"source": "aws.events"})
+
+        assert probe_events == [{"execution_arn": EXECUTION_ARN}]
@@ -4,6 +4,7 @@ from io import StringIO
 from src.transform.lambda_transform import *
 import boto3
 from moto import mock_aws
+from unittest.mock import Mock, patch
 import os
 import json
 from pprint import pprint
@@ -21,46 +22,40 @@ def s3_boto(aws_credentials):
     with mock_aws(aws_credentials):
         yield boto3.client('s3')
 
-@pytest.fixture(scope='class')
-def mock_s3_buckets(s3_boto):
-    """Create ingestion and processed buckets for test functions"""
-    
+def create_buckets(s3_client):
+    """Create ingestion and processed buckets and upload the raw test tables"""
+
     bucket_1 = "ingestion-bucket"
     bucket_2 = "processed-bucket"
 
-    key = "dev/staff"
-    s3_boto.create_bucket(Bucket=bucket_1,
+    s3_client.create_bucket(Bucket=bucket_1,
                         CreateBucketConfiguration={"LocationConstraint":"eu-west-2"})
-    s3_boto.create_bucket(Bucket=bucket_2,
+    s3_client.create_bucket(Bucket=bucket_2,
                         CreateBucketConfiguration={"LocationConstraint":"eu-west-2"})
 
     #INGESTION UPLOADS
 
-    with open("./tests/data/staff.json", "r") as jsonfile:
-        body = json.dumps(json.load(jsonfile))          
-    
-        s3_boto.put_object(Bucket=bucket_1, Key=key, Body=body.encode("utf-8"))
-        # output = s3_boto.list_objects_v2(Bucket=bucket_1, Prefix=key)
-    
-    with open("./tests/data/department.json", "r") as jsonfile:
-        body = json.dumps(json.load(jsonfile))          
-    
-        s3_boto.put_object(Bucket=bucket_1, Key="dev/department", Body=body.encode("utf-8"))
+    for table_name in ["staff", "department", "address", "counterparty", "sales_order"]:
+        with open(f"./tests/data/{table_name}.json", "r") as jsonfile:
+            body = json.dumps(json.load(jsonfile))
+        s3_client.put_object(Bucket=bucket_1, Key=f"dev/{table_name}", Body=body.encode("utf-8"))
 
-    with open("./tests/data/address.json", "r") as jsonfile:
-        body = json.dumps(json.load(jsonfile))          
-    
-        s3_boto.put_object(Bucket=bucket_1, Key="dev/address", Body=body.encode("utf-8"))
+@pytest.fixture(scope='class')
+def mock_s3_buckets(s3_boto):
+    """Create ingestion and processed buckets for test functions"""
 
-    with open("./tests/data/counterparty.json", "r") as jsonfile:
-        body = json.dumps(json.load(jsonfile))          
-    
-        s3_boto.put_object(Bucket=bucket_1, Key="dev/counterparty", Body=body.encode("utf-8"))
+    create_buckets(s3_boto)
 
-    with open("./tests/data/sales_order.json", "r") as jsonfile:
-        body = json.dumps(json.load(jsonfile))          
-    
-        s3_boto.put_object(Bucket=bucket_1, Key="dev/sales_order", Body=body.encode("utf-8"))
+@pytest.fixture
+def s3_isolated(aws_credentials):
+    """S3 client with its own mock buckets, for tests that must not depend on state left by other tests"""
+
+    reference_cache.clear()
+    with mock_aws():
+        s3_client = boto3.client('s3')
+        create_buckets(s3_client)
+        yield s3_client
+    reference_cache.clear()
 
 
 
@@ -68,46 +63,239 @@ class TestAppendJSONRaw:
 
     def test_append_json_raw_except_with_empty_processed_bucket(self, s3_boto, mock_s3_buckets):
         new_json_key = 'dev/staff'
-        processed_key = 'db_state/staff_all.json'  
 
         # Assert bucket is empty before test
         assert s3_boto.list_objects_v2(Bucket='processed-bucket')['KeyCount'] == 0 
 
         result = append_json_raw_tables(s3_boto, 'ingestion-bucket', new_json_key, 'processed-bucket')
   
-        processed_obj = s3_boto.get_object(Bucket="processed-bucket", Key=processed_key)
-        processed_json = json.loads(processed_obj["Body"].read().decode("utf-8"))
-        processed_json_0 = processed_json[0]
+        processed_keys = list_state_segments(s3_boto, 'processed-bucket', 'staff')
+        processed_df = table_name_to_df(s3_boto, 'staff', 'processed-bucket')
 
-        # Assert new key has been added to bucket
+        # Assert new segment has been added to bucket
         assert s3_boto.list_objects_v2(Bucket='processed-bucket')['KeyCount'] == 1
+        assert len(processed_keys) == 1
+        assert processed_keys[0].startswith('db_state/staff/staff_')
         # Assert length of dataframe 
         assert len(result[1]) == 4
-        # Assert new_df and merged df have the same data
-        assert ((result[1].iloc[0]['first_name'])) == processed_json_0['first_name']
-        assert len(processed_json) == len(result[1]) # 4
+        # Assert new_df and state df have the same data
+        assert ((result[1].iloc[0]['first_name'])) == processed_df.loc[0, 'first_name']
+        assert len(processed_df) == len(result[1]) # 4
 
 
     def test_append_json_raw_with_existing_data(self, s3_boto,mock_s3_buckets):
         new_json_key = 'dev/staff'
-        processed_key = 'db_state/staff_all.json'
         with open("./tests/data/staff_add.json", "r") as jsonfile:
             body = json.dumps(json.load(jsonfile))
             s3_boto.put_object(Bucket='ingestion-bucket', Key=new_json_key, Body=body.encode("utf-8"))
 
         result = append_json_raw_tables(s3_boto, 'ingestion-bucket', new_json_key, 'processed-bucket')
 
-        processed_obj = s3_boto.get_object(Bucket="processed-bucket", Key=processed_key)
-        processed_json = json.loads(processed_obj["Body"].read().decode("utf-8"))
-        processed_json_0 = processed_json[0]
-        processed_json_4 = processed_json[4]
+        processed_df = table_name_to_df(s3_boto, 'staff', 'processed-bucket')
 
+        # Assert only the new rows were written, as a second segment
+        assert len(list_state_segments(s3_boto, 'processed-bucket', 'staff')) == 2
         # Assert that processed is longer than new df
-        assert len(processed_json) > len(result[1]) 
+        assert len(processed_df) > len(result[1]) 
         # Assert length of processed data has increased        
-        assert len(processed_json) > 4
+        assert len(processed_df) > 4
         # Assert that first row of new df is same as relative row in processed
-        assert ((result[1].iloc[0]['first_name'])) == processed_json_4['first_name']
+        assert ((result[1].iloc[0]['first_name'])) == processed_df.loc[4, 'first_name']
+
+class TestStateSegments:
+
+    @pytest.fixture
+    def fake_state(self, s3_isolated):
+        s3_isolated.put_object(Bucket='processed-bucket', Key='db_state/fake_all.json',
+                               Body=json.dumps([{"fake_id": 1}, {"fake_id": 2}]))
+        save_state_segment(s3_isolated, 'processed-bucket', 'fake', pd.DataFrame({"fake_id": [3]}))
+
+    def test_table_name_to_df_reads_legacy_file_before_segments(self, s3_isolated, fake_state):
+        result = table_name_to_df(s3_isolated, 'fake', 'processed-bucket')
+        assert list(result["fake_id"]) == [1, 2, 3]
+
+    def test_compact_state_segments_merges_once_over_the_limit(self, s3_isolated, fake_state):
+        for i in range(4, 7):
+            save_state_segment(s3_isolated, 'processed-bucket', 'fake', pd.DataFrame({"fake_id": [i]}))
+
+        assert compact_state_segments(s3_isolated, 'processed-bucket', 'fake', max_segments=4) == None
+        newest_key = list_state_segments(s3_isolated, 'processed-bucket', 'fake')[-1]
+        result = compact_state_segments(s3_isolated, 'processed-bucket', 'fake', max_segments=3)
+
+        assert result == newest_key.replace(".parquet", COMPACTED_SUFFIX)
+        assert list_state_segments(s3_isolated, 'processed-bucket', 'fake') == [result]
+        assert list_segment_objects(s3_isolated, 'processed-bucket', 'fake') == [result]
+        assert 'Contents' not in s3_isolated.list_objects_v2(Bucket='processed-bucket', Prefix='db_state/fake_all.json')
+        assert list(table_name_to_df(s3_isolated, 'fake', 'processed-bucket')["fake_id"]) == [1, 2, 3, 4, 5, 6]
+
+    def test_interrupted_compaction_does_not_duplicate_rows(self, s3_isolated, fake_state):
+        for i in range(4, 6):
+            save_state_segment(s3_isolated, 'processed-bucket', 'fake', pd.DataFrame({"fake_id": [i]}))
+
+        with patch.object(s3_isolated, "delete_objects", side_effect=RuntimeError("timed out")):
+            with pytest.raises(RuntimeError):
+                compact_state_segments(s3_isolated, 'processed-bucket', 'fake', max_segments=2)
+        save_state_segment(s3_isolated, 'processed-bucket', 'fake', pd.DataFrame({"fake_id": [6]}))
+
+        assert len(list_segment_objects(s3_isolated, 'processed-bucket', 'fake')) == 5
+        assert list(table_name_to_df(s3_isolated, 'fake', 'processed-bucket')["fake_id"]) == [1, 2, 3, 4, 5, 6]
+        compacted_key = compact_state_segments(s3_isolated, 'processed-bucket', 'fake', max_segments=1)
+        assert list_segment_objects(s3_isolated, 'processed-bucket', 'fake') == [compacted_key]
+        assert list(table_name_to_df(s3_isolated, 'fake', 'processed-bucket')["fake_id"]) == [1, 2, 3, 4, 5, 6]
+
+class TestLatestSnapshot:
+
+    @pytest.fixture
+    def renamed_department(self, s3_isolated):
+        """Appends the departments, then an update renaming department 6"""
+
+        append_json_raw_tables(s3_isolated, 'ingestion-bucket', 'dev/department', 'processed-bucket')
+        with open("./tests/data/department.json", "r") as jsonfile:
+            departments = json.load(jsonfile)
+        updated = dict(next(row for row in departments if row["department_id"] == 6))
+        updated["department_name"] = "Renamed"
+        updated["last_updated"] = "2030-01-01T00:00:00"
+        s3_isolated.put_object(Bucket='ingestion-bucket', Key='dev/department/update', Body=json.dumps([updated]))
+        append_json_raw_tables(s3_isolated, 'ingestion-bucket', 'dev/department/update', 'processed-bucket')
+        return departments
+
+    def test_latest_rows_keeps_last_updated_version(self):
+        df = pd.DataFrame({"department_id": [2, 1, 1, 2],
+                           "department_name": ["Sales", "HR", "People", "Old Sales"],
+                           "last_updated": ["2025-06-03", "2025-06-01", "2025-06-02", "2025-06-01"]})
+        result = latest_rows(df, "department_id")
+        assert list(result["department_id"]) == [1, 2]
+        assert list(result["department_name"]) == ["People", "Sales"]
+
+    def test_snapshot_is_updated_when_reference_table_is_appended(self, s3_isolated, renamed_department):
+        departments = renamed_department
+        assert len(table_name_to_df(s3_isolated, 'department', 'processed-bucket')) == len(departments) + 1
+        latest_df = latest_table_df(s3_isolated, 'department', 'processed-bucket')
+        assert len(latest_df) == len(departments)
+        renamed = latest_df[latest_df["department_id"] == 6]
+        assert list(renamed["department_name"]) == ["Renamed"]
+
+    def test_staff_merge_does_not_fan_out_on_department_updates(self, s3_isolated, renamed_department):
+        table_name, new_df = append_json_raw_tables(s3_isolated, 'ingestion-bucket', 'dev/staff', 'processed-bucket')
+        result = mvp_transform_df(s3_isolated, table_name, new_df, 'processed-bucket')
+        assert len(result["dim_staff"]) == len(new_df)
+        assert list(result["dim_staff"].loc[result["dim_staff"]["staff_id"] == 2, "department_name"]) == ["Renamed"]
+
+    def test_latest_table_df_builds_missing_snapshot_from_history(self, s3_isolated):
+        save_state_segment(s3_isolated, 'processed-bucket', 'address',
+                           pd.DataFrame({"address_id": [1, 1], "city": ["Old", "New"],
+                                         "last_updated": ["2025-01-01", "2025-02-01"]}))
+        result = latest_table_df(s3_isolated, 'address', 'processed-bucket')
+        assert list(result["city"]) == ["New"]
+        s3_isolated.head_object(Bucket='processed-bucket', Key='db_state/address_latest.parquet')
+
+class TestReferenceCache:
+
+    def test_unchanged_snapshot_is_served_from_cache(self, s3_isolated):
+        save_latest_snapshot(s3_isolated, 'processed-bucket', 'department', pd.DataFrame({"department_id": [1]}))
+        etag, _ = reference_cache[('processed-bucket', 'db_state/department_latest.parquet')]
+        reference_cache[('processed-bucket', 'db_state/department_latest.parquet')] = (
+            etag, pd.DataFrame({"department_id": [99]}))
+
+        result = latest_table_df(s3_isolated, 'department', 'processed-bucket')
+        assert list(result["department_id"]) == [99]
+
+    def test_changed_snapshot_is_downloaded_again(self, s3_isolated):
+        save_latest_snapshot(s3_isolated, 'processed-bucket', 'department', pd.DataFrame({"department_id": [1]}))
+        buffer = BytesIO()
+        pd.DataFrame({"department_id": [1, 2]}).to_parquet(buffer, index=False)
+        s3_isolated.put_object(Bucket='processed-bucket', Key='db_state/department_latest.parquet', Body=buffer.getvalue())
+
+        result = latest_table_df(s3_isolated, 'department', 'processed-bucket')
+        assert list(result["department_id"]) == [1, 2]
+        etag, _ = reference_cache[('processed-bucket', 'db_state/department_latest.parquet')]
+        assert etag == s3_isolated.head_object(Bucket='processed-bucket', Key='db_state/department_latest.parquet')["ETag"]
+
+    def test_cache_evicts_least_recently_used(self, monkeypatch):
+        monkeypatch.setenv("REFERENCE_CACHE_SIZE", "2")
+        reference_cache.clear()
+        for key in ["a", "b", "c"]:
+            cache_reference_df('processed-bucket', key, f'"{key}"', pd.DataFrame())
+        assert list(reference_cache) == [('processed-bucket', 'b'), ('processed-bucket', 'c')]
+
+class TestReadRawRows:
+
+    def test_read_raw_rows_from_json_object(self, s3_isolated):
+        result = read_raw_rows(s3_isolated, 'ingestion-bucket', 'dev/department')
+        with open("./tests/data/department.json", "r") as jsonfile:
+            assert result == json.load(jsonfile)
+
+    def test_read_raw_rows_from_chunk_manifest(self, s3_isolated):
+        manifest = {"table_name": "fake", "total_rows": 3,
+                    "chunks": [{"key": "dev/fake/part_00000.json", "rows": 2},
+                               {"key": "dev/fake/part_00001.json", "rows": 1}]}
+        s3_isolated.put_object(Bucket='ingestion-bucket', Key="dev/fake/part_00000.json", Body=json.dumps([{"a": 1}, {"a": 2}]))
+        s3_isolated.put_object(Bucket='ingestion-bucket', Key="dev/fake/part_00001.json", Body=json.dumps([{"a": 3}]))
+        s3_isolated.put_object(Bucket='ingestion-bucket', Key="dev/fake.manifest.json", Body=json.dumps(manifest))
+
+        result = read_raw_rows(s3_isolated, 'ingestion-bucket', 'dev/fake.manifest.json')
+        assert result == [{"a": 1}, {"a": 2}, {"a": 3}]
+
+    def test_read_raw_rows_from_ndjson_gz_object(self, s3_isolated):
+        rows = [{"a": 1, "b": "x"}, {"a": 2, "b": None}]
+        body = gzip.compress(b"\n".join(json.dumps(row).encode("utf-8") for row in rows) + b"\n")
+        s3_isolated.put_object(Bucket='ingestion-bucket', Key="dev/fake/fake_10:00.ndjson.gz", Body=body)
+
+        result = read_raw_rows(s3_isolated, 'ingestion-bucket', "dev/fake/fake_10:00.ndjson.gz")
+        assert result == rows
+
+    def test_read_raw_rows_from_parquet_object(self, s3_isolated):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.table({"a": [1, 2], "last_updated": [datetime(2025, 6, 6, 9, 22, 10, 153000), None]})
+        buffer = BytesIO()
+        pq.write_table(table, buffer)
+        s3_isolated.put_object(Bucket='ingestion-bucket', Key="dev/fake/fake_10:00.parquet", Body=buffer.getvalue())
+
+        result = read_raw_rows(s3_isolated, 'ingestion-bucket', "dev/fake/fake_10:00.parquet")
+        assert result == [{"a": 1, "last_updated": "2025-06-06T09:22:10.153000"},
+                          {"a": 2, "last_updated": None}]
+
+    def test_iter_raw_batches_yields_fixed_size_batches(self, s3_isolated):
+        rows = [{"a": i} for i in range(5)]
+        s3_isolated.put_object(Bucket='ingestion-bucket', Key="dev/fake/fake_11:00.json", Body=json.dumps(rows))
+        body = gzip.compress(b"\n".join(json.dumps(row).encode("utf-8") for row in rows))
+        s3_isolated.put_object(Bucket='ingestion-bucket', Key="dev/fake/fake_11:00.ndjson.gz", Body=body)
+
+        for key in ["dev/fake/fake_11:00.json", "dev/fake/fake_11:00.ndjson.gz"]:
+            result = list(iter_raw_batches(s3_isolated, 'ingestion-bucket', key, batch_rows=2))
+            assert result == [rows[0:2], rows[2:4], rows[4:]]
+
+    def test_iter_raw_batches_reads_json_in_chunks_of_raw_read_chunk_bytes(self, s3_isolated, monkeypatch):
+        rows = [{"a": i, "b": "é" * i} for i in range(5)]
+        s3_isolated.put_object(Bucket='ingestion-bucket', Key="dev/fake/fake_12:00.json",
+                           Body=json.dumps(rows, ensure_ascii=False).encode("utf-8"))
+        monkeypatch.setenv("RAW_READ_CHUNK_BYTES", "5")
+        with patch("botocore.response.StreamingBody.iter_chunks", autospec=True,
+                   side_effect=lambda body, chunk_size: iter(lambda: body.read(chunk_size), b"")) as mock_iter_chunks:
+            result = list(iter_raw_batches(s3_isolated, 'ingestion-bucket', "dev/fake/fake_12:00.json", batch_rows=5))
+        assert result == [rows]
+        assert mock_iter_chunks.call_args.args[1] == 5
+
+    def test_iter_json_array_parses_across_chunk_boundaries(self):
+        rows = [{"a": i, "b": "x, ]" * i, "c": [1.5, None]} for i in range(20)] + [123, "é"]
+        body = json.dumps(rows, ensure_ascii=False).encode("utf-8")
+        for chunk_size in [1, 3, 64]:
+            chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+            assert list(iter_json_array(chunks)) == rows
+
+    @pytest.mark.parametrize("body", [b"[-1.5e3]", b"[1.25E-7, -0.5]", b"[12, -3e+2 , true, null]"])
+    def test_iter_json_array_parses_numbers_split_at_every_boundary(self, body):
+        for split in range(1, len(body)):
+            assert list(iter_json_array([body[:split], body[split:]])) == json.loads(body)
+        for chunk_size in [1, 2, 3, 4]:
+            chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+            assert list(iter_json_array(chunks)) == json.loads(body)
+
+    def test_iter_json_array_raises_on_malformed_json(self):
+        for body in [b"", b'[{"a": 1}', b'[{"a": 1} {"a": 2}]', b'{"a": 1}', b'[{"a": }]', b"[1.]", b"[1e]"]:
+            with pytest.raises(json.JSONDecodeError):
+                list(iter_json_array([body]))
 
 class TestMVPTransformDF:
 
@@ -249,6 +437,14 @@ class TestMVPTransformDF:
         assert dim_currency.loc[2, "currency_code"] == "EUR"
         assert dim_currency.loc[2, "currency_name"] == "Euro"
 
+    def test_transform_currency_case_with_unknown_code(self, s3_boto, mock_s3_buckets):
+        new_df = pd.DataFrame({"currency_id": [1, 2, 3], "currency_code": ["JPY", "XYZ", "USD"]})
+
+        result = mvp_transform_df(s3_boto, "currency", new_df, "processed-bucket")
+        dim_currency = result["dim_currency"]
+
+        assert list(dim_currency["currency_name"]) == ["Japanese yen", UNKNOWN_CURRENCY_NAME, "US dollar"]
+
     def test_transform_sales_order_and_date_case(self, s3_boto, mock_s3_buckets):        
         ingestion_bucket = "ingestion-bucket"
         processed_bucket = "processed-bucket"
@@ -306,6 +502,129 @@ class TestMVPTransformDF:
         assert dim_date_result.loc[0, 'quarter'] == 2
         assert dim_date_result.loc[0, 'month_name'] == 'June'
 
+class TestDateRegistry:
+
+    @pytest.fixture
+    def registered_dates(self, s3_isolated):
+        register_new_dates(s3_isolated, 'processed-bucket', pd.Series(["2025-06-03", "2025-06-02"]))
+
+    def test_register_new_dates_on_empty_registry(self, s3_isolated):
+        result = register_new_dates(s3_isolated, 'processed-bucket', pd.Series(["2025-06-03", "2025-06-02", "2025-06-03"]))
+        assert list(result) == ["2025-06-02", "2025-06-03"]
+        assert list(load_date_registry(s3_isolated, 'processed-bucket')) == list(dates_to_day_numbers(result))
+
+    def test_register_new_dates_returns_only_unseen_dates(self, s3_isolated, registered_dates):
+        result = register_new_dates(s3_isolated, 'processed-bucket', pd.Series(["2025-06-01", "2025-06-03", "2025-06-04"]))
+        assert list(result) == ["2025-06-01", "2025-06-04"]
+        registry = load_date_registry(s3_isolated, 'processed-bucket')
+        assert len(registry) == 4
+        assert list(registry) == sorted(registry)
+
+    def test_registry_is_not_rewritten_without_new_dates(self, s3_isolated, registered_dates):
+        before = s3_isolated.head_object(Bucket='processed-bucket', Key='db_state/date_registry.bin')["LastModified"]
+        result = register_new_dates(s3_isolated, 'processed-bucket', pd.Series(["2025-06-02"]))
+        after = s3_isolated.head_object(Bucket='processed-bucket', Key='db_state/date_registry.bin')["LastModified"]
+        assert len(result) == 0
+        assert before == after
+
+    def test_load_date_registry_seeds_from_legacy_date_all(self, s3_isolated):
+        s3_isolated.put_object(Bucket='processed-bucket', Key='db_state/date_all.json',
+                               Body=json.dumps({"0": "2025-06-05", "1": "2025-06-02"}))
+        result = load_date_registry(s3_isolated, 'processed-bucket')
+        assert list(result) == list(dates_to_day_numbers(pd.Series(["2025-06-02", "2025-06-05"])))
+
+class TestBuildDimDate:
+
+    def test_build_dim_date_columns_and_values(self):
+        result = build_dim_date(pd.Series(["2025-06-02", "2024-12-29", "2025-02-28"]))
+        assert list(result.columns) == ['date_id', 'year', 'month', 'day', 'day_of_week',
+                                        'day_name', 'month_name', 'quarter']
+        assert str(result.loc[0, 'date_id']) == '2025-06-02 00:00:00'
+        assert list(result['year']) == [2025, 2024, 2025]
+        assert list(result['day']) == [2, 29, 28]
+        assert list(result['day_of_week']) == [0, 6, 4]
+        assert list(result['day_name']) == ['Monday', 'Sunday', 'Friday']
+        assert list(result['month_name']) == ['June', 'December', 'February']
+        assert list(result['quarter']) == [2, 4, 1]
+
+    def test_build_dim_date_matches_per_date_calendar(self):
+        dates = pd.Series(pd.date_range("2020-01-01", "2030-12-31").strftime("%Y-%m-%d"))
+        result = build_dim_date(dates)
+        sample = [datetime.strptime(date, "%Y-%m-%d") for date in dates[::97]]
+        assert list(result['day_of_week'][::97]) == [d.weekday() for d in sample]
+        assert list(result['month'][::97]) == [d.month for d in sample]
+        assert list(result['quarter'][::97]) == [(d.month - 1) // 3 + 1 for d in sample]
+
+class TestArrowEngine:
+
+    @pytest.fixture
+    def engine_results(self, s3_isolated):
+        """Transforms every table with both engines, keeping the arrow engine's state in its own bucket"""
+
+        s3_isolated.create_bucket(Bucket='processed-arrow-bucket',
+                                  CreateBucketConfiguration={"LocationConstraint":"eu-west-2"})
+        for table_name in ["currency", "design"]:
+            with open(f"./tests/data/{table_name}.json", "r") as jsonfile:
+                s3_isolated.put_object(Bucket='ingestion-bucket', Key=f"dev/{table_name}", Body=jsonfile.read().encode("utf-8"))
+
+        results = []
+        for table_name in ["department", "address", "staff", "counterparty", "sales_order", "currency", "design"]:
+            _, new_df = append_json_raw_tables(s3_isolated, 'ingestion-bucket', f"dev/{table_name}", 'processed-bucket')
+            pandas_result = mvp_transform_df(s3_isolated, table_name, new_df, 'processed-bucket')
+            _, new_table = append_raw_table_arrow(s3_isolated, 'ingestion-bucket', f"dev/{table_name}", 'processed-arrow-bucket')
+            arrow_result = mvp_transform_arrow(s3_isolated, table_name, new_table, 'processed-arrow-bucket')
+            results.append((pandas_result, arrow_result))
+        return results
+
+    def test_arrow_engine_matches_pandas_engine(self, engine_results):
+        import pyarrow as pa
+        for pandas_result, arrow_result in engine_results:
+            assert (arrow_result or {}).keys() == (pandas_result or {}).keys()
+            for name, df in (pandas_result or {}).items():
+                expected = pa.Table.from_pandas(df, preserve_index=False)
+                assert arrow_result[name].to_pylist() == expected.to_pylist()
+
+    def test_arrow_state_segments_are_readable_by_pandas_engine(self, s3_isolated, engine_results):
+        state_df = table_name_to_df(s3_isolated, 'staff', 'processed-arrow-bucket')
+        assert list(state_df['staff_id']) == list(table_name_to_df(s3_isolated, 'staff', 'processed-bucket')['staff_id'])
+
+    def test_arrow_engine_matches_pandas_engine_for_whole_second_timestamps(self, s3_isolated):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        with open("./tests/data/sales_order.json") as jsonfile:
+            rows = json.load(jsonfile)
+        rows[0]["created_at"] = rows[0]["last_updated"] = "2025-06-02T11:19:10"
+        s3_isolated.put_object(Bucket='ingestion-bucket', Key="dev/sales_order/whole_seconds.json", Body=json.dumps(rows))
+        parquet_rows = [{**row, "created_at": datetime.fromisoformat(row["created_at"]),
+                         "last_updated": datetime.fromisoformat(row["last_updated"])} for row in rows]
+        buffer = BytesIO()
+        pq.write_table(pa.Table.from_pylist(parquet_rows), buffer)
+        s3_isolated.put_object(Bucket='ingestion-bucket', Key="dev/sales_order/whole_seconds.parquet", Body=buffer.getvalue())
+
+        _, new_df = append_json_raw_tables(s3_isolated, 'ingestion-bucket', "dev/sales_order/whole_seconds.json", 'processed-bucket')
+        pandas_result = mvp_transform_df(s3_isolated, "sales_order", new_df, 'processed-bucket')
+        _, new_table = append_raw_table_arrow(s3_isolated, 'ingestion-bucket', "dev/sales_order/whole_seconds.parquet", 'processed-bucket')
+        arrow_result = mvp_transform_arrow(s3_isolated, "sales_order", new_table, 'processed-bucket')
+
+        expected = pa.Table.from_pandas(pandas_result["fact_sales_order"], preserve_index=False).to_pylist()
+        assert arrow_result["fact_sales_order"].to_pylist() == expected
+        assert expected[0]["created_time"] == "11:19:10"
+        assert expected[1]["created_time"] == "11:41:10.067000"
+
+    def test_map_currency_names_arrow_names_unknown_codes(self):
+        import pyarrow as pa
+        result = map_currency_names_arrow(pa.chunked_array([["GBP", "XYZ"]]))
+        assert result.to_pylist() == ["British pound", UNKNOWN_CURRENCY_NAME]
+
+class TestScheduleTransformLevels:
+
+    def test_snapshot_tables_are_scheduled_before_their_dependants(self):
+        result = schedule_transform_levels(["staff", "counterparty", "sales_order", "department", "address"])
+        assert result == [["sales_order", "department", "address"], ["staff", "counterparty"]]
+
+    def test_dependencies_not_in_the_event_are_ignored(self):
+        assert schedule_transform_levels(["staff"]) == [["staff"]]
+
 class TestSerialiseObjectFunction:
 
     def test_serialise_object_returns_isoformat(self):
@@ -335,10 +654,28 @@ class TestSaveParquetToS3:
         ## run transformation
         transformed_dict = mvp_transform_df(s3_boto, table_name, new_df, processed_bucket)
         saved_parquet = 'dev/fact_sales_order/2022/fact_sales_order_14:20.parquet'
-        save_parquet_to_s3(processed_bucket, transformed_dict,"2022T14:20")
+        save_parquet_to_s3(s3_boto, processed_bucket, transformed_dict,"2022T14:20")
         assert s3_boto.list_objects_v2(Bucket='processed-bucket')['Contents'][3]['Key'] == saved_parquet
         
 
+class TestTransformKeys:
+
+    def test_pandas_uploads_from_several_threads_use_the_shared_client(self, s3_isolated, monkeypatch):
+        # boto3 Sessions are not thread-safe, so the shared default session must not be used for uploads
+        shared_session = Mock(spec=boto3.Session)
+        monkeypatch.setattr(boto3, "DEFAULT_SESSION", shared_session)
+        new_keys = ['dev/staff', 'dev/counterparty', 'dev/department', 'dev/address', 'dev/sales_order']
+
+        result = transform_keys(s3_isolated, 'ingestion-bucket', 'processed-bucket', new_keys,
+                                "2025-06-10T10:04:36.847261", workers=4, engine="pandas")
+
+        assert not shared_session.method_calls
+        assert sorted(key.split("/")[1] for key in result) == ['dim_counterparty', 'dim_date', 'dim_location',
+                                                               'dim_staff', 'fact_sales_order']
+        for key in result:
+            saved = pd.read_parquet(BytesIO(s3_isolated.get_object(Bucket='processed-bucket', Key=key)["Body"].read()))
+            assert len(saved) > 0
+
 class TestTransformLambdaHandler:
 
     def test_lambda_transform_with_no_event(self, s3_boto, mock_s3_buckets, monkeypatch):
@@ -356,6 +693,15 @@ class TestTransformLambdaHandler:
         assert result.keys() == {'message', 'timestamp', 'total_new_files', 'new_keys'}
        
 
+    def test_lambda_transform_with_no_event_does_not_import_pandas(self):
+        import subprocess
+        import sys
+        script = ("import sys; from src.transform.lambda_transform import lambda_transform; "
+                  "lambda_transform({'timestamp': '2025-06-10T10:04:36.847261', 'total_new_files': 0, 'new_keys': []}, None); "
+                  "print(sorted(name for name in ('pandas', 'numpy', 'awswrangler', 'pyarrow') if name in sys.modules))")
+        result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+        assert result.stdout.strip() == "[]"
+
     def test_lambda_transform_with_1_event_and_no_data(self, s3_boto, mock_s3_buckets, monkeypatch):
         test_events = {
                 "message": "completed ingestion",
@@ -376,6 +722,24 @@ class TestTransformLambdaHandler:
         assert len(result) == 4
         assert result.keys() == {'message', 'timestamp', 'total_new_files', 'new_keys'}
         assert result['total_new_files'] == 2
+
+    def test_lambda_transform_with_workers_keeps_dependencies_and_key_order(self, s3_boto, mock_s3_buckets, monkeypatch):
+        test_events = {
+                "message": "completed ingestion",
+                "timestamp": "2025-06-10T10:04:36.847261",
+                "total_new_files": 4,
+                "new_keys": ['dev/staff', 'dev/counterparty', 'dev/department', 'dev/address']
+                }
+        monkeypatch.setenv("INGESTION_S3", 'ingestion-bucket')
+        monkeypatch.setenv("PROCESSED_S3", 'processed-bucket')
+        monkeypatch.setenv("TRANSFORM_WORKERS", '4')
+        monkeypatch.setattr("boto3.client", lambda _: s3_boto)
+
+        result = lambda_transform(test_events, None)
+
+        assert [key.split("/")[1] for key in result['new_keys']] == ['dim_staff', 'dim_counterparty', 'dim_location']
+        dim_staff = pd.read_parquet(BytesIO(s3_boto.get_object(Bucket='processed-bucket', Key=result['new_keys'][0])["Body"].read()))
+        assert dim_staff["department_name"].notna().all()
        
         
         